@@ -1,18 +1,38 @@
 import time
 from datetime import datetime
+from contextlib import nullcontext
 from pathlib import Path
 import xlwt
 
 from src.dataset.data_loader import GMDataset, get_dataloader
 from src.evaluation_metric import *
-from src.parallel import DataParallel
+from src.parallel import DataParallel, DistributedDataParallel, init_distributed, is_distributed, is_main_process
 from src.utils.model_sl import load_model
 from src.utils.data_to_cuda import data_to_cuda
 from src.utils.timer import Timer
+from src.utils.amp import autocast
 
 from src.utils.config import cfg
 
 
+def format_accuracy(metrics: MetricAccumulator) -> str:
+    return 'p = {}, r = {}, f1 = {}'.format(
+        metrics.format('precision'), metrics.format('recall'), metrics.format('f1'))
+
+
+def update_accuracy(metrics: MetricAccumulator, pmat_pred, pmat_gt, ns):
+    """
+    Accumulate the matching precision, recall and f1 score of a batch.
+    """
+    recall = matching_recall(pmat_pred, pmat_gt, ns)
+    precision = matching_precision(pmat_pred, pmat_gt, ns)
+    f1 = 2 * (precision * recall) / (precision + recall)
+    f1 = torch.where(torch.isnan(f1), torch.zeros_like(f1), f1)
+    metrics.update('recall', recall)
+    metrics.update('precision', precision)
+    metrics.update('f1', f1)
+
+
 def eval_model(model, dataloader, verbose=False, xls_sheet=None):
     print('Start evaluation...')
     since = time.time()
@@ -25,14 +45,9 @@ def eval_model(model, dataloader, verbose=False, xls_sheet=None):
     ds = dataloader.dataset
     classes = ds.classes
 
-    recalls = []
-    precisions = []
-    f1s = []
-    pred_time = []
-    objs = torch.zeros(len(classes), device=device)
-    cluster_acc = []
-    cluster_purity = []
-    cluster_ri = []
+    # the metrics of every class are accumulated on device, and synchronized once per class
+    cls_metrics = []
+    all_metrics = MetricAccumulator(device)
 
     timer = Timer()
 
@@ -44,17 +59,10 @@ def eval_model(model, dataloader, verbose=False, xls_sheet=None):
         iter_num = 0
 
         ds.cls = cls
-        recall_list = []
-        precision_list = [] 
-        f1_list = []
-        pred_time_list = []
-        obj_total_num = torch.zeros(1, device=device)
-        cluster_acc_list = []
-        cluster_purity_list = []
-        cluster_ri_list = []
+        metrics = MetricAccumulator(device)
 
         for inputs in dataloader:
-            if model.module.device != torch.device('cpu'):
+            if device != torch.device('cpu'):
                 inputs = data_to_cuda(inputs)
 
             batch_num = inputs['batch_size']
@@ -63,8 +71,9 @@ def eval_model(model, dataloader, verbose=False, xls_sheet=None):
 
             with torch.set_grad_enabled(False):
                 timer.tick()
-                outputs = model(inputs)
-                pred_time_list.append(torch.full((batch_num,), timer.toc() / batch_num))
+                with autocast(device):
+                    outputs = model(inputs)
+                metrics.update('time', timer.toc() / batch_num, n=batch_num)
 
             # Evaluate matching accuracy
             if cfg.PROBLEM.TYPE == '2GM':
@@ -76,19 +85,12 @@ def eval_model(model, dataloader, verbose=False, xls_sheet=None):
                 else:
                     gt_mat = outputs['gt_perm_mat']
 
-                recall = matching_recall(outputs['perm_mat'], gt_mat,  outputs['ns'][0])
-                recall_list.append(recall)
-                precision = matching_precision(outputs['perm_mat'], gt_mat, outputs['ns'][0])
-                precision_list.append(precision)
-                f1 = 2 * (precision * recall) / (precision + recall)
-                f1[torch.isnan(f1)] = 0
-                f1_list.append(f1)
+                update_accuracy(metrics, outputs['perm_mat'], gt_mat, outputs['ns'][0])
 
                 if 'aff_mat' in outputs:
                     pred_obj_score = objective_score(outputs['perm_mat'], outputs['aff_mat'])
                     gt_obj_score = objective_score(outputs['gt_perm_mat'], outputs['aff_mat'])
-                    objs[i] += torch.sum(pred_obj_score / gt_obj_score)
-                    obj_total_num += batch_num
+                    metrics.update('obj_score', pred_obj_score / gt_obj_score)
             elif cfg.PROBLEM.TYPE in ['MGM', 'MGMC']:
                 assert 'graph_indices' in outputs
                 assert 'perm_mat_list' in outputs
@@ -97,13 +99,7 @@ def eval_model(model, dataloader, verbose=False, xls_sheet=None):
                 ns = outputs['ns']
                 for x_pred, x_gt, (idx_src, idx_tgt) in \
                         zip(outputs['perm_mat_list'], outputs['gt_perm_mat_list'], outputs['graph_indices']):
-                    recall = matching_recall(x_pred, x_gt, ns[idx_src])
-                    recall_list.append(recall)
-                    precision = matching_precision(x_pred, x_gt, ns[idx_src])
-                    precision_list.append(precision)
-                    f1 = 2 * (precision * recall) / (precision + recall)
-                    f1[torch.isnan(f1)] = 0
-                    f1_list.append(f1)
+                    update_accuracy(metrics, x_pred, x_gt, ns[idx_src])
             else:
                 raise ValueError('Unknown problem type {}'.format(cfg.PROBLEM.TYPE))
 
@@ -113,37 +109,31 @@ def eval_model(model, dataloader, verbose=False, xls_sheet=None):
                 assert 'cls' in outputs
 
                 pred_cluster = outputs['pred_cluster']
-                cls_gt_transpose = [[] for _ in range(batch_num)]
-                for batched_cls in outputs['cls']:
-                    for b, _cls in enumerate(batched_cls):
-                        cls_gt_transpose[b].append(_cls)
-                cluster_acc_list.append(clustering_accuracy(pred_cluster, cls_gt_transpose))
-                cluster_purity_list.append(clustering_purity(pred_cluster, cls_gt_transpose))
-                cluster_ri_list.append(rand_index(pred_cluster, cls_gt_transpose))
+                cls_gt_transpose = [list(_cls) for _cls in zip(*outputs['cls'])]
+                metrics.update('cluster_acc', clustering_accuracy(pred_cluster, cls_gt_transpose))
+                metrics.update('cluster_purity', clustering_purity(pred_cluster, cls_gt_transpose))
+                metrics.update('cluster_ri', rand_index(pred_cluster, cls_gt_transpose))
 
             if iter_num % cfg.STATISTIC_STEP == 0 and verbose:
                 running_speed = cfg.STATISTIC_STEP * batch_num / (time.time() - running_since)
                 print('Class {} Iteration {:<4} {:>4.2f}sample/s'.format(cls, iter_num, running_speed))
                 running_since = time.time()
 
-        recalls.append(torch.cat(recall_list))
-        precisions.append(torch.cat(precision_list))
-        f1s.append(torch.cat(f1_list))
-        objs[i] = objs[i] / obj_total_num
-        pred_time.append(torch.cat(pred_time_list))
-        if cfg.PROBLEM.TYPE == 'MGMC':
-            cluster_acc.append(torch.cat(cluster_acc_list))
-            cluster_purity.append(torch.cat(cluster_purity_list))
-            cluster_ri.append(torch.cat(cluster_ri_list))
+        # in distributed mode, the results of all processes are reduced
+        all_metrics.merge(metrics)
+        metrics.synchronize()
+        cls_metrics.append(metrics)
 
         if verbose:
-            print('Class {} {}'.format(cls, format_accuracy_metric(precisions[i], recalls[i], f1s[i])))
-            print('Class {} norm obj score = {:.4f}'.format(cls, objs[i]))
-            print('Class {} pred time = {}s'.format(cls, format_metric(pred_time[i])))
+            print('Class {} {}'.format(cls, format_accuracy(metrics)))
+            print('Class {} norm obj score = {:.4f}'.format(cls, metrics.mean('obj_score')))
+            print('Class {} pred time = {}s'.format(cls, metrics.format('time')))
             if cfg.PROBLEM.TYPE == 'MGMC':
-                print('Class {} cluster acc={}'.format(cls, format_metric(cluster_acc[i])))
-                print('Class {} cluster purity={}'.format(cls, format_metric(cluster_purity[i])))
-                print('Class {} cluster rand index={}'.format(cls, format_metric(cluster_ri[i])))
+                print('Class {} cluster acc={}'.format(cls, metrics.format('cluster_acc')))
+                print('Class {} cluster purity={}'.format(cls, metrics.format('cluster_purity')))
+                print('Class {} cluster rand index={}'.format(cls, metrics.format('cluster_ri')))
+
+    all_metrics.synchronize()
 
     time_elapsed = time.time() - since
     print('Evaluation complete in {:.0f}m {:.0f}s'.format(time_elapsed // 60, time_elapsed % 60))
@@ -163,19 +153,20 @@ def eval_model(model, dataloader, verbose=False, xls_sheet=None):
         xls_sheet.write(xls_row, 0, 'precision')
         xls_sheet.write(xls_row+1, 0, 'recall')
         xls_sheet.write(xls_row+2, 0, 'f1')
-    for idx, (cls, cls_p, cls_r, cls_f1) in enumerate(zip(classes, precisions, recalls, f1s)):
-        print('{}: {}'.format(cls, format_accuracy_metric(cls_p, cls_r, cls_f1)))
+    for idx, (cls, metrics) in enumerate(zip(classes, cls_metrics)):
+        print('{}: {}'.format(cls, format_accuracy(metrics)))
         if xls_sheet:
-            xls_sheet.write(xls_row, idx+1, torch.mean(cls_p).item())
-            xls_sheet.write(xls_row+1, idx+1, torch.mean(cls_r).item())
-            xls_sheet.write(xls_row+2, idx+1, torch.mean(cls_f1).item())
-    print('average accuracy: {}'.format(format_accuracy_metric(torch.cat(precisions), torch.cat(recalls), torch.cat(f1s))))
+            xls_sheet.write(xls_row, idx+1, metrics.mean('precision'))
+            xls_sheet.write(xls_row+1, idx+1, metrics.mean('recall'))
+            xls_sheet.write(xls_row+2, idx+1, metrics.mean('f1'))
+    print('average accuracy: {}'.format(format_accuracy(all_metrics)))
     if xls_sheet:
-        xls_sheet.write(xls_row, idx+2, torch.mean(torch.cat(precisions)).item())
-        xls_sheet.write(xls_row+1, idx+2, torch.mean(torch.cat(recalls)).item())
-        xls_sheet.write(xls_row+2, idx+2, torch.mean(torch.cat(f1s)).item())
+        xls_sheet.write(xls_row, idx+2, all_metrics.mean('precision'))
+        xls_sheet.write(xls_row+1, idx+2, all_metrics.mean('recall'))
+        xls_sheet.write(xls_row+2, idx+2, all_metrics.mean('f1'))
         xls_row += 3
 
+    objs = torch.tensor([metrics.mean('obj_score') for metrics in cls_metrics])
     if not torch.any(torch.isnan(objs)):
         print('Normalized objective score')
         if xls_sheet: xls_sheet.write(xls_row, 0, 'norm objscore')
@@ -188,47 +179,31 @@ def eval_model(model, dataloader, verbose=False, xls_sheet=None):
             xls_row += 1
 
     if cfg.PROBLEM.TYPE == 'MGMC':
-        print('Clustering accuracy')
-        if xls_sheet: xls_sheet.write(xls_row, 0, 'cluster acc')
-        for idx, (cls, cls_acc) in enumerate(zip(classes, cluster_acc)):
-            print('{} = {}'.format(cls, format_metric(cls_acc)))
-            if xls_sheet: xls_sheet.write(xls_row, idx+1, torch.mean(cls_acc).item())
-        print('average clustering accuracy = {}'.format(format_metric(torch.cat(cluster_acc))))
-        if xls_sheet:
-            xls_sheet.write(xls_row, idx+2, torch.mean(torch.cat(cluster_acc)).item())
-            xls_row += 1
-
-        print('Clustering purity')
-        if xls_sheet: xls_sheet.write(xls_row, 0, 'cluster purity')
-        for idx, (cls, cls_acc) in enumerate(zip(classes, cluster_purity)):
-            print('{} = {}'.format(cls, format_metric(cls_acc)))
-            if xls_sheet: xls_sheet.write(xls_row, idx+1, torch.mean(cls_acc).item())
-        print('average clustering purity = {}'.format(format_metric(torch.cat(cluster_purity))))
-        if xls_sheet:
-            xls_sheet.write(xls_row, idx+2, torch.mean(torch.cat(cluster_purity)).item())
-            xls_row += 1
-
-        print('Clustering rand index')
-        if xls_sheet: xls_sheet.write(xls_row, 0, 'rand index')
-        for idx, (cls, cls_acc) in enumerate(zip(classes, cluster_ri)):
-            print('{} = {}'.format(cls, format_metric(cls_acc)))
-            if xls_sheet: xls_sheet.write(xls_row, idx+1, torch.mean(cls_acc).item())
-        print('average rand index = {}'.format(format_metric(torch.cat(cluster_ri))))
-        if xls_sheet:
-            xls_sheet.write(xls_row, idx+2, torch.mean(torch.cat(cluster_ri)).item())
-            xls_row += 1
+        for name, title, xls_title, avg_title in (
+                ('cluster_acc', 'Clustering accuracy', 'cluster acc', 'average clustering accuracy'),
+                ('cluster_purity', 'Clustering purity', 'cluster purity', 'average clustering purity'),
+                ('cluster_ri', 'Clustering rand index', 'rand index', 'average rand index')):
+            print(title)
+            if xls_sheet: xls_sheet.write(xls_row, 0, xls_title)
+            for idx, (cls, metrics) in enumerate(zip(classes, cls_metrics)):
+                print('{} = {}'.format(cls, metrics.format(name)))
+                if xls_sheet: xls_sheet.write(xls_row, idx+1, metrics.mean(name))
+            print('{} = {}'.format(avg_title, all_metrics.format(name)))
+            if xls_sheet:
+                xls_sheet.write(xls_row, idx+2, all_metrics.mean(name))
+                xls_row += 1
 
     print('Predict time')
     if xls_sheet: xls_sheet.write(xls_row, 0, 'time')
-    for idx, (cls, cls_time) in enumerate(zip(classes, pred_time)):
-        print('{} = {}'.format(cls, format_metric(cls_time)))
-        if xls_sheet: xls_sheet.write(xls_row, idx + 1, torch.mean(cls_time).item())
-    print('average time = {}'.format(format_metric(torch.cat(pred_time))))
+    for idx, (cls, metrics) in enumerate(zip(classes, cls_metrics)):
+        print('{} = {}'.format(cls, metrics.format('time')))
+        if xls_sheet: xls_sheet.write(xls_row, idx + 1, metrics.mean('time'))
+    print('average time = {}'.format(all_metrics.format('time')))
     if xls_sheet:
-        xls_sheet.write(xls_row, idx+2, torch.mean(torch.cat(pred_time)).item())
+        xls_sheet.write(xls_row, idx+2, all_metrics.mean('time'))
         xls_row += 1
 
-    return torch.Tensor(list(map(torch.mean, recalls)))
+    return torch.Tensor([metrics.mean('recall') for metrics in cls_metrics])
 
 
 if __name__ == '__main__':
@@ -243,6 +218,7 @@ if __name__ == '__main__':
     mod = importlib.import_module(cfg.MODULE)
     Net = mod.Net
 
+    device = init_distributed()
     torch.manual_seed(cfg.RANDOM_SEED)
     rate_1 = 1.0
     rate_2 = 1.0
@@ -256,18 +232,20 @@ if __name__ == '__main__':
                               obj_resize=cfg.PROBLEM.RESCALE)
     dataloader = get_dataloader(image_dataset)
 
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-
     model = Net()
     model = model.to(device)
-    model = DataParallel(model, device_ids=cfg.GPUS)
+    if is_distributed():
+        model = DistributedDataParallel(model)
+    else:
+        model = DataParallel(model, device_ids=cfg.GPUS)
 
     if not Path(cfg.OUTPUT_PATH).exists():
         Path(cfg.OUTPUT_PATH).mkdir(parents=True)
     now_time = datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
     wb = xlwt.Workbook()
     ws = wb.add_sheet('epoch{}'.format(cfg.EVAL.EPOCH))
-    with DupStdoutFileManager(str(Path(cfg.OUTPUT_PATH) / ('eval_log_' + now_time + '.log'))) as _:
+    with DupStdoutFileManager(str(Path(cfg.OUTPUT_PATH) / ('eval_log_' + now_time + '.log'))) \
+            if is_main_process() else nullcontext() as _:
         print_easydict(cfg)
         print('Number of parameters: {:.2f}M'.format(count_parameters(model) / 1e6))
 
@@ -285,4 +263,5 @@ if __name__ == '__main__':
             verbose=True,
             xls_sheet=ws
         )
-    wb.save(str(Path(cfg.OUTPUT_PATH) / ('eval_result_' + now_time + '.xls')))
+    if is_main_process():
+        wb.save(str(Path(cfg.OUTPUT_PATH) / ('eval_result_' + now_time + '.xls')))
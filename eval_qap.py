@@ -59,7 +59,7 @@ def eval_model(model, alphas, dataloader, eval_epoch=None, verbose=False):
         rel_sum = torch.zeros(1, device=device)
         rel_num = torch.zeros(1, device=device)
         for inputs in dataloader:
-            if model.module.device != torch.device('cpu'):
+            if device != torch.device('cpu'):
                 inputs = data_to_cuda(inputs)
 
             ori_affmtx = inputs['aff_mat']
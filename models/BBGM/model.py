@@ -10,6 +10,8 @@ from src.feature_align import feature_align
 
 from src.utils.config import cfg
 from src.utils.c_loss import simclr_loss
+from src.ssl.mixing import ragged_to_padded, batched_randperm, mix_node_features, perm_to_mat, \
+    compact_nonzero_rows
 
 from src.backbone import *
 CNN = eval(cfg.BACKBONE)
@@ -77,14 +79,12 @@ class Net(CNN):
         perm_list = []
         node_feature_cl = []
         idx = 0
-        perms = []
-        for image, p, n_p, graph in zip(images, points, n_points, graphs):
+        mix_perm = None
+        # extract feature of all graphs in one pass
+        cnn_feats = self.extract_features_list(images, data_dict.get('img_keys'))
+        for (nodes, edges, global_feat), p, n_p, graph in zip(cnn_feats, points, n_points, graphs):
             idx += 1
-            # extract feature
-            nodes = self.node_layers(image)
-            edges = self.edge_layers(nodes)
-
-            global_list.append(self.final_layers(edges).reshape((nodes.shape[0], -1)))
+            global_list.append(global_feat)
             nodes = normalize_over_channels(nodes)
             edges = normalize_over_channels(edges)
 
@@ -94,32 +94,14 @@ class Net(CNN):
             node_features = torch.cat((U, F), dim=1)
 
             if cfg.PROBLEM.SSL:
-                n_p_c = n_p.cpu().detach().numpy()
-
                 if cfg.SSL.C_LOSS:
-                    node_features_format = torch.zeros([perm_old.shape[0], perm_old.shape[1], node_features.shape[1]],
-                                                       device=perm_old.device)  # B x N x D
-                    pre = 0
-                    for i in range(len(n_p_c)):
-                        node_features_format[i][0: n_p_c[i]] = node_features[pre: pre + n_p_c[i]]
-                        pre += int(n_p_c[i])
-                    node_feature_cl.append(node_features_format)
+                    node_feature_cl.append(ragged_to_padded(node_features, n_p, perm_old.shape[1]))  # B x N x D
 
                 if idx == 2:
-                    pre = 0
-                    rate = cfg.SSL.MIX_RATE
-                    for i in range(len(n_p_c)):
-                        perm = torch.randperm(int(n_p_c[i]))
-                        perms.append(perm)
-                        if not cfg.SSL.MIX_DETACH:
-                            node_features[pre: pre + n_p_c[i]] = node_features[pre: pre + n_p_c[i]] * (
-                                        1 - rate) + rate * \
-                                                                 node_features[pre + perm]
-                        else:
-                            node_features[pre: pre + n_p_c[i]] = node_features[pre: pre + n_p_c[i]] * (
-                                        1 - rate) + rate * \
-                                                                 node_features[pre + perm].detach()
-                        pre += int(n_p_c[i])
+                    # the mixing permutations of the whole batch are generated at once
+                    mix_perm = batched_randperm(n_p, perm_old.shape[1])
+                    node_features = mix_node_features(node_features, n_p, mix_perm, cfg.SSL.MIX_RATE,
+                                                      cfg.SSL.MIX_DETACH)
 
             graph.x = node_features
             graph = self.message_pass_node_features(graph)
@@ -130,22 +112,13 @@ class Net(CNN):
             z1 = node_feature_cl[0]
             z2 = node_feature_cl[1]
             z2_ = torch.bmm(perm_old, z2)
-            z1_cross = torch.zeros(z1.shape, device=z1.device)
-            z2_cross = torch.zeros(z1.shape, device=z1.device)
-            for i in range(len(z2_)):
-                non_zeros = z2_[i].sum(axis=1).nonzero()[:, 0]
-                z2_cross[i][0: len(non_zeros)] = z2_[i][non_zeros]
-                z1_cross[i][0: len(non_zeros)] = z1[i][non_zeros]
+            z2_cross, z1_cross = compact_nonzero_rows(z2_, z1)
             c_loss = simclr_loss(torch.nn.functional.normalize(self.mlp(z1_cross), dim=-1),
                                  torch.nn.functional.normalize(self.mlp(z2_cross), dim=-1))
             data_dict['c_loss'] = c_loss
 
         if cfg.PROBLEM.SSL and not cfg.SSL.MIX_DETACH:
-            perm_new = torch.zeros(perm_old.shape).to(perm_old.device)
-            for i in range(len(perm_old)):
-                perm = perms[i]
-                for j in range(len(perm)):
-                    perm_new[i][j, perm[j]] = 1
+            perm_new = perm_to_mat(mix_perm, n_points[1], dtype=perm_old.dtype)
             perm_new_ = torch.bmm(perm_old, perm_new)[:, 0: old_shape[0], 0: old_shape[1]]
             data_dict['gt_perm_mat_old'] = copy.deepcopy(data_dict['gt_perm_mat'])
             data_dict['gt_perm_mat_new'] = perm_new_
@@ -40,10 +40,8 @@ class Net(CNN):
             G_src, G_tgt = data_dict['Gs']
             H_src, H_tgt = data_dict['Hs']
             # extract feature
-            src_node = self.node_layers(src)
-            src_edge = self.edge_layers(src_node)
-            tgt_node = self.node_layers(tgt)
-            tgt_edge = self.edge_layers(tgt_node)
+            (src_node, src_edge, _), (tgt_node, tgt_edge, _) = \
+                self.extract_features_list([src, tgt], data_dict.get('img_keys'))
 
             # feature normalization
             src_node = self.l2norm(src_node)
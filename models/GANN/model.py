@@ -125,8 +125,8 @@ class Net(CNN):
             data_cat = torch.cat(data, dim=0)
             P_cat = torch.cat(pad_tensor(Ps), dim=0)
             n_cat = torch.cat(ns, dim=0)
-            node = self.node_layers(data_cat)
-            edge = self.edge_layers(node)
+            keys_cat = torch.cat(data_dict['img_keys']) if 'img_keys' in data_dict else None
+            node, edge, _ = self.extract_features(data_cat, keys_cat)
             U = feature_align(node, P_cat, n_cat, self.rescale)
             F = feature_align(edge, P_cat, n_cat, self.rescale)
             feats = torch.cat((U, F), dim=1)
@@ -38,10 +38,8 @@ class Net(CNN):
             K_G, K_H = data_dict['KGHs']
 
             # extract feature
-            src_node = self.node_layers(src)
-            src_edge = self.edge_layers(src_node)
-            tgt_node = self.node_layers(tgt)
-            tgt_edge = self.edge_layers(tgt_node)
+            (src_node, src_edge, _), (tgt_node, tgt_edge, _) = \
+                self.extract_features_list([src, tgt], data_dict.get('img_keys'))
 
             # feature normalization
             src_node = self.l2norm(src_node)
@@ -76,7 +74,7 @@ class Net(CNN):
         # affinity layer
         Me, Mp = self.affinity_layer(X, Y, U_src, U_tgt)
 
-        M = construct_aff_mat(Me, Mp, K_G, K_H)
+        M = construct_aff_mat(Me, Mp, K_G, K_H, lazy=cfg.GMN.LAZY_AFF)
 
         v = self.gm_solver(M, num_src=P_src.shape[1], ns_src=ns_src, ns_tgt=ns_tgt)
         s = v.view(v.shape[0], P_tgt.shape[1], -1).transpose(1, 2)
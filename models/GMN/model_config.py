@@ -12,4 +12,5 @@ __C.GMN.PI_STOP_THRESH = 2e-7
 __C.GMN.BS_ITER_NUM = 10
 __C.GMN.BS_EPSILON = 1e-10
 __C.GMN.VOTING_ALPHA = 2e8
-__C.GMN.GM_SOLVER = 'SM'
\ No newline at end of file
+__C.GMN.GM_SOLVER = 'SM'
+__C.GMN.LAZY_AFF = False # pass K to the solver as a lazy FactorizedAffinity operator instead of a dense tensor
\ No newline at end of file
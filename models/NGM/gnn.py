@@ -8,7 +8,7 @@ from collections import Iterable
 
 class GNNLayer(nn.Module):
     def __init__(self, in_node_features, in_edge_features, out_node_features, out_edge_features,
-                 sk_channel=0, sk_iter=20, sk_tau=0.05, edge_emb=False):
+                 sk_channel=0, sk_iter=20, sk_tau=0.05, edge_emb=False, sk_tol=0., sk_backward='unroll'):
         super(GNNLayer, self).__init__()
         self.in_nfeat = in_node_features
         self.in_efeat = in_edge_features
@@ -17,7 +17,7 @@ class GNNLayer(nn.Module):
         assert out_node_features == out_edge_features + self.sk_channel
         if self.sk_channel > 0:
             self.out_nfeat = out_node_features - self.sk_channel
-            self.sk = Sinkhorn(sk_iter, sk_tau)
+            self.sk = Sinkhorn(sk_iter, sk_tau, tol=sk_tol, backward_mode=sk_backward)
             self.classifier = nn.Linear(self.out_nfeat, self.sk_channel)
         else:
             self.out_nfeat = out_node_features
@@ -51,22 +51,15 @@ class GNNLayer(nn.Module):
 
     def forward(self, A, W, x, n1=None, n2=None, norm=True):
         """
-        :param A: adjacent matrix in 0/1 (b x n x n)
-        :param W: edge feature tensor (b x n x n x feat_dim)
+        wrapper function of forward (support dense/sparse)
+        :param A: adjacent matrix in 0/1 (b x n x n), or a tuple of its indices (3 x nnz) and values (nnz)
+        :param W: edge feature tensor (b x n x n x feat_dim), or the edge features of non-zero elements (nnz x feat_dim)
         :param x: node feature tensor (b x n x feat_dim)
         """
-        if self.e_func is not None:
-            W1 = torch.mul(A.unsqueeze(-1), x.unsqueeze(1))
-            W2 = torch.cat((W, W1), dim=-1)
-            W_new = self.e_func(W2)
+        if type(A) is tuple:
+            W_new, x2 = self.forward_sparse(A, W, x, norm)
         else:
-            W_new = W
-
-        if norm is True:
-            A = F.normalize(A, p=1, dim=2)
-
-        x1 = self.n_func(x)
-        x2 = torch.matmul((A.unsqueeze(-1) * W_new).permute(0, 3, 1, 2), x1.unsqueeze(2).permute(0, 3, 1, 2)).squeeze(-1).transpose(1, 2)
+            W_new, x2 = self.forward_dense(A, W, x, norm)
         x2 += self.n_self_func(x)
 
         if self.classifier is not None:
@@ -84,6 +77,69 @@ class GNNLayer(nn.Module):
 
         return W_new, x_new
 
+    def forward_sparse(self, A, W, x, norm=True):
+        """
+        Message passing over the non-zero elements of the adjacent matrix, whose cost scales with the number of
+        non-zero elements instead of n x n.
+        :param A: tuple of indices (3 x nnz, in order of batch, row, column) and values (nnz) of the adjacent matrix
+        :param W: edge feature tensor of the non-zero elements (nnz x feat_dim)
+        :param x: node feature tensor (b x n x feat_dim)
+        """
+        A_ind, A_val = A
+        batch_num, n = x.shape[0], x.shape[1]
+        row = A_ind[0] * n + A_ind[1]
+        col = A_ind[0] * n + A_ind[2]
+
+        if self.e_func is not None:
+            W1 = A_val.unsqueeze(-1) * x.reshape(batch_num * n, -1)[col]
+            W2 = torch.cat((W, W1), dim=-1)
+            W_new = self.e_func(W2)
+        else:
+            W_new = W
+
+        if norm is True:
+            A_sum = torch.zeros(batch_num * n, dtype=A_val.dtype, device=A_val.device).index_add(0, row, A_val.abs())
+            A_val = A_val / A_sum.clamp(min=1e-12)[row]  # same as F.normalize(A, p=1, dim=2)
+
+        x1 = self.n_func(x).reshape(batch_num * n, -1)
+        msg = A_val.unsqueeze(-1) * W_new * x1[col]
+        x2 = torch.zeros(batch_num * n, msg.shape[-1], dtype=msg.dtype, device=msg.device).index_add(0, row, msg)
+
+        return W_new, x2.view(batch_num, n, -1)
+
+    def forward_dense(self, A, W, x, norm=True):
+        """
+        :param A: adjacent matrix in 0/1 (b x n x n)
+        :param W: edge feature tensor (b x n x n x feat_dim)
+        :param x: node feature tensor (b x n x feat_dim)
+        """
+        if self.e_func is not None:
+            W1 = torch.mul(A.unsqueeze(-1), x.unsqueeze(1))
+            W2 = torch.cat((W, W1), dim=-1)
+            W_new = self.e_func(W2)
+        else:
+            W_new = W
+
+        if norm is True:
+            A = F.normalize(A, p=1, dim=2)
+
+        x1 = self.n_func(x)
+        x2 = torch.matmul((A.unsqueeze(-1) * W_new).permute(0, 3, 1, 2), x1.unsqueeze(2).permute(0, 3, 1, 2)).squeeze(-1).transpose(1, 2)
+
+        return W_new, x2
+
+
+def normalize_sparse_adj(A: torch.Tensor) -> torch.Tensor:
+    """
+    Normalize the sparse adjacent tensor (b x {n x ... x n}) by its sum over dims 2, ..., order, i.e. the hyperedges
+    starting from every node sum to 1. The order of the non-zero elements is kept.
+    """
+    ind, val = A._indices(), A._values()
+    row = ind[0] * A.shape[1] + ind[1]
+    A_sum = torch.zeros(A.shape[0] * A.shape[1], dtype=val.dtype, device=val.device).index_add(0, row, val)[row]
+    val = torch.where(A_sum != 0, val / A_sum, torch.zeros_like(val))
+    return torch.sparse_coo_tensor(ind, val, A.shape)
+
 
 class HyperGNNLayer(nn.Module):
     def __init__(self, in_node_features, in_edge_features, out_node_features, out_edge_features, orders=3, eps=1e-10,
@@ -183,10 +239,12 @@ class HyperGNNLayer(nn.Module):
 
         W_new_val = W_val
         if norm is True:
-            assert not A.is_sparse, 'sparse normalization is currently not supported'
-            A_sum = torch.sum(A, dim=tuple(range(2, order + 1)), keepdim=True)
-            A = A / A_sum.expand_as(A)
-            A[torch.isnan(A)] = 0
+            if A.is_sparse:
+                A = normalize_sparse_adj(A)
+            else:
+                A_sum = torch.sum(A, dim=tuple(range(2, order + 1)), keepdim=True)
+                A = A / A_sum.expand_as(A)
+                A[torch.isnan(A)] = 0
 
         if not A.is_sparse:
             A = A.to_sparse()
@@ -4,8 +4,8 @@ from src.lap_solvers.sinkhorn import Sinkhorn
 from src.lap_solvers.hungarian import hungarian
 from src.build_graphs import reshape_edge_feature
 from src.feature_align import feature_align
-from src.factorize_graph_matching import construct_aff_mat
-from models.NGM.gnn import HyperGNNLayer
+from src.factorize_graph_matching import construct_aff_mat, order3_hyperedges
+from models.NGM.gnn import HyperGNNLayer, normalize_sparse_adj
 from models.NGM.geo_edge_feature import geo_edge_feature
 from models.GMN.affinity_layer import GaussianAffinity, InnerpAffinity
 
@@ -57,10 +57,8 @@ class Net(CNN):
             K_G, K_H = data_dict['KGHs']
 
             # extract feature
-            src_node = self.node_layers(src)
-            src_edge = self.edge_layers(src_node)
-            tgt_node = self.node_layers(tgt)
-            tgt_edge = self.edge_layers(tgt_node)
+            (src_node, src_edge, _), (tgt_node, tgt_edge, _) = \
+                self.extract_features_list([src, tgt], data_dict.get('img_keys'))
 
             # feature normalization
             src_node = self.l2norm(src_node)
@@ -105,52 +103,45 @@ class Net(CNN):
         K = construct_aff_mat(Ke, torch.zeros_like(Kp), K_G, K_H)
         adj = (K > 0).to(K.dtype)
 
-        # build 3-order affinity tensor
+        # build 3-order affinity tensor, which is sparse and only contains the triangles of the association graph
         hshape = list(adj.shape) + [adj.shape[-1]]
-        order3A = adj.unsqueeze(1).expand(hshape) * adj.unsqueeze(2).expand(hshape) * adj.unsqueeze(3).expand(hshape)
-        hyper_adj = order3A
+        hyper_ind = order3_hyperedges(adj)
+        b_idx, x_idx, y_idx, z_idx = hyper_ind
 
         if cfg.NGM.ORDER3_FEATURE == 'cat':
             Ke_3, _ = self.feat_affinity_layer3(X, Y, torch.zeros(1, 1, 1), torch.zeros(1, 1, 1), w1=0.5, w2=1)
             K_3 = construct_aff_mat(Ke_3, torch.zeros_like(Kp), K_G, K_H)
-            H = (K_3.unsqueeze(1).expand(hshape) + K_3.unsqueeze(2).expand(hshape) + K_3.unsqueeze(3).expand(hshape)) * F.relu(self.weight3)
+            H = (K_3[b_idx, y_idx, z_idx] + K_3[b_idx, x_idx, z_idx] + K_3[b_idx, x_idx, y_idx]) * F.relu(self.weight3)
         elif cfg.NGM.ORDER3_FEATURE == 'geo':
             Ke_d, _ = self.geo_affinity_layer(dx, dy, torch.zeros(1, 1, 1), torch.zeros(1, 1, 1))
 
-            m_d_src = construct_aff_mat(dx.squeeze().unsqueeze(-1).expand_as(Ke_d), torch.zeros_like(Kp), K_G, K_H).cpu()
-            m_d_tgt = construct_aff_mat(dy.squeeze().unsqueeze(-2).expand_as(Ke_d), torch.zeros_like(Kp), K_G, K_H).cpu()
-            order3A = order3A.cpu()
+            m_d_src = construct_aff_mat(dx.squeeze().unsqueeze(-1).expand_as(Ke_d), torch.zeros_like(Kp), K_G, K_H)
+            m_d_tgt = construct_aff_mat(dy.squeeze().unsqueeze(-2).expand_as(Ke_d), torch.zeros_like(Kp), K_G, K_H)
 
-            cum_sin = torch.zeros_like(order3A)
+            # the side lengths (y, z), (x, z), (x, y) of every triangle
+            sides_src = [m_d_src[b_idx, y_idx, z_idx], m_d_src[b_idx, x_idx, z_idx], m_d_src[b_idx, x_idx, y_idx]]
+            sides_tgt = [m_d_tgt[b_idx, y_idx, z_idx], m_d_tgt[b_idx, x_idx, z_idx], m_d_tgt[b_idx, x_idx, y_idx]]
+
+            cum_sin = torch.zeros_like(sides_src[0])
             for i in range(3):
-                def calc_sin(t):
-                    a = t.unsqueeze(i % 3 + 1).expand(hshape)
-                    b = t.unsqueeze((i + 1) % 3 + 1).expand(hshape)
-                    c = t.unsqueeze((i + 2) % 3 + 1).expand(hshape)
+                def calc_sin(sides):
+                    a, b, c = sides[i % 3], sides[(i + 1) % 3], sides[(i + 2) % 3]
                     cos = torch.clamp((a.pow(2) + b.pow(2) - c.pow(2)) / (2 * a * b + 1e-15), -1, 1)
-                    cos *= order3A
-                    sin = torch.sqrt(1 - cos.pow(2)) * order3A
-                    assert torch.sum(torch.isnan(sin)) == 0
-                    return sin
-                sin_src = calc_sin(m_d_src)
-                sin_tgt = calc_sin(m_d_tgt)
+                    return torch.sqrt(1 - cos.pow(2))
+                sin_src = calc_sin(sides_src)
+                sin_tgt = calc_sin(sides_tgt)
                 cum_sin += torch.abs(sin_src - sin_tgt)
 
-            H = torch.exp(- 1 / cfg.NGM.SIGMA3 * cum_sin) * order3A
-            H = H.cuda()
-            order3A = order3A.cuda()
+            H = torch.exp(- 1 / cfg.NGM.SIGMA3 * cum_sin)
         elif cfg.NGM.ORDER3_FEATURE == 'none':
-            H = torch.zeros_like(hyper_adj)
+            H = torch.zeros(hyper_ind.shape[1], dtype=adj.dtype, device=adj.device)
         else:
             raise ValueError('Unknown edge feature type {}'.format(cfg.NGM.ORDER3_FEATURE))
 
-        hyper_adj = hyper_adj.cpu()
-        hyper_adj_sum = torch.sum(hyper_adj, dim=tuple(range(2, 3 + 1)), keepdim=True) + 1e-10
-        hyper_adj = hyper_adj / hyper_adj_sum
-        hyper_adj = hyper_adj.to_sparse().coalesce().cuda()
+        hyper_adj = torch.sparse_coo_tensor(hyper_ind, torch.ones_like(H), hshape)
+        hyper_adj = normalize_sparse_adj(hyper_adj)
 
-        H = H.sparse_mask(hyper_adj)
-        H = (H._indices(), H._values().unsqueeze(-1))
+        H = (hyper_ind, H.unsqueeze(-1))
 
         if cfg.NGM.FIRST_ORDER:
             emb = Kp.transpose(1, 2).contiguous().view(Kp.shape[0], -1, 1)
@@ -9,6 +9,7 @@ from models.NGM.gnn import HyperGNNLayer
 from src.lap_solvers.sinkhorn import Sinkhorn
 from src.lap_solvers.hungarian import hungarian
 from src.utils.pad_tensor import pad_tensor
+from src.utils.linalg import eigh
 from src.utils.sparse import to_sparse
 
 from src.utils.config import cfg
@@ -32,6 +33,8 @@ def concat_features(embeddings, num_vertices):
 
 
 def construct_hyperE(ori_graphs, batch_size, device):
+    assert all([getattr(g, 'hyperedge_index', None) is not None for g in ori_graphs]), \
+        'hyperedge_index is not found in graphs. Please set GRAPH.HYPEREDGE = True.'
     nmax = max([g.num_nodes for g in ori_graphs])
     emax = max([g.hyperedge_index.shape[1] for g in ori_graphs])
     hyperE = torch.zeros(batch_size, nmax, nmax, nmax, emax, device=device)
@@ -110,12 +113,10 @@ class Net(CNN):
 
         global_list = []
         orig_graph_list = []
-        for image, p, n_p, graph in zip(images, points, n_points, graphs):
-            # extract feature
-            nodes = self.node_layers(image)
-            edges = self.edge_layers(nodes)
-
-            global_list.append(self.final_layers(edges).reshape((nodes.shape[0], -1)))
+        # extract feature of all graphs in one pass
+        cnn_feats = self.extract_features_list(images, data_dict.get('img_keys'))
+        for (nodes, edges, global_feat), p, n_p, graph in zip(cnn_feats, points, n_points, graphs):
+            global_list.append(global_feat)
             nodes = normalize_over_channels(nodes)
             edges = normalize_over_channels(edges)
 
@@ -214,7 +215,7 @@ class Net(CNN):
 
             matching_s = []
             for b in range(batch_size):
-                e, v = torch.symeig(joint_S[b], eigenvectors=True)
+                e, v = eigh(joint_S[b])
                 diff = e[-self.univ_size:-1] - e[-self.univ_size+1:]
                 if self.training and torch.min(torch.abs(diff)) <= 1e-4:
                     matching_s.append(joint_S[b])
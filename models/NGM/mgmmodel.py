@@ -10,6 +10,7 @@ from models.NGM.gnn import GNNLayer
 from models.NGM.geo_edge_feature import geo_edge_feature
 from models.GMN.affinity_layer import InnerpAffinity, GaussianAffinity
 from src.lap_solvers.hungarian import hungarian
+from src.utils.linalg import eigh
 
 from itertools import combinations
 import numpy as np
@@ -92,8 +93,8 @@ class Net(CNN):
             data_cat = torch.cat(data, dim=0)
             P_cat = torch.cat(pad_tensor(Ps), dim=0)
             n_cat = torch.cat(ns, dim=0)
-            node = self.node_layers(data_cat)
-            edge = self.edge_layers(node)
+            keys_cat = torch.cat(data_dict['img_keys']) if 'img_keys' in data_dict else None
+            node, edge, _ = self.extract_features(data_cat, keys_cat)
             U = feature_align(node, P_cat, n_cat, self.rescale)
             F = feature_align(edge, P_cat, n_cat, self.rescale)
             feats = torch.cat((U, F), dim=1)
@@ -156,7 +157,7 @@ class Net(CNN):
 
         matching_s = []
         for b in range(batch_size):
-            e, v = torch.symeig(joint_S[b], eigenvectors=True)
+            e, v = eigh(joint_S[b])
             topargs = torch.argsort(torch.abs(e), descending=True)[:joint_indices[1]]
             diff = e[topargs[:-1]] - e[topargs[1:]]
             if torch.min(torch.abs(diff)) > 1e-4:
@@ -70,10 +70,8 @@ class Net(CNN):
             K_G, K_H = data_dict['KGHs']
 
             # extract feature
-            src_node = self.node_layers(src)
-            src_edge = self.edge_layers(src_node)
-            tgt_node = self.node_layers(tgt)
-            tgt_edge = self.edge_layers(tgt_node)
+            (src_node, src_edge, _), (tgt_node, tgt_edge, _) = \
+                self.extract_features_list([src, tgt], data_dict.get('img_keys'))
 
             # feature normalization
             src_node = self.l2norm(src_node)
@@ -101,6 +99,9 @@ class Net(CNN):
             F_tgt = tgt[:, tgt.shape[1] // 2:, :]
         elif 'aff_mat' in data_dict:
             K = data_dict['aff_mat']
+            if hasattr(K, 'to_dense'):
+                # the GNN layers take the dense affinity matrix
+                K = K.to_dense()
             ns_src, ns_tgt = data_dict['ns']
         else:
             raise ValueError('Unknown data type for this model.')
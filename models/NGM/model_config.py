@@ -9,8 +9,12 @@ __C.NGM = edict()
 __C.NGM.FEATURE_CHANNEL = 512
 __C.NGM.SK_ITER_NUM = 10
 __C.NGM.SK_EPSILON = 1e-10
+__C.NGM.SK_TOL = 0. # early stopping tolerance of Sinkhorn, 0 for no early stopping
+__C.NGM.SK_BACKWARD = 'unroll' # Sinkhorn backward mode: 'unroll', 'implicit' or 'checkpoint'
 __C.NGM.SK_TAU = 0.005
 __C.NGM.MGM_SK_TAU = 0.005
+__C.NGM.MGM_EIGEN = 'full' # eigensolver of the joint matching matrix in MGM: 'full' or 'randomized' (top UNIV_SIZE only)
+__C.NGM.MGM_EIGEN_ITER = 4 # number of subspace iterations of the randomized eigensolver
 __C.NGM.GNN_FEAT = [16, 16, 16]
 __C.NGM.GNN_LAYER = 3
 __C.NGM.GAUSSIAN_SIGMA = 1.
@@ -25,3 +29,4 @@ __C.NGM.SK_EMB = 1
 __C.NGM.GUMBEL_SK = 0 # 0 for no gumbel, other wise for number of gumbel samples
 __C.NGM.UNIV_SIZE = -1
 __C.NGM.POSITIVE_EDGES = True
+__C.NGM.SPARSE_AFF = False # build K by its non-zero elements and run the GNN layers on the sparse edge list
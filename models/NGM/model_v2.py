@@ -6,12 +6,15 @@ from models.BBGM.sconv_archs import SiameseSConvOnNodes, SiameseNodeFeaturesToEd
 from src.feature_align import feature_align
 from src.factorize_graph_matching import construct_aff_mat
 from src.utils.pad_tensor import pad_tensor
+from src.utils.linalg import eigvalsh, top_eigh
 from models.NGM.gnn import GNNLayer
 from src.lap_solvers.sinkhorn import Sinkhorn
 from src.lap_solvers.hungarian import hungarian
 
 from src.utils.config import cfg
 from src.utils.c_loss import simclr_loss
+from src.ssl.mixing import ragged_to_padded, batched_randperm, mix_node_features, perm_to_mat, \
+    compact_nonzero_rows
 import copy
 from src.backbone import *
 CNN = eval(cfg.BACKBONE)
@@ -26,6 +29,40 @@ def normalize_over_channels(x):
     return x / channel_norms
 
 
+def pairwise_sinkhorn_hungarian(sinkhorn, s_list, ns_list, **kwargs):
+    r"""
+    Run Sinkhorn and Hungarian for all pairs of graphs as one padded batch.
+
+    Every matrix with more rows than columns is transposed beforehand, the same as Sinkhorn does in separate calls.
+
+    :param sinkhorn: the Sinkhorn module
+    :param s_list: list of :math:`(b\times n_i \times n_j)` matrices
+    :param ns_list: list of the number of nodes :math:`(n_i, n_j)` of every matrix
+    :param kwargs: other arguments of Sinkhorn
+    :return: list of doubly-stochastic matrices, list of permutation matrices
+    """
+    batch_size = s_list[0].shape[0]
+    max_n = max([max(s.shape[1:]) for s in s_list])
+    transposed = [s.shape[1] > s.shape[2] for s in s_list]
+    s_batch = torch.cat([torch.nn.functional.pad(s.transpose(1, 2) if t else s,
+                                                 (0, max_n - max(s.shape[1:]), 0, max_n - min(s.shape[1:])))
+                         for s, t in zip(s_list, transposed)])
+    nrows = torch.cat([n2 if t else n1 for (n1, n2), t in zip(ns_list, transposed)])
+    ncols = torch.cat([n1 if t else n2 for (n1, n2), t in zip(ns_list, transposed)])
+
+    ss_batch = sinkhorn(s_batch, nrows, ncols, **kwargs)
+    x_batch = hungarian(ss_batch, nrows, ncols)
+
+    ss_list, x_list = [], []
+    for i, (s, t) in enumerate(zip(s_list, transposed)):
+        rows, cols = min(s.shape[1:]), max(s.shape[1:])
+        ss = ss_batch[i * batch_size:(i + 1) * batch_size, :rows, :cols]
+        x = x_batch[i * batch_size:(i + 1) * batch_size, :rows, :cols]
+        ss_list.append(ss.transpose(1, 2) if t else ss)
+        x_list.append(x.transpose(1, 2) if t else x)
+    return ss_list, x_list
+
+
 def concat_features(embeddings, num_vertices):
     res = torch.cat([embedding[:, :num_v] for embedding, num_v in zip(embeddings, num_vertices)], dim=-1)
     return res.transpose(0, 1)
@@ -55,19 +92,23 @@ class Net(CNN):
         self.mgm_tau = cfg.NGM.MGM_SK_TAU
         self.univ_size = cfg.NGM.UNIV_SIZE
 
-        self.sinkhorn = Sinkhorn(max_iter=cfg.NGM.SK_ITER_NUM, tau=self.tau, epsilon=cfg.NGM.SK_EPSILON)
-        self.sinkhorn_mgm = Sinkhorn(max_iter=cfg.NGM.SK_ITER_NUM, epsilon=cfg.NGM.SK_EPSILON, tau=self.mgm_tau)
+        self.sinkhorn = Sinkhorn(max_iter=cfg.NGM.SK_ITER_NUM, tau=self.tau, epsilon=cfg.NGM.SK_EPSILON,
+                                 tol=cfg.NGM.SK_TOL, backward_mode=cfg.NGM.SK_BACKWARD)
+        self.sinkhorn_mgm = Sinkhorn(max_iter=cfg.NGM.SK_ITER_NUM, epsilon=cfg.NGM.SK_EPSILON, tau=self.mgm_tau,
+                                     tol=cfg.NGM.SK_TOL, backward_mode=cfg.NGM.SK_BACKWARD)
         self.gnn_layer = cfg.NGM.GNN_LAYER
         for i in range(self.gnn_layer):
             tau = cfg.NGM.SK_TAU
             if i == 0:
                 gnn_layer = GNNLayer(1, 1,
                                      cfg.NGM.GNN_FEAT[i] + cfg.NGM.SK_EMB, cfg.NGM.GNN_FEAT[i],
-                                     sk_channel=cfg.NGM.SK_EMB, sk_tau=tau, edge_emb=cfg.NGM.EDGE_EMB)
+                                     sk_channel=cfg.NGM.SK_EMB, sk_tau=tau, edge_emb=cfg.NGM.EDGE_EMB,
+                                     sk_tol=cfg.NGM.SK_TOL, sk_backward=cfg.NGM.SK_BACKWARD)
             else:
                 gnn_layer = GNNLayer(cfg.NGM.GNN_FEAT[i - 1] + cfg.NGM.SK_EMB, cfg.NGM.GNN_FEAT[i - 1],
                                      cfg.NGM.GNN_FEAT[i] + cfg.NGM.SK_EMB, cfg.NGM.GNN_FEAT[i],
-                                     sk_channel=cfg.NGM.SK_EMB, sk_tau=tau, edge_emb=cfg.NGM.EDGE_EMB)
+                                     sk_channel=cfg.NGM.SK_EMB, sk_tau=tau, edge_emb=cfg.NGM.EDGE_EMB,
+                                     sk_tol=cfg.NGM.SK_TOL, sk_backward=cfg.NGM.SK_BACKWARD)
             self.add_module('gnn_layer_{}'.format(i), gnn_layer)
         self.classifier = nn.Linear(cfg.NGM.GNN_FEAT[-1] + cfg.NGM.SK_EMB, 1)
 
@@ -101,14 +142,12 @@ class Net(CNN):
         # perm_list = []
         node_feature_cl = []
         idx = 0
-        perms = []
-        for image, p, n_p, graph in zip(images, points, n_points, graphs):
+        mix_perm = None
+        # extract feature of all graphs in one pass
+        cnn_feats = self.extract_features_list(images, data_dict.get('img_keys'))
+        for (nodes, edges, global_feat), p, n_p, graph in zip(cnn_feats, points, n_points, graphs):
             idx += 1
-            # extract feature
-            nodes = self.node_layers(image)
-            edges = self.edge_layers(nodes)
-
-            global_list.append(self.final_layers(edges).reshape((nodes.shape[0], -1)))
+            global_list.append(global_feat)
             nodes = normalize_over_channels(nodes)
             edges = normalize_over_channels(edges)
 
@@ -118,33 +157,14 @@ class Net(CNN):
             node_features = torch.cat((U, F), dim=1)
 
             if cfg.PROBLEM.SSL:
-                n_p_c = n_p.cpu().detach().numpy()
-
                 if cfg.SSL.C_LOSS:
-                    node_features_format = torch.zeros([perm_old.shape[0], perm_old.shape[1], node_features.shape[1]],
-                                                       device=perm_old.device)  # B x N x D
-                    pre = 0
-                    for i in range(len(n_p_c)):
-                        node_features_format[i][0: n_p_c[i]] = node_features[pre: pre + n_p_c[i]]
-                        pre += int(n_p_c[i])
-                    node_feature_cl.append(node_features_format)
+                    node_feature_cl.append(ragged_to_padded(node_features, n_p, perm_old.shape[1]))  # B x N x D
 
                 if idx == 2:
-                    pre = 0
-                    rate = cfg.SSL.MIX_RATE
-                    for i in range(len(n_p_c)):
-                        perm = torch.randperm(int(n_p_c[i]))
-                        perms.append(perm)
-                        if not cfg.SSL.MIX_DETACH:
-                            node_features[pre: pre + n_p_c[i]] = node_features[pre: pre + n_p_c[i]] * (
-                                        1 - rate) + rate * \
-                                                                 node_features[pre + perm]
-                        else:
-                            node_features[pre: pre + n_p_c[i]] = node_features[pre: pre + n_p_c[i]] * (
-                                        1 - rate) + rate * \
-                                                                 node_features[pre + perm].detach()
-
-                        pre += int(n_p_c[i])
+                    # the mixing permutations of the whole batch are generated at once
+                    mix_perm = batched_randperm(n_p, perm_old.shape[1])
+                    node_features = mix_node_features(node_features, n_p, mix_perm, cfg.SSL.MIX_RATE,
+                                                      cfg.SSL.MIX_DETACH)
 
             # perm_list.append(perms)
             graph.x = node_features
@@ -157,22 +177,13 @@ class Net(CNN):
             z1 = node_feature_cl[0]
             z2 = node_feature_cl[1]
             z2_ = torch.bmm(perm_old, z2)
-            z1_cross = torch.zeros(z1.shape, device=z1.device)
-            z2_cross = torch.zeros(z1.shape, device=z1.device)
-            for i in range(len(z2_)):
-                non_zeros = z2_[i].sum(axis=1).nonzero()[:, 0]
-                z2_cross[i][0: len(non_zeros)] = z2_[i][non_zeros]
-                z1_cross[i][0: len(non_zeros)] = z1[i][non_zeros]
+            z2_cross, z1_cross = compact_nonzero_rows(z2_, z1)
             c_loss = simclr_loss(torch.nn.functional.normalize(self.mlp(z1_cross), dim=-1),
                                  torch.nn.functional.normalize(self.mlp(z2_cross), dim=-1))
             data_dict['c_loss'] = c_loss
 
         if cfg.PROBLEM.SSL and not cfg.SSL.MIX_DETACH:
-            perm_new = torch.zeros(perm_old.shape).to(perm_old.device)
-            for i in range(len(perm_old)):
-                perm = perms[i]
-                for j in range(len(perm)):
-                    perm_new[i][j, perm[j]] = 1
+            perm_new = perm_to_mat(mix_perm, n_points[1], dtype=perm_old.dtype)
             perm_new_ = torch.bmm(perm_old, perm_new)[:, 0: old_shape[0], 0: old_shape[1]]
             data_dict['gt_perm_mat_old'] = copy.deepcopy(data_dict['gt_perm_mat'])
             data_dict['gt_perm_mat_new'] = perm_new_
@@ -200,26 +211,35 @@ class Net(CNN):
 
         quadratic_affs_list = [[0.5 * x for x in quadratic_affs] for quadratic_affs in quadratic_affs_list]
 
-        s_list, mgm_s_list, x_list, mgm_x_list, indices = [], [], [], [], []
+        s_list, mgm_s_list, mgm_x_list, indices = [], [], [], []
 
         for unary_affs, quadratic_affs, (idx1, idx2) in zip(unary_affs_list, quadratic_affs_list, lexico_iter(range(num_graphs))):
             kro_G, kro_H = data_dict['KGHs'] if num_graphs == 2 else data_dict['KGHs']['{},{}'.format(idx1, idx2)]
             Kp = torch.stack(pad_tensor(unary_affs), dim=0)
             Ke = torch.stack(pad_tensor(quadratic_affs), dim=0)
-            K = construct_aff_mat(Ke, Kp, kro_G, kro_H)
+            K = construct_aff_mat(Ke, Kp, kro_G, kro_H, lazy=cfg.NGM.SPARSE_AFF)
             if num_graphs == 2: data_dict['aff_mat'] = K
 
             if cfg.NGM.FIRST_ORDER:
                 emb = Kp.transpose(1, 2).contiguous().view(Kp.shape[0], -1, 1)
             else:
-                emb = torch.ones(K.shape[0], K.shape[1], 1, device=K.device)
+                emb = torch.ones(Kp.shape[0], Kp.shape[1] * Kp.shape[2], 1, device=Kp.device)
 
-            if cfg.NGM.POSITIVE_EDGES:
-                A = (K > 0).to(K.dtype)
+            if cfg.NGM.SPARSE_AFF:
+                # K is represented by its non-zero elements, and the GNN layers pass messages along them
+                K_ind, K_val = K.nonzero()
+                if cfg.NGM.POSITIVE_EDGES:
+                    A = (K_ind, (K_val > 0).to(K_val.dtype))
+                else:
+                    A = (K_ind, (K_val != 0).to(K_val.dtype))
+                emb_K = K_val.unsqueeze(-1)
             else:
-                A = (K != 0).to(K.dtype)
+                if cfg.NGM.POSITIVE_EDGES:
+                    A = (K > 0).to(K.dtype)
+                else:
+                    A = (K != 0).to(K.dtype)
 
-            emb_K = K.unsqueeze(-1)
+                emb_K = K.unsqueeze(-1)
 
             # NGM qap solver
             for i in range(self.gnn_layer):
@@ -229,44 +249,49 @@ class Net(CNN):
             v = self.classifier(emb)
             s = v.view(v.shape[0], points[idx2].shape[1], -1).transpose(1, 2)
 
-            ss = self.sinkhorn(s, n_points[idx1], n_points[idx2], dummy_row=True)
-            x = hungarian(ss, n_points[idx1], n_points[idx2])
-            s_list.append(ss)
-            x_list.append(x)
+            s_list.append(s)
             indices.append((idx1, idx2))
 
+        # the Sinkhorn and Hungarian of all pairs are computed in one batch
+        ns_list = [(n_points[idx1], n_points[idx2]) for idx1, idx2 in indices]
+        s_list, x_list = pairwise_sinkhorn_hungarian(self.sinkhorn, s_list, ns_list, dummy_row=True)
+
         if num_graphs > 2:
-            joint_indices = torch.cat((torch.cumsum(torch.stack([torch.max(np) for np in n_points]), dim=0), torch.zeros((1,), dtype=torch.long, device=K.device)))
-            joint_S = torch.zeros(batch_size, torch.max(joint_indices), torch.max(joint_indices), device=K.device)
+            # assemble the joint matching matrix by blocks, whose sizes are the (padded) numbers of nodes
+            sizes = [None] * num_graphs
+            for (idx1, idx2), s in zip(indices, s_list):
+                sizes[idx1], sizes[idx2] = s.shape[1], s.shape[2]
+            blocks = [[None] * num_graphs for _ in range(num_graphs)]
             for idx in range(num_graphs):
-                for b in range(batch_size):
-                    start = joint_indices[idx-1]
-                    joint_S[b, start:start+n_points[idx][b], start:start+n_points[idx][b]] += torch.eye(n_points[idx][b], device=K.device)
-
+                node_mask = torch.arange(sizes[idx], device=Kp.device).unsqueeze(0) < n_points[idx].unsqueeze(1)
+                blocks[idx][idx] = torch.diag_embed(node_mask.to(s_list[0].dtype))
             for (idx1, idx2), s in zip(indices, s_list):
-                if idx1 > idx2:
-                    joint_S[:, joint_indices[idx2-1]:joint_indices[idx2], joint_indices[idx1-1]:joint_indices[idx1]] += s.transpose(1, 2)
-                else:
-                    joint_S[:, joint_indices[idx1-1]:joint_indices[idx1], joint_indices[idx2-1]:joint_indices[idx2]] += s
-
-            matching_s = []
-            for b in range(batch_size):
-                e, v = torch.symeig(joint_S[b], eigenvectors=True)
-                diff = e[-self.univ_size:-1] - e[-self.univ_size+1:]
-                if self.training and torch.min(torch.abs(diff)) <= 1e-4:
-                    matching_s.append(joint_S[b])
-                else:
-                    matching_s.append(num_graphs * torch.mm(v[:, -self.univ_size:], v[:, -self.univ_size:].transpose(0, 1)))
-
-            matching_s = torch.stack(matching_s, dim=0)
-
-            for idx1, idx2 in indices:
-                s = matching_s[:, joint_indices[idx1-1]:joint_indices[idx1], joint_indices[idx2-1]:joint_indices[idx2]]
-                s = self.sinkhorn_mgm(torch.log(torch.relu(s)), n_points[idx1], n_points[idx2]) # only perform row/col norm, do not perform exp
-                x = hungarian(s, n_points[idx1], n_points[idx2])
+                blocks[idx1][idx2] = s
+                blocks[idx2][idx1] = s.transpose(1, 2)
+            joint_S = torch.cat([torch.cat(row, dim=2) for row in blocks], dim=1)
+            offsets = [0] + list(itertools.accumulate(sizes))
+
+            if self.training:
+                # the eigenvectors are not differentiable if the top eigenvalues are degenerated, and joint_S is used
+                with torch.no_grad():
+                    if cfg.NGM.MGM_EIGEN == 'full':
+                        e = eigvalsh(joint_S)[:, -self.univ_size:]
+                    else:
+                        e = top_eigh(joint_S, self.univ_size, cfg.NGM.MGM_EIGEN, cfg.NGM.MGM_EIGEN_ITER)[0]
+                    diff = e[:, :-1] - e[:, 1:]
+                    keep = torch.nonzero(torch.min(torch.abs(diff), dim=1).values > 1e-4, as_tuple=False).view(-1)
+                matching_s = joint_S
+                if keep.shape[0] > 0:
+                    _, v = top_eigh(joint_S[keep], self.univ_size, cfg.NGM.MGM_EIGEN, cfg.NGM.MGM_EIGEN_ITER)
+                    matching_s = matching_s.index_copy(0, keep, num_graphs * torch.bmm(v, v.transpose(1, 2)))
+            else:
+                _, v = top_eigh(joint_S, self.univ_size, cfg.NGM.MGM_EIGEN, cfg.NGM.MGM_EIGEN_ITER)
+                matching_s = num_graphs * torch.bmm(v, v.transpose(1, 2))
 
-                mgm_s_list.append(s)
-                mgm_x_list.append(x)
+            # only perform row/col norm, do not perform exp
+            mgm_s_list = [torch.log(torch.relu(matching_s[:, offsets[idx1]:offsets[idx1 + 1], offsets[idx2]:offsets[idx2 + 1]]))
+                          for idx1, idx2 in indices]
+            mgm_s_list, mgm_x_list = pairwise_sinkhorn_hungarian(self.sinkhorn_mgm, mgm_s_list, ns_list)
 
         if cfg.PROBLEM.TYPE == '2GM':
             data_dict.update({
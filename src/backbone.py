@@ -1,7 +1,14 @@
+import copy
+import hashlib
+from typing import Optional, Tuple
 import torch
 import torch.nn as nn
+from torch import Tensor
 from torchvision import models
 
+from src.utils.config import cfg
+from src.utils.feature_cache import FeatureCache
+
 
 class VGG16_base(nn.Module):
     r"""
@@ -13,6 +20,10 @@ class VGG16_base(nn.Module):
         self.node_layers, self.edge_layers, self.final_layers = self.get_backbone(batch_norm)
         if not final_layers: self.final_layers = None
         self.backbone_params = list(self.parameters())
+        # shared by the DataParallel replicas (which shallow-copy the module): the module itself, whose weights are the
+        # master copy, the feature caches and the BN-folded fused backbones of every device, and the unfolded fused
+        # backbone of the module itself
+        self._backbone_state = {'module': self, 'caches': dict(), 'folded': dict(), 'unfolded': None}
 
     def forward(self, *input):
         raise NotImplementedError
@@ -21,6 +32,144 @@ class VGG16_base(nn.Module):
     def device(self):
         return next(self.parameters()).device
 
+    def extract_features(self, images, keys=None):
+        r"""
+        Extract the CNN features of a batch of images.
+
+        If ``cfg.FEATURE_CACHE.ENABLED``, the features are cached by the keys of images, and the images which hit the
+        cache skip the CNN. The cache is only used if the backbone is not trained, i.e. no gradient is required by the
+        backbone and batch normalization is in eval mode. It is rebuilt whenever the backbone weights are modified.
+
+        :param images: :math:`(b\times 3\times h\times w)` input images
+        :param keys: :math:`(b)` int64 keys of images (-1 if the image is not cacheable, e.g. randomly augmented).
+                     ``None`` for no caching
+        :return: node features (output of ``node_layers``), edge features (output of ``edge_layers``), and global
+                 features (output of ``final_layers``, ``None`` if there are no final layers)
+        """
+        if keys is None or not self._feature_cache_usable():
+            return self._extract_features(images)
+
+        cache = self._get_feature_cache(images.device)
+        keys = keys.tolist()
+        cached = [cache.get(k) if k >= 0 else None for k in keys]
+        miss = [i for i, c in enumerate(cached) if c is None]
+        if len(miss) > 0:
+            feats = self._extract_features(images[miss] if len(miss) < len(keys) else images)
+            feats = [f for f in feats if f is not None]
+            for j, i in enumerate(miss):
+                cached[i] = tuple(f[j] for f in feats)
+                if keys[i] >= 0:
+                    cache.put(keys[i], cached[i])
+
+        ret = [torch.stack([c[n] for c in cached]).to(device=images.device, dtype=images.dtype)
+               for n in range(len(cached[0]))]
+        if self.final_layers is None:
+            ret.append(None)
+        return tuple(ret)
+
+    def extract_features_list(self, images, keys=None):
+        r"""
+        Extract the CNN features of the images of multiple graphs. The images of all graphs are concatenated and
+        go through the backbone in a single pass, unless the batch normalization is in training mode (whose statistics
+        would be shared among graphs).
+
+        :param images: list of :math:`(b\times 3\times h\times w)` input images
+        :param keys: list of the keys of images of every graph (see :meth:`extract_features`). ``None`` for no caching
+        :return: list of the features of every graph (see :meth:`extract_features`)
+        """
+        if keys is None:
+            keys = [None] * len(images)
+        if len(images) == 1 or self._batch_norm_training():
+            return [self.extract_features(img, k) for img, k in zip(images, keys)]
+
+        sizes = [img.shape[0] for img in images]
+        keys_cat = None if any(k is None for k in keys) else torch.cat(keys)
+        feats = self.extract_features(torch.cat(images, dim=0), keys_cat)
+        feats = [f.split(sizes) if f is not None else [None] * len(images) for f in feats]
+        return list(zip(*feats))
+
+    def _extract_features(self, images):
+        if cfg.BACKBONE_FUSION.CHANNELS_LAST or cfg.BACKBONE_FUSION.FOLD_BN or len(cfg.BACKBONE_FUSION.COMPILE) > 0:
+            return self._get_fused_backbone()(images)
+        nodes = self.node_layers(images)
+        edges = self.edge_layers(nodes)
+        if self.final_layers is None:
+            return nodes, edges, None
+        return nodes, edges, self.final_layers(edges).reshape((nodes.shape[0], -1))
+
+    def _get_fused_backbone(self):
+        state = self._backbone_state
+        if cfg.BACKBONE_FUSION.FOLD_BN and self._backbone_frozen():
+            # batch normalization can only be folded if the backbone is not trained. The folded copy does not share the
+            # weights with the module, therefore it is shared by the DataParallel replicas on the same device, and is
+            # rebuilt upon the modification of the master weights
+            device = next(self.node_layers.parameters()).device
+            signature = tuple((t._version, t.dtype) for t in state['module']._backbone_tensors())
+            entry = state['folded'].get(device)
+            if entry is not None and entry[0] == signature:
+                return entry[1]
+            fused = FusedBackbone(self.node_layers, self.edge_layers, self.final_layers,
+                                  channels_last=cfg.BACKBONE_FUSION.CHANNELS_LAST, fold_bn=True)
+            fused = compile_module(fused, cfg.BACKBONE_FUSION.COMPILE)
+            state['folded'][device] = signature, fused
+            return fused
+
+        # the unfolded fused backbone shares the weights with the module. The weights of DataParallel replicas are new
+        # copies at every forward pass, therefore a replica builds its own one on the fly, without compilation
+        if getattr(self, '_is_replica', False):
+            return FusedBackbone(self.node_layers, self.edge_layers, self.final_layers,
+                                 channels_last=cfg.BACKBONE_FUSION.CHANNELS_LAST, convert_weights=False)
+        if state['unfolded'] is None:
+            fused = FusedBackbone(self.node_layers, self.edge_layers, self.final_layers,
+                                  channels_last=cfg.BACKBONE_FUSION.CHANNELS_LAST)
+            state['unfolded'] = compile_module(fused, cfg.BACKBONE_FUSION.COMPILE)
+        return state['unfolded']
+
+    def _backbone_tensors(self):
+        for layers in (self.node_layers, self.edge_layers, self.final_layers):
+            if layers is not None:
+                yield from layers.parameters()
+                yield from layers.buffers()
+
+    def _batch_norm_training(self):
+        for layers in (self.node_layers, self.edge_layers, self.final_layers):
+            if layers is not None and any(isinstance(m, nn.modules.batchnorm._BatchNorm) and m.training
+                                          for m in layers.modules()):
+                return True
+        return False
+
+    def _backbone_frozen(self):
+        if torch.is_grad_enabled() and any(t.requires_grad for t in self._backbone_tensors()):
+            return False
+        return not self._batch_norm_training()
+
+    def _feature_cache_usable(self):
+        return cfg.FEATURE_CACHE.ENABLED and self._backbone_frozen()
+
+    def _master_version(self):
+        # the in-place modifications of the master weights (by optimizer, load_state_dict, etc.) are tracked by the
+        # version counters of tensors, which costs no device synchronization. The weights of DataParallel replicas are
+        # new copies at every forward pass, therefore they are not tracked
+        return tuple((id(t), t._version) for t in self._backbone_state['module']._backbone_tensors())
+
+    def _get_feature_cache(self, device):
+        # one cache for every device, which is shared by the DataParallel replicas on that device
+        version = self._master_version()
+        caches = self._backbone_state['caches']
+        if device in caches and caches[device][0] == version:
+            return caches[device][1]
+
+        disk_path = None
+        if cfg.FEATURE_CACHE.DISK:
+            digest = hashlib.md5()
+            for t in self._backbone_state['module']._backbone_tensors():
+                digest.update(t.detach().cpu().numpy().tobytes())
+            disk_path = FeatureCache.default_disk_path(cfg.CACHE_PATH, cfg.BACKBONE, cfg.PROBLEM.RESCALE,
+                                                       digest.hexdigest())
+        cache = FeatureCache(cfg.FEATURE_CACHE.MEMORY_MB, disk_path)
+        caches[device] = version, cache
+        return cache
+
     @staticmethod
     def get_backbone(batch_norm):
         """
@@ -66,6 +215,94 @@ class VGG16_base(nn.Module):
         return node_layers, edge_layers, final_layers
     
 
+class FusedBackbone(nn.Module):
+    r"""
+    The fused forward pass of ``node_layers``, ``edge_layers`` and ``final_layers``, which returns the three outputs at
+    once. It shares the weights with the given layers, unless batch normalization is folded.
+
+    :param node_layers: layers of node features
+    :param edge_layers: layers of edge features
+    :param final_layers: layers of global features (or ``None``)
+    :param channels_last: compute in channels-last memory format, which is preferred by cuDNN (with tensor cores) and
+                          oneDNN on CPU
+    :param fold_bn: fold batch normalization into the preceding convolution. Only valid for inference, because the
+                    folded copy of weights does not receive gradients
+    :param convert_weights: convert the weights of the given layers to channels-last in-place (if ``channels_last``).
+                            Should be disabled if the weights are temporary, e.g. of DataParallel replicas
+    """
+    def __init__(self, node_layers, edge_layers, final_layers=None, channels_last=False, fold_bn=False,
+                 convert_weights=True):
+        super(FusedBackbone, self).__init__()
+        if fold_bn:
+            node_layers, edge_layers = fold_batch_norm(node_layers), fold_batch_norm(edge_layers)
+            final_layers = fold_batch_norm(final_layers) if final_layers is not None else None
+        self.has_final = final_layers is not None
+        self.node_layers = node_layers
+        self.edge_layers = edge_layers
+        self.final_layers = final_layers if final_layers is not None else nn.Identity()
+        self.channels_last = channels_last
+        if channels_last and (convert_weights or fold_bn):
+            for layers in (self.node_layers, self.edge_layers, self.final_layers):
+                layers.to(memory_format=torch.channels_last)
+
+    def forward(self, x: Tensor) -> Tuple[Tensor, Tensor, Optional[Tensor]]:
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        nodes = self.node_layers(x)
+        edges = self.edge_layers(nodes)
+        glob: Optional[Tensor] = None
+        if self.has_final:
+            glob = self.final_layers(edges).reshape(nodes.shape[0], -1)
+        return nodes.contiguous(), edges.contiguous(), glob
+
+
+def fold_batch_norm(layers: nn.Sequential) -> nn.Sequential:
+    r"""
+    Fold every batch normalization into its preceding convolution, by the running statistics.
+
+    :param layers: the layers, which are not modified
+    :return: a copy of layers, where the folded batch normalization layers are replaced by ``nn.Identity``
+    """
+    layers = copy.deepcopy(layers)
+    modules = list(layers.children())
+    for i in range(1, len(modules)):
+        conv, bn = modules[i - 1], modules[i]
+        if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d) and bn.track_running_stats:
+            with torch.no_grad():
+                scale = bn.running_var.add(bn.eps).rsqrt()
+                if bn.affine:
+                    scale = scale * bn.weight
+                bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+                bias = (bias - bn.running_mean) * scale
+                if bn.affine:
+                    bias = bias + bn.bias
+                conv.weight.mul_(scale.view(-1, 1, 1, 1))
+                conv.bias = nn.Parameter(bias)
+            modules[i] = nn.Identity()
+    return nn.Sequential(*modules).requires_grad_(False)
+
+
+def compile_module(module: nn.Module, method: str='') -> nn.Module:
+    r"""
+    Compile a module for faster inference.
+
+    :param module: the module
+    :param method: ``''`` (no compilation), ``'script'`` (TorchScript) or ``'compile'`` (``torch.compile``, which
+                   requires PyTorch>=2.0)
+    :return: the compiled module
+    """
+    if method == '':
+        return module
+    elif method == 'script':
+        return torch.jit.script(module)
+    elif method == 'compile':
+        if not hasattr(torch, 'compile'):
+            raise RuntimeError('torch.compile requires PyTorch>=2.0.')
+        return torch.compile(module)
+    else:
+        raise ValueError('Unknown compile method: {}'.format(method))
+
+
 class VGG16_bn_final(VGG16_base):
     r"""
     VGG16 with batch normalization and final layers.
@@ -2,15 +2,18 @@ import torch
 from torch import Tensor
 from scipy.spatial import Delaunay
 from scipy.spatial.qhull import QhullError
+from scipy.spatial.distance import cdist
 
+import hashlib
 import itertools
 import numpy as np
+from collections import OrderedDict
 
 from typing import Tuple
 
 
 def build_graphs(P_np: np.ndarray, n: int, n_pad: int=None, edge_pad: int=None, stg: str='fc', sym: bool=True,
-                 thre: int=0) -> Tuple[np.ndarray, np.ndarray, np.ndarray, int]:
+                 thre: int=0, k: int=4, cache: bool=False) -> Tuple[np.ndarray, np.ndarray, np.ndarray, int]:
     r"""
     Build graph matrix :math:`\mathbf G, \mathbf H` from point set :math:`\mathbf P`.
     This function supports only cpu operations in numpy.
@@ -21,9 +24,11 @@ def build_graphs(P_np: np.ndarray, n: int, n_pad: int=None, edge_pad: int=None,
     :param n: number of exact points in the point set
     :param n_pad: padded node length
     :param edge_pad: padded edge length
-    :param stg: strategy to build graphs. Options: ``fc``, ``near``, ``tri``
+    :param stg: strategy to build graphs. Options: ``fc``, ``near``, ``tri``, ``knn``
     :param sym: True for a symmetric adjacency, False for half adjacency (A contains only the upper half)
     :param thre: The threshold value of 'near' strategy
+    :param k: The number of neighbors of 'knn' strategy
+    :param cache: look up (and store) the result in an LRU cache keyed by the hash of the point coordinates
     :return: :math:`A`, :math:`G`, :math:`H`, edge_num
 
     The possible options for ``stg``:
@@ -32,6 +37,7 @@ def build_graphs(P_np: np.ndarray, n: int, n_pad: int=None, edge_pad: int=None,
         'fc'(default): construct a fully-connected graph
         'near': construct a fully-connected graph, but edges longer than ``thre`` are removed
         'tri': apply Delaunay triangulation
+        'knn': connect every node with its ``k`` nearest neighbors (the adjacency is symmetrized)
 
     An illustration of :math:`\mathbf G, \mathbf H` with their connections to the graph, the adjacency matrix,
     the incident matrix is
@@ -39,12 +45,26 @@ def build_graphs(P_np: np.ndarray, n: int, n_pad: int=None, edge_pad: int=None,
     .. image:: ../../images/build_graphs_GH.png
     """
 
-    assert stg in ('fc', 'tri', 'near'), 'No strategy named {} found.'.format(stg)
+    assert stg in ('fc', 'tri', 'near', 'knn'), 'No strategy named {} found.'.format(stg)
+
+    if cache:
+        P = np.ascontiguousarray(P_np[0:n, :])
+        key = (hashlib.sha1(P.tobytes()).hexdigest(), P.shape, P.dtype.str, n, n_pad, edge_pad, stg, sym, thre, k)
+        if key in _GRAPH_CACHE:
+            _GRAPH_CACHE.move_to_end(key)
+        else:
+            _GRAPH_CACHE[key] = build_graphs(P_np, n, n_pad, edge_pad, stg, sym, thre, k, cache=False)
+            if len(_GRAPH_CACHE) > _GRAPH_CACHE_SIZE:
+                _GRAPH_CACHE.popitem(last=False)
+        A, G, H, edge_num = _GRAPH_CACHE[key]
+        return A.copy(), G.copy(), H.copy(), edge_num
 
     if stg == 'tri':
         A = delaunay_triangulate(P_np[0:n, :])
     elif stg == 'near':
         A = fully_connect(P_np[0:n, :], thre=thre)
+    elif stg == 'knn':
+        A = knn_connect(P_np[0:n, :], k=k)
     else:
         A = fully_connect(P_np[0:n, :])
     edge_num = int(np.sum(A, axis=(0, 1)))
@@ -57,19 +77,13 @@ def build_graphs(P_np: np.ndarray, n: int, n_pad: int=None, edge_pad: int=None,
     assert n_pad >= n
     assert edge_pad >= edge_num
 
+    # np.nonzero returns the edges in row-major order, i.e. the same order as iterating i then j
+    row, col = np.nonzero(A if sym else np.triu(A))
+    edge_idx = np.arange(row.shape[0])
     G = np.zeros((n_pad, edge_pad), dtype=np.float32)
     H = np.zeros((n_pad, edge_pad), dtype=np.float32)
-    edge_idx = 0
-    for i in range(n):
-        if sym:
-            range_j = range(n)
-        else:
-            range_j = range(i, n)
-        for j in range_j:
-            if A[i, j] == 1:
-                G[i, edge_idx] = 1
-                H[j, edge_idx] = 1
-                edge_idx += 1
+    G[row, edge_idx] = 1
+    H[col, edge_idx] = 1
 
     return A, G, H, edge_num
 
@@ -89,9 +103,9 @@ def delaunay_triangulate(P: np.ndarray) -> np.ndarray:
             d = Delaunay(P)
             #assert d.coplanar.size == 0, 'Delaunay triangulation omits points.'
             A = np.zeros((n, n))
-            for simplex in d.simplices:
-                for pair in itertools.permutations(simplex, 2):
-                    A[pair] = 1
+            simplices = d.simplices
+            for i, j in itertools.permutations(range(simplices.shape[1]), 2):
+                A[simplices[:, i], simplices[:, j]] = 1
         except QhullError as err:
             print('Delaunay triangulation error detected. Return fully-connected graph.')
             print('Traceback:')
@@ -111,14 +125,35 @@ def fully_connect(P: np.ndarray, thre=None) -> np.ndarray:
     n = P.shape[0]
     A = np.ones((n, n)) - np.eye(n)
     if thre is not None:
-        for i in range(n):
-            for j in range(i):
-                if np.linalg.norm(P[i] - P[j]) > thre:
-                    A[i, j] = 0
-                    A[j, i] = 0
+        A[cdist(P, P) > thre] = 0
+    return A
+
+
+def knn_connect(P: np.ndarray, k: int) -> np.ndarray:
+    r"""
+    Return the adjacency matrix of the (symmetrized) k-nearest-neighbor graph.
+
+    :param P: :math:`(n\times 2)` point set
+    :param k: number of nearest neighbors of each node
+    :return: adjacency matrix :math:`A`
+    """
+    n = P.shape[0]
+    k = min(k, n - 1)
+    A = np.zeros((n, n))
+    if k <= 0:
+        return A
+    dist = cdist(P, P)
+    np.fill_diagonal(dist, np.inf)
+    nn = np.argpartition(dist, k - 1, axis=1)[:, :k]
+    A[np.repeat(np.arange(n), k), nn.reshape(-1)] = 1
+    A = np.maximum(A, A.T)
     return A
 
 
+_GRAPH_CACHE = OrderedDict()
+_GRAPH_CACHE_SIZE = 256
+
+
 def make_grids(start, stop, num) -> np.ndarray:
     r"""
     Make grids.
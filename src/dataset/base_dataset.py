@@ -1,6 +1,53 @@
+import numpy as np
+
+
 class BaseDataset:
     def __init__(self):
         pass
 
     def get_pair(self, cls, shuffle):
         raise NotImplementedError
+
+
+def keypoint_ids(keypoints, name_to_id=None) -> np.ndarray:
+    """
+    Intern the keypoint names to integer ids. Outliers are assigned with -1.
+    :param keypoints: list of keypoint dicts
+    :param name_to_id: dict mapping names to ids. If not specified, the names are assumed to be integers already and
+                       the outliers are named 'outlier'
+    :return: (n) integer ids
+    """
+    if name_to_id is None:
+        return np.array([-1 if kp['name'] == 'outlier' else kp['name'] for kp in keypoints], dtype=np.int64)
+    return np.array([name_to_id.get(kp['name'], -1) for kp in keypoints], dtype=np.int64)
+
+
+def match_keypoints(ids1: np.ndarray, ids2: np.ndarray):
+    """
+    Build the groundtruth permutation matrix between two sets of keypoint ids (from keypoint_ids). The keypoint names
+    are assumed to be unique in each set, and outliers (negative ids) are never matched.
+    :param ids1: (n1) keypoint ids of the first set
+    :param ids2: (n2) keypoint ids of the second set
+    :return: (n1 x n2) permutation matrix, (n1) mask of matched rows, (n2) mask of matched columns
+    """
+    match = (ids1[:, None] == ids2[None, :]) & (ids1[:, None] >= 0)
+    return match.astype(np.float32), match.any(axis=1), match.any(axis=0)
+
+
+def universe_perm_mat(ids: np.ndarray, univ_size: int) -> np.ndarray:
+    """
+    Build the permutation matrix from a set of keypoint ids to the universe of keypoints.
+    :param ids: (n) keypoint ids, which are the indices in the universe
+    :param univ_size: size of the universe
+    :return: (n x univ_size) permutation matrix
+    """
+    perm_mat = np.zeros((ids.shape[0], univ_size), dtype=np.float32)
+    perm_mat[np.arange(ids.shape[0]), ids] = 1
+    return perm_mat
+
+
+def filter_keypoints(keypoints, mask: np.ndarray):
+    """
+    Keep the keypoints where mask is True.
+    """
+    return [kp for kp, m in zip(keypoints, mask) if m]
@@ -3,7 +3,7 @@ from PIL import Image
 import numpy as np
 import random
 
-from src.dataset.base_dataset import BaseDataset
+from src.dataset.base_dataset import BaseDataset, keypoint_ids, match_keypoints, universe_perm_mat, filter_keypoints
 from src.utils.config import cfg
 
 
@@ -128,24 +128,13 @@ class CUB2011(BaseDataset):
                 random.shuffle(anno_dict['keypoints'])
             anno_pair.append(anno_dict)
 
-        perm_mat = np.zeros([len(_['keypoints']) for _ in anno_pair], dtype=np.float32)
-        row_list = []
-        col_list = []
-        for i, keypoint in enumerate(anno_pair[0]['keypoints']):
-            for j, _keypoint in enumerate(anno_pair[1]['keypoints']):
-                if keypoint['name'] == _keypoint['name']:
-                    perm_mat[i, j] = 1
-                    row_list.append(i)
-                    col_list.append(j)
-                    break
-        row_list.sort()
-        col_list.sort()
+        perm_mat, row_mask, col_mask = match_keypoints(*[keypoint_ids(_['keypoints']) for _ in anno_pair])
         if not src_outlier:
-            perm_mat = perm_mat[row_list, :]
-            anno_pair[0]['keypoints'] = [anno_pair[0]['keypoints'][i] for i in row_list]
+            perm_mat = perm_mat[row_mask, :]
+            anno_pair[0]['keypoints'] = filter_keypoints(anno_pair[0]['keypoints'], row_mask)
         if not tgt_outlier:
-            perm_mat = perm_mat[:, col_list]
-            anno_pair[1]['keypoints'] = [anno_pair[1]['keypoints'][j] for j in col_list]
+            perm_mat = perm_mat[:, col_mask]
+            anno_pair[1]['keypoints'] = filter_keypoints(anno_pair[1]['keypoints'], col_mask)
 
         if perm_mat.shape[0] > perm_mat.shape[1]:
             anno_pair = anno_pair[::-1]
@@ -177,16 +166,9 @@ class CUB2011(BaseDataset):
                 random.shuffle(anno_dict['keypoints'])
             anno_list.append(anno_dict)
 
-        max_kpt_idx = max([max([x['name'] for x in anno_dict['keypoints']]) for anno_dict in anno_list]) + 1
-        perm_mat = [np.zeros([max_kpt_idx, len(x['keypoints'])], dtype=np.float32) for x in anno_list]
-
-        for k, anno_dict in enumerate(anno_list):
-            kpt_name_list = [x['name'] for x in anno_dict['keypoints']]
-            for j, name in enumerate(kpt_name_list):
-                perm_mat[k][name, j] = 1
-
-        for k in range(num):
-            perm_mat[k] = perm_mat[k].transpose()
+        ids = [keypoint_ids(anno_dict['keypoints']) for anno_dict in anno_list]
+        max_kpt_idx = max([x.max() for x in ids]) + 1
+        perm_mat = [universe_perm_mat(x, max_kpt_idx) for x in ids]
 
         return anno_list, perm_mat
 
@@ -225,6 +207,7 @@ class CUB2011(BaseDataset):
         anno_dict['ori_sizes'] = ori_sizes
         anno_dict['cls'] = self.classes[cls]
         anno_dict['univ_size'] = 15
+        anno_dict['id'] = str(img_name)
 
         return anno_dict
 
@@ -5,12 +5,15 @@ from torchvision import transforms
 import torch_geometric as pyg
 import numpy as np
 import random
+import os
+import functools
 from src.build_graphs import build_graphs
-from src.factorize_graph_matching import kronecker_sparse, kronecker_torch
-from src.sparse_torch import CSRMatrix3d
+from src.factorize_graph_matching import KroneckerIncidence, KroneckerAffinity, kronecker_torch
 from src.dataset import *
+from src.parallel.distributed import is_distributed, get_rank
 
 from src.utils.config import cfg
+from src.utils.feature_cache import FeatureCache
 
 from itertools import combinations, product
 
@@ -33,6 +36,7 @@ class GMDataset(Dataset):
             self.classes = [self.cls]
 
         self.problem_type = problem
+        self.cache_graphs = cfg.GRAPH.CACHE and getattr(self.ds, 'sets', None) == 'test'
 
     def __len__(self):
         return self.length
@@ -48,27 +52,37 @@ class GMDataset(Dataset):
             raise NameError("Unknown problem type: {}".format(self.problem_type))
 
     @staticmethod
-    def to_pyg_graph(A, P):
+    def to_pyg_graph(A, P, hyperedge=False):
         rescale = max(cfg.PROBLEM.RESCALE)
 
-        edge_feat = 0.5 * (np.expand_dims(P, axis=1) - np.expand_dims(P, axis=0)) / rescale + 0.5  # from Rolink's paper
+        A = A != 0
         edge_index = np.nonzero(A)
-        edge_attr = edge_feat[edge_index]
+        edge_attr = 0.5 * (P[edge_index[0]] - P[edge_index[1]]) / rescale + 0.5  # from Rolink's paper
 
         edge_attr = np.clip(edge_attr, 0, 1)
         assert (edge_attr > -1e-5).all(), P
 
-        o3_A = np.expand_dims(A, axis=0) * np.expand_dims(A, axis=1) * np.expand_dims(A, axis=2)
-        hyperedge_index = np.nonzero(o3_A)
-
         pyg_graph = pyg.data.Data(
             x=torch.tensor(P / rescale).to(torch.float32),
             edge_index=torch.tensor(np.array(edge_index), dtype=torch.long),
             edge_attr=torch.tensor(edge_attr).to(torch.float32),
-            hyperedge_index=torch.tensor(np.array(hyperedge_index), dtype=torch.long),
         )
+        if hyperedge:
+            # hyperedges (i, j, k) are the triangles in A, i.e. the common neighbors k of every edge (i, j)
+            edge_id, k = np.nonzero(A[edge_index[0]] & A[edge_index[1]])
+            hyperedge_index = (edge_index[0][edge_id], edge_index[1][edge_id], k)
+            pyg_graph.hyperedge_index = torch.tensor(np.array(hyperedge_index), dtype=torch.long)
         return pyg_graph
 
+    def image_keys(self, anno_list):
+        """
+        Keys of the images for the CNN feature cache (see :class:`~src.utils.feature_cache.FeatureCache`), which are
+        -1 for the images without an object id (e.g. randomly augmented). The keys are int64 tensors, so that they are
+        split with the batch among devices.
+        """
+        return [torch.tensor(FeatureCache.hash_key(self.name, anno['cls'], anno['id']) if anno.get('id') is not None
+                             else -1) for anno in anno_list]
+
     def get_pair(self, idx, cls):
         #anno_pair, perm_mat = self.ds.get_pair(self.cls if self.cls is not None else
         #                                       (idx % (cfg.BATCH_SIZE * len(self.classes))) // cfg.BATCH_SIZE)
@@ -89,17 +103,19 @@ class GMDataset(Dataset):
         P1 = np.array(P1)
         P2 = np.array(P2)
 
-        A1, G1, H1, e1 = build_graphs(P1, n1, stg=cfg.GRAPH.SRC_GRAPH_CONSTRUCT, sym=cfg.GRAPH.SYM_ADJACENCY)
+        A1, G1, H1, e1 = build_graphs(P1, n1, stg=cfg.GRAPH.SRC_GRAPH_CONSTRUCT, sym=cfg.GRAPH.SYM_ADJACENCY,
+                                      k=cfg.GRAPH.KNN_K, cache=self.cache_graphs)
         if cfg.GRAPH.TGT_GRAPH_CONSTRUCT == 'same':
             G2 = perm_mat.transpose().dot(G1)
             H2 = perm_mat.transpose().dot(H1)
             A2 = G2.dot(H2.transpose())
             e2 = e1
         else:
-            A2, G2, H2, e2 = build_graphs(P2, n2, stg=cfg.GRAPH.TGT_GRAPH_CONSTRUCT, sym=cfg.GRAPH.SYM_ADJACENCY)
+            A2, G2, H2, e2 = build_graphs(P2, n2, stg=cfg.GRAPH.TGT_GRAPH_CONSTRUCT, sym=cfg.GRAPH.SYM_ADJACENCY,
+                                          k=cfg.GRAPH.KNN_K, cache=self.cache_graphs)
 
-        pyg_graph1 = self.to_pyg_graph(A1, P1)
-        pyg_graph2 = self.to_pyg_graph(A2, P2)
+        pyg_graph1 = self.to_pyg_graph(A1, P1, cfg.GRAPH.HYPEREDGE)
+        pyg_graph2 = self.to_pyg_graph(A2, P2, cfg.GRAPH.HYPEREDGE)
 
         ret_dict = {'Ps': [torch.Tensor(x) for x in [P1, P2]],
                     'ns': [torch.tensor(x) for x in [n1, n2]],
@@ -119,8 +135,10 @@ class GMDataset(Dataset):
                     transforms.ToTensor(),
                     transforms.Normalize(cfg.NORM_MEANS, cfg.NORM_STD)
                     ])
-            imgs = [trans(img) for img in imgs]
+            # images augmented by src.ssl.augmentation are already tensors
+            imgs = [trans.transforms[1](img) if isinstance(img, torch.Tensor) else trans(img) for img in imgs]
             ret_dict['images'] = imgs
+            ret_dict['img_keys'] = self.image_keys(anno_pair)
         elif 'feat' in anno_pair[0]['keypoints'][0]:
             feat1 = np.stack([kp['feat'] for kp in anno_pair[0]['keypoints']], axis=-1)
             feat2 = np.stack([kp['feat'] for kp in anno_pair[1]['keypoints']], axis=-1)
@@ -169,8 +187,10 @@ class GMDataset(Dataset):
                 H_tgt = H
                 A_tgt = G_tgt.dot(H_tgt.transpose())
             else:
-                A, G, H, _ = build_graphs(P, n, stg=cfg.GRAPH.SRC_GRAPH_CONSTRUCT)
-                A_tgt, G_tgt, H_tgt, _ = build_graphs(P, n, stg=cfg.GRAPH.TGT_GRAPH_CONSTRUCT)
+                A, G, H, _ = build_graphs(P, n, stg=cfg.GRAPH.SRC_GRAPH_CONSTRUCT, k=cfg.GRAPH.KNN_K,
+                                          cache=self.cache_graphs)
+                A_tgt, G_tgt, H_tgt, _ = build_graphs(P, n, stg=cfg.GRAPH.TGT_GRAPH_CONSTRUCT, k=cfg.GRAPH.KNN_K,
+                                                      cache=self.cache_graphs)
             As.append(A)
             Gs.append(G)
             Hs.append(H)
@@ -178,8 +198,8 @@ class GMDataset(Dataset):
             Gs_tgt.append(G_tgt)
             Hs_tgt.append(H_tgt)
 
-        pyg_graphs = [self.to_pyg_graph(A, P) for A, P in zip(As, Ps)]
-        pyg_graphs_tgt = [self.to_pyg_graph(A, P) for A, P in zip(As_tgt, Ps)]
+        pyg_graphs = [self.to_pyg_graph(A, P, cfg.GRAPH.HYPEREDGE) for A, P in zip(As, Ps)]
+        pyg_graphs_tgt = [self.to_pyg_graph(A, P, cfg.GRAPH.HYPEREDGE) for A, P in zip(As_tgt, Ps)]
 
         ret_dict = {
             'Ps': [torch.Tensor(x) for x in Ps],
@@ -205,6 +225,7 @@ class GMDataset(Dataset):
             ])
             imgs = [trans(img) for img in imgs]
             ret_dict['images'] = imgs
+            ret_dict['img_keys'] = self.image_keys(anno_list)
         elif 'feat' in anno_list[0]['keypoints'][0]:
             feats = [np.stack([kp['feat'] for kp in anno_dict['keypoints']], axis=-1) for anno_dict in anno_list]
             ret_dict['features'] = [torch.Tensor(x) for x in feats]
@@ -320,35 +341,24 @@ def collate_fn(data: list):
 
     # compute CPU-intensive Kronecker product here to leverage multi-processing nature of dataloader
     if 'Gs' in ret and 'Hs' in ret:
+        kron = KroneckerIncidence(dtype=np.float32,
+                                  cache_dir=os.path.join(cfg.CACHE_PATH, 'kron') if cfg.GRAPH.KRON_CACHE else None)
         if cfg.PROBLEM.TYPE == '2GM' and len(ret['Gs']) == 2 and len(ret['Hs']) == 2:
             G1, G2 = ret['Gs']
             H1, H2 = ret['Hs']
-            if cfg.FP16:
-                sparse_dtype = np.float16
-            else:
-                sparse_dtype = np.float32
-            K1G = [kronecker_sparse(x, y).astype(sparse_dtype) for x, y in zip(G2, G1)]  # 1 as source graph, 2 as target graph
-            K1H = [kronecker_sparse(x, y).astype(sparse_dtype) for x, y in zip(H2, H1)]
-            K1G = CSRMatrix3d(K1G)
-            K1H = CSRMatrix3d(K1H).transpose()
+            K1G = kron(G2, G1)  # 1 as source graph, 2 as target graph
+            K1H = kron(H2, H1).transpose()
 
             ret['KGHs'] = K1G, K1H
         elif cfg.PROBLEM.TYPE in ['MGM', 'MGMC'] and 'Gs_tgt' in ret and 'Hs_tgt' in ret:
             ret['KGHs'] = dict()
+            # the non-zero elements of every graph are extracted once and shared by all pairs
+            Gs, Hs = [kron.to_coo(x) for x in ret['Gs']], [kron.to_coo(x) for x in ret['Hs']]
+            Gs_tgt, Hs_tgt = [kron.to_coo(x) for x in ret['Gs_tgt']], [kron.to_coo(x) for x in ret['Hs_tgt']]
             for idx_1, idx_2 in product(range(len(ret['Gs'])), repeat=2):
                 # 1 as source graph, 2 as target graph
-                G1 = ret['Gs'][idx_1]
-                H1 = ret['Hs'][idx_1]
-                G2 = ret['Gs_tgt'][idx_2]
-                H2 = ret['Hs_tgt'][idx_2]
-                if cfg.FP16:
-                    sparse_dtype = np.float16
-                else:
-                    sparse_dtype = np.float32
-                KG = [kronecker_sparse(x, y).astype(sparse_dtype) for x, y in zip(G2, G1)]
-                KH = [kronecker_sparse(x, y).astype(sparse_dtype) for x, y in zip(H2, H1)]
-                KG = CSRMatrix3d(KG)
-                KH = CSRMatrix3d(KH).transpose()
+                KG = kron(Gs_tgt[idx_2], Gs[idx_1])
+                KH = kron(Hs_tgt[idx_2], Hs[idx_1]).transpose()
                 ret['KGHs']['{},{}'.format(idx_1, idx_2)] = KG, KH
         else:
             raise ValueError('Data type not understood.')
@@ -356,7 +366,11 @@ def collate_fn(data: list):
     if 'Fi' in ret and 'Fj' in ret:
         Fi = ret['Fi']
         Fj = ret['Fj']
-        aff_mat = kronecker_torch(Fj, Fi)
+        if cfg.QAPLIB.LAZY_AFF:
+            # the n^2 x n^2 affinity matrix is never materialized, and is accessed by matrix-vector products
+            aff_mat = KroneckerAffinity(Fi, Fj)
+        else:
+            aff_mat = kronecker_torch(Fj, Fi)
         ret['aff_mat'] = aff_mat
 
     ret['batch_size'] = len(data)
@@ -370,25 +384,39 @@ def collate_fn(data: list):
     return ret
 
 
-def worker_init_fix(worker_id):
+def worker_init_fix(worker_id, rank=0):
     """
     Init dataloader workers with fixed seed.
+    In distributed mode, the seeds are offset by rank, so that different processes sample different pairs.
     """
-    random.seed(cfg.RANDOM_SEED + worker_id)
-    np.random.seed(cfg.RANDOM_SEED + worker_id)
+    seed = cfg.RANDOM_SEED + rank * max(cfg.DATALOADER_NUM, 1) + worker_id
+    random.seed(seed)
+    np.random.seed(seed)
 
 
-def worker_init_rand(worker_id):
+def worker_init_rand(worker_id, rank=0):
     """
     Init dataloader workers with torch.initial_seed().
     torch.initial_seed() returns different seeds when called from different dataloader threads.
+    In distributed mode, the seeds are offset by rank, so that different processes sample different pairs.
     """
-    random.seed(torch.initial_seed())
-    np.random.seed(torch.initial_seed() % 2 ** 32)
+    seed = torch.initial_seed() + rank * max(cfg.DATALOADER_NUM, 1)
+    random.seed(seed)
+    np.random.seed(seed % 2 ** 32)
 
 
 def get_dataloader(dataset, fix_seed=True, shuffle=False):
+    """
+    In distributed mode, the samples (and the length of the dataset) are split among the processes by
+    ``DistributedSampler``, and every process draws its random pairs with its own seeds.
+    """
+    worker_init_fn = worker_init_fix if fix_seed else worker_init_rand
+    sampler = None
+    if is_distributed():
+        sampler = torch.utils.data.distributed.DistributedSampler(dataset, shuffle=shuffle)
+        worker_init_fn = functools.partial(worker_init_fn, rank=get_rank())
+        shuffle = False
     return torch.utils.data.DataLoader(
-        dataset, batch_size=cfg.BATCH_SIZE, shuffle=shuffle, num_workers=cfg.DATALOADER_NUM, collate_fn=collate_fn,
-        pin_memory=False, worker_init_fn=worker_init_fix if fix_seed else worker_init_rand
+        dataset, batch_size=cfg.BATCH_SIZE, shuffle=shuffle, sampler=sampler, num_workers=cfg.DATALOADER_NUM,
+        collate_fn=collate_fn, pin_memory=False, worker_init_fn=worker_init_fn
     )
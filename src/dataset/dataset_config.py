@@ -11,6 +11,7 @@ __C.PascalVOC.SET_SPLIT = 'data/PascalVOC/voc2011_pairs.npz'  # set split path
 __C.PascalVOC.CLASSES = ['aeroplane', 'bicycle', 'bird', 'boat', 'bottle', 'bus', 'car', 'cat', 'chair', 'cow',
                          'diningtable', 'dog', 'horse', 'motorbike', 'person', 'pottedplant', 'sheep', 'sofa', 'train',
                          'tvmonitor']
+__C.PascalVOC.OBJ_CACHE = False  # preprocess all objects into a memory-mapped cache (in CACHE_PATH) upon first usage
 
 # Willow-Object Class dataset
 __C.WillowObject = edict()
@@ -48,6 +49,8 @@ __C.QAPLIB.FEED_TYPE = 'affmat' # 'affmat' (affinity matrix) or 'adj' (adjacency
 __C.QAPLIB.ONLINE_REPO = 'http://anjos.mgi.polymtl.ca/qaplib/'
 __C.QAPLIB.MAX_TRAIN_SIZE = 200
 __C.QAPLIB.MAX_TEST_SIZE = 100
+__C.QAPLIB.CACHE = True  # cache the parsed instances as .npz files (in CACHE_PATH)
+__C.QAPLIB.LAZY_AFF = False  # feed kron(Fj, Fi) as a lazy KroneckerAffinity operator instead of the dense matrix
 
 # CUB2011 dataset
 __C.CUB2011 = edict()
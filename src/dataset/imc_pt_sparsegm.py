@@ -2,7 +2,7 @@ from pathlib import Path
 from PIL import Image
 import numpy as np
 from src.utils.config import cfg
-from src.dataset.base_dataset import BaseDataset
+from src.dataset.base_dataset import BaseDataset, keypoint_ids, match_keypoints, universe_perm_mat, filter_keypoints
 import random
 
 
@@ -47,25 +47,13 @@ class IMC_PT_SparseGM(BaseDataset):
                 random.shuffle(anno_dict['keypoints'])
             anno_pair.append(anno_dict)
 
-        perm_mat = np.zeros([len(_['keypoints']) for _ in anno_pair], dtype=np.float32)
-        row_list = []
-        col_list = []
-        for i, keypoint in enumerate(anno_pair[0]['keypoints']):
-            for j, _keypoint in enumerate(anno_pair[1]['keypoints']):
-                if keypoint['name'] == _keypoint['name']:
-                    if keypoint['name'] != 'outlier':
-                        perm_mat[i, j] = 1
-                    row_list.append(i)
-                    col_list.append(j)
-                    break
-        row_list.sort()
-        col_list.sort()
+        perm_mat, row_mask, col_mask = match_keypoints(*[keypoint_ids(_['keypoints']) for _ in anno_pair])
         if not src_outlier:
-            perm_mat = perm_mat[row_list, :]
-            anno_pair[0]['keypoints'] = [anno_pair[0]['keypoints'][i] for i in row_list]
+            perm_mat = perm_mat[row_mask, :]
+            anno_pair[0]['keypoints'] = filter_keypoints(anno_pair[0]['keypoints'], row_mask)
         if not tgt_outlier:
-            perm_mat = perm_mat[:, col_list]
-            anno_pair[1]['keypoints'] = [anno_pair[1]['keypoints'][j] for j in col_list]
+            perm_mat = perm_mat[:, col_mask]
+            anno_pair[1]['keypoints'] = filter_keypoints(anno_pair[1]['keypoints'], col_mask)
 
         return anno_pair, perm_mat
 
@@ -93,13 +81,7 @@ class IMC_PT_SparseGM(BaseDataset):
                 random.shuffle(anno_dict['keypoints'])
             anno_list.append(anno_dict)
 
-        perm_mat = [np.zeros([self.total_kpt_num, len(x['keypoints'])], dtype=np.float32) for x in anno_list]
-        for k, anno_dict in enumerate(anno_list):
-            kpt_name_list = [x['name'] for x in anno_dict['keypoints']]
-            for j, name in enumerate(kpt_name_list):
-                perm_mat[k][name, j] = 1
-        for k in range(num):
-            perm_mat[k] = perm_mat[k].transpose()
+        perm_mat = [universe_perm_mat(keypoint_ids(x['keypoints']), self.total_kpt_num) for x in anno_list]
 
         return anno_list, perm_mat
 
@@ -144,6 +126,7 @@ class IMC_PT_SparseGM(BaseDataset):
         anno_dict['ori_sizes'] = ori_sizes
         anno_dict['cls'] = self.classes[cls]
         anno_dict['univ_size'] = self.total_kpt_num
+        anno_dict['id'] = img_name
 
         return anno_dict
 
@@ -4,8 +4,9 @@ import numpy as np
 import xml.etree.ElementTree as ET
 import random
 import pickle
-import copy
-from src.ssl.augmentation import augmentation
+import os
+from src.ssl.augmentation import BatchedAugmentation, augment_anno_dict
+from src.dataset.base_dataset import keypoint_ids, match_keypoints, filter_keypoints
 
 from src.utils.config import cfg
 
@@ -93,6 +94,12 @@ class PascalVOC:
         cache_path = cfg.CACHE_PATH
 
         self.classes_kpts = {cls: len(KPT_NAMES[cls]) for cls in self.classes}
+        self.kpt_name_to_id = [{name: i for i, name in enumerate(KPT_NAMES[cls])} for cls in self.classes]
+        self.ssl_augmentation = BatchedAugmentation(256, cfg.SSL.CROP_RATE_LB, cfg.SSL.CROP_RATE_UB,
+                                                    cfg.SSL.SCALE_RATIO_LB, cfg.SSL.SCALE_RATIO_UB,
+                                                    cfg.SSL.VERTICAL_FLIP_RATE, cfg.SSL.HORIZONTAL_FLIP_RATE,
+                                                    cfg.SSL.COLOR_JITTER, cfg.SSL.COLOR_JITTER_RATE, cfg.SSL.GRAY_SCALE,
+                                                    cfg.SSL.GAUSSIAN_BLUR_RATE, cfg.SSL.GAUSSIAN_BLUR_SIGMA)
 
         self.anno_path = Path(anno_path)
         self.img_path = Path(img_path)
@@ -127,6 +134,10 @@ class PascalVOC:
                 pickle.dump(self.xml_list, f)
             print('Filtered {} images to {}. Annotation saved.'.format(before_filter, after_filter))
 
+        self.obj_cache = None
+        if cfg.PascalVOC.OBJ_CACHE:
+            self.obj_cache = self.__load_obj_cache()
+
     def filter_list(self):
         """
         Filter out 'truncated', 'occluded' and 'difficult' images following the practice of previous works.
@@ -190,54 +201,19 @@ class PascalVOC:
                 random.shuffle(anno_dict['keypoints'])
             anno_pair.append(anno_dict)
 
-        for n in range(2 if cfg.SSL.DOUBLE else 1):
-            ps = anno_pair[0]['keypoints']
-            pset = []
-            for i in range(len(ps)):
-                pset.append((ps[i]['x'], ps[i]['y']))
-            im = anno_pair[0]['image']
-            trans, qset, coord = augmentation(im, pset, cfg.SSL.CROP_RATE_LB, cfg.SSL.CROP_RATE_UB,
-                                              cfg.SSL.SCALE_RATIO_LB, cfg.SSL.SCALE_RATIO_UB,
-                                              cfg.SSL.VERTICAL_FLIP_RATE, cfg.SSL.HORIZONTAL_FLIP_RATE,
-                                              cfg.SSL.COLOR_JITTER, cfg.SSL.COLOR_JITTER_RATE, cfg.SSL.GRAY_SCALE,
-                                              cfg.SSL.GAUSSIAN_BLUR_RATE, cfg.SSL.GAUSSIAN_BLUR_SIGMA)
-            # while all([q is None for q in qset]):
-            #     trans, qset, coord = argumentation(im, pset)
-            new_dict = copy.deepcopy(anno_pair[0])
-            new_dict['image'] = trans
-            qs = []
-            for i in range(len(qset)):
-                if qset[i] is not None:
-                    qs.append({'name': ps[i]['name'], 'x': qset[i][0], 'y': qset[i][1]})
-                elif random.random() < cfg.SSL.PADDING_RATE:
-                    qs.append({'name': 'outlier', 'x': random.random() * im.size[0], 'y': random.random() * im.size[1]})
-            while len(qs) <= 2:
-                qs.append({'name': 'outlier', 'x': random.random() * im.size[0], 'y': random.random() * im.size[1]})
-            if shuffle:
-                random.shuffle(qs)
-            new_dict['keypoints'] = qs
-            anno_pair.append(new_dict)
+        anno_pair += augment_anno_dict(anno_pair[0], self.ssl_augmentation, 2 if cfg.SSL.DOUBLE else 1,
+                                       cfg.SSL.PADDING_RATE, 3, shuffle)
         if len(anno_pair) > 2:
             anno_pair.pop(0)
         # anno_pair.reverse()
-        perm_mat = np.zeros([len(_['keypoints']) for _ in anno_pair], dtype=np.float32)
-        row_list = []
-        col_list = []
-        for i, keypoint in enumerate(anno_pair[0]['keypoints']):
-            for j, _keypoint in enumerate(anno_pair[1]['keypoints']):
-                if keypoint['name'] == _keypoint['name'] and keypoint['name'] != 'outlier':
-                    perm_mat[i, j] = 1
-                    row_list.append(i)
-                    col_list.append(j)
-                    break
-        row_list.sort()
-        col_list.sort()
+        perm_mat, row_mask, col_mask = match_keypoints(
+            *[keypoint_ids(_['keypoints'], self.kpt_name_to_id[cls]) for _ in anno_pair])
         if not src_outlier:
-            perm_mat = perm_mat[row_list, :]
-            anno_pair[0]['keypoints'] = [anno_pair[0]['keypoints'][i] for i in row_list]
+            perm_mat = perm_mat[row_mask, :]
+            anno_pair[0]['keypoints'] = filter_keypoints(anno_pair[0]['keypoints'], row_mask)
         if not tgt_outlier:
-            perm_mat = perm_mat[:, col_list]
-            anno_pair[1]['keypoints'] = [anno_pair[1]['keypoints'][j] for j in col_list]
+            perm_mat = perm_mat[:, col_mask]
+            anno_pair[1]['keypoints'] = filter_keypoints(anno_pair[1]['keypoints'], col_mask)
 
         return anno_pair, perm_mat
 
@@ -265,24 +241,14 @@ class PascalVOC:
                 random.shuffle(anno_dict['keypoints'])
             anno_pair.append(anno_dict)
 
-        perm_mat = np.zeros([len(_['keypoints']) for _ in anno_pair], dtype=np.float32)
-        row_list = []
-        col_list = []
-        for i, keypoint in enumerate(anno_pair[0]['keypoints']):
-            for j, _keypoint in enumerate(anno_pair[1]['keypoints']):
-                if keypoint['name'] == _keypoint['name']:
-                    perm_mat[i, j] = 1
-                    row_list.append(i)
-                    col_list.append(j)
-                    break
-        row_list.sort()
-        col_list.sort()
+        perm_mat, row_mask, col_mask = match_keypoints(
+            *[keypoint_ids(_['keypoints'], self.kpt_name_to_id[cls]) for _ in anno_pair])
         if not src_outlier:
-            perm_mat = perm_mat[row_list, :]
-            anno_pair[0]['keypoints'] = [anno_pair[0]['keypoints'][i] for i in row_list]
+            perm_mat = perm_mat[row_mask, :]
+            anno_pair[0]['keypoints'] = filter_keypoints(anno_pair[0]['keypoints'], row_mask)
         if not tgt_outlier:
-            perm_mat = perm_mat[:, col_list]
-            anno_pair[1]['keypoints'] = [anno_pair[1]['keypoints'][j] for j in col_list]
+            perm_mat = perm_mat[:, col_mask]
+            anno_pair[1]['keypoints'] = filter_keypoints(anno_pair[1]['keypoints'], col_mask)
 
         return anno_pair, perm_mat
 
@@ -311,35 +277,12 @@ class PascalVOC:
                 random.shuffle(anno_dict['keypoints'])
             anno_list.append(anno_dict)
 
-        perm_mat = [np.zeros([len(anno_list[0]['keypoints']), len(x['keypoints'])], dtype=np.float32) for x in anno_list]
-        row_list = []
-        col_lists = []
-        for i in range(num):
-            col_lists.append([])
-        for i, keypoint in enumerate(anno_list[0]['keypoints']):
-            kpt_idx = []
-            for anno_dict in anno_list:
-                kpt_name_list = [x['name'] for x in anno_dict['keypoints']]
-                if keypoint['name'] in kpt_name_list:
-                    kpt_idx.append(kpt_name_list.index(keypoint['name']))
-                else:
-                    kpt_idx.append(-1)
-            row_list.append(i)
-            for k in range(num):
-                j = kpt_idx[k]
-                if j != -1:
-                    col_lists[k].append(j)
-                    perm_mat[k][i, j] = 1
-
-        row_list.sort()
-        for col_list in col_lists:
-            col_list.sort()
-
+        ids = [keypoint_ids(x['keypoints'], self.kpt_name_to_id[cls]) for x in anno_list]
+        perm_mat = []
         for k in range(num):
-            perm_mat[k] = perm_mat[k][row_list, :]
-            perm_mat[k] = perm_mat[k][:, col_lists[k]]
-            anno_list[k]['keypoints'] = [anno_list[k]['keypoints'][j] for j in col_lists[k]]
-            perm_mat[k] = perm_mat[k].transpose()
+            pm, _, col_mask = match_keypoints(ids[0], ids[k])
+            anno_list[k]['keypoints'] = filter_keypoints(anno_list[k]['keypoints'], col_mask)
+            perm_mat.append(pm[:, col_mask].transpose())
 
         return anno_list, perm_mat
 
@@ -366,11 +309,8 @@ class PascalVOC:
 
         ref = self.__get_ref_model(cls)
 
-        perm_mat = np.zeros((len(anno_dict['keypoints']), len(ref['keypoints'])), dtype=np.float32)
-        for i, keypoint in enumerate(anno_dict['keypoints']):
-            for j, _keypoint in enumerate(ref['keypoints']):
-                if keypoint['name'] == _keypoint['name']:
-                    perm_mat[i, j] = 1
+        perm_mat, _, _ = match_keypoints(keypoint_ids(anno_dict['keypoints'], self.kpt_name_to_id[cls]),
+                                         keypoint_ids(ref['keypoints'], self.kpt_name_to_id[cls]))
 
         return anno_dict, perm_mat
 
@@ -385,7 +325,96 @@ class PascalVOC:
         anno_dict['cls'] = self.classes[cls]
         return anno_dict
 
+    def __load_obj_cache(self):
+        """
+        Load the memory-mapped object cache, which is built upon the first call. The cache contains:
+        ::
+
+            images: (num_objs x h x w x 3) uint8 array of the resized objects (memory-mapped)
+            kpt_offsets: (num_objs + 1) offsets of the keypoints of each object
+            kpt_xy: (num_kpts x 2) resized keypoint coordinates
+            kpt_names: (num_kpts) keypoint names, as indices in KPT_NAMES of the class
+            bounds: (num_objs x 4) visible bounds (xmin, ymin, w, h)
+            ori_sizes: (num_objs x 2) original image sizes
+            xml_names: (num_objs) the xml names of objects
+
+        :return: dict of the cached arrays, and the index of every xml name
+        """
+        prefix = 'voc_obj_{}_{}x{}'.format(self.sets, *self.obj_resize)
+        img_file = self.cache_path / (prefix + '_img.npy')
+        anno_file = self.cache_path / (prefix + '_anno.npz')
+        if not (img_file.exists() and anno_file.exists()):
+            self.__build_obj_cache(img_file, anno_file)
+
+        obj_cache = dict(np.load(str(anno_file)))
+        obj_cache['images'] = np.load(str(img_file), mmap_mode='r')
+        obj_cache['index'] = {xml_name: i for i, xml_name in enumerate(obj_cache['xml_names'])}
+        print('object cache loaded from {}'.format(img_file))
+        return obj_cache
+
+    def __build_obj_cache(self, img_file, anno_file):
+        """
+        Decode, crop and resize every object in the dataset once, and write them to the object cache.
+        """
+        xml_cls = [(xml_name, cls_id) for cls_id in range(len(self.classes)) for xml_name in self.xml_list[cls_id]]
+        print('Caching {} objects to {}...'.format(len(xml_cls), img_file))
+        self.cache_path.mkdir(exist_ok=True, parents=True)
+
+        # the temporary files are unique to the process, because every distributed process may build the cache
+        # concurrently, and the others may have memory-mapped the cache already
+        tmp_img_file = img_file.with_suffix('.{}.tmp.npy'.format(os.getpid()))
+        images = np.lib.format.open_memmap(str(tmp_img_file), mode='w+', dtype=np.uint8,
+                                           shape=(len(xml_cls), self.obj_resize[1], self.obj_resize[0], 3))
+        kpt_offsets = np.zeros(len(xml_cls) + 1, dtype=np.int64)
+        kpt_xy = []
+        kpt_names = []
+        bounds = np.zeros((len(xml_cls), 4), dtype=np.float64)
+        ori_sizes = np.zeros((len(xml_cls), 2), dtype=np.int64)
+        for i, (xml_name, cls_id) in enumerate(xml_cls):
+            anno_dict = self.__parse_anno_dict(xml_name, cls_id)
+            images[i] = np.asarray(anno_dict['image'].convert('RGB'))
+            kpt_offsets[i + 1] = kpt_offsets[i] + len(anno_dict['keypoints'])
+            kpt_xy += [(kp['x'], kp['y']) for kp in anno_dict['keypoints']]
+            kpt_names += [KPT_NAMES[self.classes[cls_id]].index(kp['name']) for kp in anno_dict['keypoints']]
+            bounds[i] = anno_dict['bounds']
+            ori_sizes[i] = anno_dict['ori_sizes']
+        images.flush()
+        del images
+
+        tmp_anno_file = anno_file.with_suffix('.{}.tmp.npz'.format(os.getpid()))
+        np.savez(str(tmp_anno_file), kpt_offsets=kpt_offsets, kpt_xy=np.array(kpt_xy, dtype=np.float64).reshape(-1, 2),
+                 kpt_names=np.array(kpt_names, dtype=np.int64), bounds=bounds, ori_sizes=ori_sizes,
+                 xml_names=np.array([xml_name for xml_name, _ in xml_cls]))
+        tmp_img_file.replace(img_file)
+        tmp_anno_file.replace(anno_file)
+        print('Object cache saved.')
+
     def __get_anno_dict(self, xml_name, cls):
+        """
+        Get an annotation dict, from the object cache if enabled, otherwise from xml file
+        """
+        if self.obj_cache is None or xml_name not in self.obj_cache['index']:
+            return self.__parse_anno_dict(xml_name, cls)
+
+        c = self.obj_cache
+        i = c['index'][xml_name]
+        names = KPT_NAMES[self.classes[cls]]
+        keypoint_list = [{'name': names[name_id], 'x': x, 'y': y} for name_id, (x, y) in
+                         zip(c['kpt_names'][c['kpt_offsets'][i]: c['kpt_offsets'][i + 1]].tolist(),
+                             c['kpt_xy'][c['kpt_offsets'][i]: c['kpt_offsets'][i + 1]].tolist())]
+
+        anno_dict = dict()
+        anno_dict['image'] = Image.fromarray(c['images'][i])
+        anno_dict['keypoints'] = keypoint_list
+        anno_dict['bounds'] = tuple(c['bounds'][i].tolist())
+        anno_dict['ori_sizes'] = tuple(c['ori_sizes'][i].tolist())
+        anno_dict['cls'] = self.classes[cls]
+        anno_dict['univ_size'] = len(names)
+        anno_dict['id'] = xml_name
+
+        return anno_dict
+
+    def __parse_anno_dict(self, xml_name, cls):
         """
         Get an annotation dict from xml file
         """
@@ -420,6 +449,7 @@ class PascalVOC:
         anno_dict['ori_sizes'] = ori_sizes
         anno_dict['cls'] = self.classes[cls]
         anno_dict['univ_size'] = len(KPT_NAMES[anno_dict['cls']])
+        anno_dict['id'] = xml_name
 
         return anno_dict
 
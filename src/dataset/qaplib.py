@@ -3,7 +3,9 @@ from src.utils.config import cfg
 from pathlib import Path
 from src.dataset.base_dataset import BaseDataset
 import re
-import urllib
+import os
+import threading
+import urllib.request
 
 
 cls_list = ['bur', 'chr', 'els', 'esc', 'had', 'kra', 'lipa', 'nug', 'rou', 'scr', 'sko', 'ste', 'tai', 'tho', 'wil']
@@ -75,6 +77,10 @@ class QAPLIB(BaseDataset):
         # sort data list according to the names
         self.data_list.sort(key=cmp_to_key(name_cmp))
 
+        # parsed instances, which are also cached on disk if cfg.QAPLIB.CACHE
+        self.instances = dict()
+        self.cache_path = Path(cfg.CACHE_PATH) / 'qaplib'
+
         fetched_flag = self.qap_path / 'fetched_online'
 
         if fetch_online or not fetched_flag.exists():
@@ -89,59 +95,64 @@ class QAPLIB(BaseDataset):
         :return: (pair of data, groundtruth permutation matrix)
         """
         name = self.data_list[idx]
+        if name not in self.instances:
+            self.instances[name] = self.__load_instance(name)
+        Fi, Fj, perm_mat, sol = self.instances[name]
+
+        return Fi.copy(), Fj.copy(), perm_mat.copy(), sol, name
 
+    def __load_instance(self, name):
+        """
+        Load a QAP instance from the cache if enabled (built upon the first call), otherwise from .dat and .sln files.
+        :param name: name of the instance
+        :return: (Fi, Fj, groundtruth permutation matrix, optimal objective score)
+        """
         dat_path = self.qap_path / (name + '.dat')
         sln_path = self.qap_path / (name + '.sln')
-        dat_file = dat_path.open()
-        sln_file = sln_path.open()
-
-        def split_line(x):
-            for _ in re.split(r'[,\s]', x.rstrip('\n')):
-                if _ == "":
-                    continue
-                else:
-                    yield int(_)
-
-        dat_list = [[_ for _ in split_line(line)] for line in dat_file]
-        sln_list = [[_ for _ in split_line(line)] for line in sln_file]
+        cache_file = self.cache_path / (name + '.npz')
+
+        if cfg.QAPLIB.CACHE and cache_file.exists() and \
+                cache_file.stat().st_mtime >= max(dat_path.stat().st_mtime, sln_path.stat().st_mtime):
+            with np.load(str(cache_file)) as cache:
+                return cache['Fi'], cache['Fj'], cache['perm_mat'], int(cache['sol'])
+
+        Fi, Fj, perm_mat, sol = self.__parse_instance(dat_path, sln_path)
+
+        if cfg.QAPLIB.CACHE:
+            self.cache_path.mkdir(exist_ok=True, parents=True)
+            # the temporary file is unique to the process and thread, since the dataloader workers and the ranks may
+            # build the cache concurrently
+            tmp_cache_file = cache_file.with_suffix('.{}-{}.tmp.npz'.format(os.getpid(), threading.get_ident()))
+            np.savez(str(tmp_cache_file), Fi=Fi, Fj=Fj, perm_mat=perm_mat, sol=sol)
+            tmp_cache_file.replace(cache_file)
+        return Fi, Fj, perm_mat, sol
+
+    @staticmethod
+    def __parse_instance(dat_path, sln_path):
+        """
+        Parse the .dat and .sln files. The numbers are parsed at once, as the line breaks have no meaning in QAPLIB.
+        """
+        def read_ints(path):
+            return np.fromstring(path.read_text().replace(',', ' '), dtype=np.int64, sep=' ')
 
-        prob_size = dat_list[0][0]
+        dat = read_ints(dat_path)
+        sln = read_ints(sln_path)
 
         # read data
-        r = 0
-        c = 0
-        Fi = [[]]
-        Fj = [[]]
-        F = Fi
-        for l in dat_list[1:]:
-            F[r] += l
-            c += len(l)
-            assert c <= prob_size
-            if c == prob_size:
-                r += 1
-                if r < prob_size:
-                    F.append([])
-                    c = 0
-                else:
-                    F = Fj
-                    r = 0
-                    c = 0
-        Fi = np.array(Fi, dtype=np.float32)
-        Fj = np.array(Fj, dtype=np.float32)
-        assert Fi.shape == Fj.shape == (prob_size, prob_size)
+        prob_size = int(dat[0])
+        assert dat.shape[0] == 1 + 2 * prob_size ** 2
+        Fi = dat[1:1 + prob_size ** 2].reshape(prob_size, prob_size).astype(np.float32)
+        Fj = dat[1 + prob_size ** 2:].reshape(prob_size, prob_size).astype(np.float32)
         #K = np.kron(Fj, Fi)
 
         # read solution
-        sol = sln_list[0][1]
-        perm_list = []
-        for _ in sln_list[1:]:
-            perm_list += _
-        assert len(perm_list) == prob_size
+        sol = int(sln[1])
+        perm_list = sln[2:]
+        assert perm_list.shape[0] == prob_size
         perm_mat = np.zeros((prob_size, prob_size), dtype=np.float32)
-        for r, c in enumerate(perm_list):
-            perm_mat[r, c - 1] = 1
+        perm_mat[np.arange(prob_size), perm_list - 1] = 1
 
-        return Fi, Fj, perm_mat, sol, name
+        return Fi, Fj, perm_mat, sol
 
     def __fetch_online(self):
         """
@@ -151,7 +162,5 @@ class QAPLIB(BaseDataset):
             dat_content = urllib.request.urlopen(cfg.QAPLIB.ONLINE_REPO + 'data.d/{}.dat'.format(name)).read()
             sln_content = urllib.request.urlopen(cfg.QAPLIB.ONLINE_REPO + 'soln.d/{}.sln'.format(name)).read()
 
-            dat_file = (self.qap_path / (name + '.dat')).open('wb')
-            dat_file.write(dat_content)
-            sln_file = (self.qap_path / (name + '.sln')).open('wb')
-            sln_file.write(sln_content)
+            (self.qap_path / (name + '.dat')).write_bytes(dat_content)
+            (self.qap_path / (name + '.sln')).write_bytes(sln_content)
@@ -1,11 +1,10 @@
-import copy
 from pathlib import Path
 import scipy.io as sio
 from PIL import Image
 import numpy as np
 from src.utils.config import cfg
-from src.dataset.base_dataset import BaseDataset
-from src.ssl.augmentation import augmentation
+from src.dataset.base_dataset import BaseDataset, keypoint_ids, match_keypoints, filter_keypoints
+from src.ssl.augmentation import BatchedAugmentation, augment_anno_dict
 import random
 
 '''
@@ -35,6 +34,11 @@ class WillowObject(BaseDataset):
         self.train_len = int(self.train_len * rate_1)
         self.rand_outlier = cfg.WillowObject.RAND_OUTLIER
         self.rate_2 = rate_2
+        self.ssl_augmentation = BatchedAugmentation(256, cfg.SSL.CROP_RATE_LB, cfg.SSL.CROP_RATE_UB,
+                                                    cfg.SSL.SCALE_RATIO_LB, cfg.SSL.SCALE_RATIO_UB,
+                                                    cfg.SSL.VERTICAL_FLIP_RATE, cfg.SSL.HORIZONTAL_FLIP_RATE,
+                                                    cfg.SSL.COLOR_JITTER, cfg.SSL.COLOR_JITTER_RATE, cfg.SSL.GRAY_SCALE,
+                                                    cfg.SSL.GAUSSIAN_BLUR_RATE, cfg.SSL.GAUSSIAN_BLUR_SIGMA)
 
         self.mat_list = []
         for cls_name in self.classes:
@@ -92,46 +96,11 @@ class WillowObject(BaseDataset):
                 random.shuffle(anno_dict['keypoints'])
             anno_pair.append(anno_dict)
 
-        for n in range(2 if cfg.SSL.DOUBLE else 1):
-            ps = anno_pair[0]['keypoints']
-            pset = []
-            for i in range(len(ps)):
-                pset.append((ps[i]['x'], ps[i]['y']))
-            im = anno_pair[0]['image']
-            trans, qset, coord = augmentation(im, pset, cfg.SSL.CROP_RATE_LB, cfg.SSL.CROP_RATE_UB,
-                                              cfg.SSL.SCALE_RATIO_LB, cfg.SSL.SCALE_RATIO_UB,
-                                              cfg.SSL.VERTICAL_FLIP_RATE, cfg.SSL.HORIZONTAL_FLIP_RATE,
-                                              cfg.SSL.COLOR_JITTER, cfg.SSL.COLOR_JITTER_RATE, cfg.SSL.GRAY_SCALE,
-                                              cfg.SSL.GAUSSIAN_BLUR_RATE, cfg.SSL.GAUSSIAN_BLUR_SIGMA)
-            new_dict = copy.deepcopy(anno_pair[0])
-            new_dict['image'] = trans
-            qs = []
-            for i in range(len(qset)):
-                if qset[i] is not None:
-                    qs.append({'name': ps[i]['name'], 'x': qset[i][0], 'y': qset[i][1]})
-                elif random.random() < cfg.SSL.PADDING_RATE:
-                    qs.append({'name': 'outlier', 'x': random.random() * im.size[0], 'y': random.random() * im.size[1]})
-            while len(qs) <= 9:
-                qs.append({'name': 'outlier', 'x': random.random() * im.size[0], 'y': random.random() * im.size[1]})
-            if shuffle:
-                random.shuffle(qs)
-            new_dict['keypoints'] = qs
-            anno_pair.append(new_dict)
+        anno_pair += augment_anno_dict(anno_pair[0], self.ssl_augmentation, 2 if cfg.SSL.DOUBLE else 1,
+                                       cfg.SSL.PADDING_RATE, 10, shuffle)
         if len(anno_pair) > 2:
             anno_pair.pop(0)
-        perm_mat = np.zeros([len(_['keypoints']) for _ in anno_pair], dtype=np.float32)
-        row_list = []
-        col_list = []
-        for i, keypoint in enumerate(anno_pair[0]['keypoints']):
-            for j, _keypoint in enumerate(anno_pair[1]['keypoints']):
-                if keypoint['name'] == _keypoint['name']:
-                    if keypoint['name'] != 'outlier':
-                        perm_mat[i, j] = 1
-                    row_list.append(i)
-                    col_list.append(j)
-                    break
-        row_list.sort()
-        col_list.sort()
+        perm_mat, _, _ = match_keypoints(*[keypoint_ids(_['keypoints']) for _ in anno_pair])
         # perm_mat = perm_mat[row_list, :]
         # perm_mat = perm_mat[:, col_list]
         # anno_pair[0]['keypoints'] = [anno_pair[0]['keypoints'][i] for i in row_list]
@@ -161,23 +130,15 @@ class WillowObject(BaseDataset):
                 random.shuffle(anno_dict['keypoints'])
             anno_pair.append(anno_dict)
 
-        perm_mat = np.zeros([len(_['keypoints']) for _ in anno_pair], dtype=np.float32)
-        row_list = []
-        col_list = []
-        for i, keypoint in enumerate(anno_pair[0]['keypoints']):
-            for j, _keypoint in enumerate(anno_pair[1]['keypoints']):
-                if keypoint['name'] == _keypoint['name']:
-                    if keypoint['name'] != 'outlier':
-                        perm_mat[i, j] = 1
-                    row_list.append(i)
-                    col_list.append(j)
-                    break
-        row_list.sort()
-        col_list.sort()
-        perm_mat = perm_mat[row_list, :]
-        perm_mat = perm_mat[:, col_list]
-        anno_pair[0]['keypoints'] = [anno_pair[0]['keypoints'][i] for i in row_list]
-        anno_pair[1]['keypoints'] = [anno_pair[1]['keypoints'][j] for j in col_list]
+        ids1, ids2 = [keypoint_ids(_['keypoints']) for _ in anno_pair]
+        perm_mat, row_mask, col_mask = match_keypoints(ids1, ids2)
+        # unmatched inliers are removed, outliers are kept
+        row_mask |= ids1 < 0
+        col_mask |= ids2 < 0
+        perm_mat = perm_mat[row_mask, :]
+        perm_mat = perm_mat[:, col_mask]
+        anno_pair[0]['keypoints'] = filter_keypoints(anno_pair[0]['keypoints'], row_mask)
+        anno_pair[1]['keypoints'] = filter_keypoints(anno_pair[1]['keypoints'], col_mask)
 
         return anno_pair, perm_mat
 
@@ -202,37 +163,13 @@ class WillowObject(BaseDataset):
                 random.shuffle(anno_dict['keypoints'])
             anno_list.append(anno_dict)
 
-        perm_mat = [np.zeros([len(anno_list[0]['keypoints']), len(x['keypoints'])], dtype=np.float32) for x in
-                    anno_list]
-        row_list = []
-        col_lists = []
-        for i in range(num):
-            col_lists.append([])
-        for i, keypoint in enumerate(anno_list[0]['keypoints']):
-            kpt_idx = []
-            for anno_dict in anno_list:
-                kpt_name_list = [x['name'] for x in anno_dict['keypoints']]
-                if keypoint['name'] in kpt_name_list:
-                    kpt_idx.append(kpt_name_list.index(keypoint['name']))
-                else:
-                    kpt_idx.append(-1)
-            row_list.append(i)
-            for k in range(num):
-                j = kpt_idx[k]
-                if j != -1:
-                    col_lists[k].append(j)
-                    if keypoint['name'] != 'outlier':
-                        perm_mat[k][i, j] = 1
-
-        row_list.sort()
-        for col_list in col_lists:
-            col_list.sort()
-
+        ids = [keypoint_ids(x['keypoints']) for x in anno_list]
+        perm_mat = []
         for k in range(num):
-            perm_mat[k] = perm_mat[k][row_list, :]
-            perm_mat[k] = perm_mat[k][:, col_lists[k]]
-            anno_list[k]['keypoints'] = [anno_list[k]['keypoints'][j] for j in col_lists[k]]
-            perm_mat[k] = perm_mat[k].transpose()
+            pm, _, col_mask = match_keypoints(ids[0], ids[k])
+            col_mask |= ids[k] < 0  # outliers are kept
+            anno_list[k]['keypoints'] = filter_keypoints(anno_list[k]['keypoints'], col_mask)
+            perm_mat.append(pm[:, col_mask].transpose())
 
         return anno_list, perm_mat
 
@@ -280,6 +217,7 @@ class WillowObject(BaseDataset):
         anno_dict['ori_sizes'] = ori_sizes
         anno_dict['cls'] = cls
         anno_dict['univ_size'] = 10
+        anno_dict['id'] = mat_file.stem
 
         return anno_dict
 
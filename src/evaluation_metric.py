@@ -1,6 +1,8 @@
 import torch
 from torch import Tensor
-from itertools import combinations
+
+from src.parallel.distributed import all_reduce_sum
+from src.utils.config import cfg
 
 
 def pck(x: Tensor, x_gt: Tensor, perm_mat: Tensor, dist_threshs: Tensor, ns: Tensor) -> Tensor:
@@ -34,27 +36,39 @@ def pck(x: Tensor, x_gt: Tensor, perm_mat: Tensor, dist_threshs: Tensor, ns: Ten
              [10, 20]]
     """
     device = x.device
-    batch_num = x.shape[0]
-    thresh_num = dist_threshs.shape[1]
-
-    indices = torch.argmax(perm_mat, dim=-1)
+    n_gt = x_gt.shape[1]
 
-    dist = torch.zeros(batch_num, x_gt.shape[1], device=device)
-    for b in range(batch_num):
-        x_correspond = x[b, indices[b], :]
-        dist[b, 0:ns[b]] = torch.norm(x_correspond - x_gt[b], p=2, dim=-1)[0:ns[b]]
+    indices = torch.argmax(perm_mat, dim=-1)[:, :n_gt]
+    x_correspond = torch.gather(x, 1, indices.unsqueeze(-1).expand(-1, -1, x.shape[-1]))
+    dist = torch.norm(x_correspond - x_gt, p=2, dim=-1)  # b x n_gt
 
-    match_num = torch.zeros(thresh_num, device=device)
-    total_num = torch.zeros(thresh_num, device=device)
-    for b in range(batch_num):
-        for idx in range(thresh_num):
-            matches = (dist[b] < dist_threshs[b, idx])[0:ns[b]]
-            match_num[idx] += torch.sum(matches).to(match_num.dtype)
-            total_num[idx] += ns[b].to(total_num.dtype)
+    valid = torch.arange(n_gt, device=device).unsqueeze(0) < ns.to(device).unsqueeze(1)
+    matches = (dist.unsqueeze(-1) < dist_threshs.to(device).unsqueeze(1)) & valid.unsqueeze(-1)  # b x n_gt x m
 
+    match_num = torch.sum(matches, dim=(0, 1)).to(torch.float)
+    total_num = torch.sum(ns).to(device=device, dtype=torch.float)
     return match_num / total_num
 
 
+def _node_mask(pmat: Tensor, ns: Tensor) -> Tensor:
+    """
+    :return: :math:`(b\times n_1 \times 1)` mask of the first ``ns`` rows
+    """
+    return (torch.arange(pmat.shape[1], device=pmat.device).unsqueeze(0) < ns.to(pmat.device).unsqueeze(1)).unsqueeze(-1)
+
+
+def _check_perm_mat(pmat_pred: Tensor, pmat_gt: Tensor):
+    """
+    Check if the inputs are valid (partial) permutation matrices. This check synchronizes with the device, therefore it
+    is only enabled if ``cfg.DEBUG`` is set.
+    """
+    if cfg.DEBUG:
+        assert torch.all((pmat_pred == 0) + (pmat_pred == 1)), 'pmat_pred can only contain 0/1 elements.'
+        assert torch.all((pmat_gt == 0) + (pmat_gt == 1)), 'pmat_gt should only contain 0/1 elements.'
+        assert torch.all(torch.sum(pmat_pred, dim=-1) <= 1) and torch.all(torch.sum(pmat_pred, dim=-2) <= 1)
+        assert torch.all(torch.sum(pmat_gt, dim=-1) <= 1) and torch.all(torch.sum(pmat_gt, dim=-2) <= 1)
+
+
 def matching_recall(pmat_pred: Tensor, pmat_gt: Tensor, ns: Tensor) -> Tensor:
     r"""
     Matching Recall between predicted permutation matrix and ground truth permutation matrix.
@@ -72,20 +86,15 @@ def matching_recall(pmat_pred: Tensor, pmat_gt: Tensor, ns: Tensor) -> Tensor:
         This function is equivalent to "matching accuracy" if the matching problem has no outliers.
     """
     device = pmat_pred.device
-    batch_num = pmat_pred.shape[0]
 
     pmat_gt = pmat_gt.to(device)
 
-    assert torch.all((pmat_pred == 0) + (pmat_pred == 1)), 'pmat_pred can only contain 0/1 elements.'
-    assert torch.all((pmat_gt == 0) + (pmat_gt == 1)), 'pmat_gt should only contain 0/1 elements.'
-    assert torch.all(torch.sum(pmat_pred, dim=-1) <= 1) and torch.all(torch.sum(pmat_pred, dim=-2) <= 1)
-    assert torch.all(torch.sum(pmat_gt, dim=-1) <= 1) and torch.all(torch.sum(pmat_gt, dim=-2) <= 1)
+    _check_perm_mat(pmat_pred, pmat_gt)
 
-    acc = torch.zeros(batch_num, device=device)
-    for b in range(batch_num):
-        acc[b] = torch.sum(pmat_pred[b, :ns[b]] * pmat_gt[b, :ns[b]]) / torch.sum(pmat_gt[b, :ns[b]])
+    mask = _node_mask(pmat_pred, ns).to(pmat_pred.dtype)
+    acc = torch.sum(pmat_pred * pmat_gt * mask, dim=(1, 2)) / torch.sum(pmat_gt * mask, dim=(1, 2))
 
-    acc[torch.isnan(acc)] = 1
+    acc = torch.where(torch.isnan(acc), torch.ones_like(acc), acc)
 
     return acc
 
@@ -107,20 +116,15 @@ def matching_precision(pmat_pred: Tensor, pmat_gt: Tensor, ns: Tensor) -> Tensor
         This function is equivalent to "matching accuracy" if the matching problem has no outliers.
     """
     device = pmat_pred.device
-    batch_num = pmat_pred.shape[0]
 
     pmat_gt = pmat_gt.to(device)
 
-    assert torch.all((pmat_pred == 0) + (pmat_pred == 1)), 'pmat_pred can only contain 0/1 elements.'
-    assert torch.all((pmat_gt == 0) + (pmat_gt == 1)), 'pmat_gt should only contain 0/1 elements.'
-    assert torch.all(torch.sum(pmat_pred, dim=-1) <= 1) and torch.all(torch.sum(pmat_pred, dim=-2) <= 1)
-    assert torch.all(torch.sum(pmat_gt, dim=-1) <= 1) and torch.all(torch.sum(pmat_gt, dim=-2) <= 1)
+    _check_perm_mat(pmat_pred, pmat_gt)
 
-    precision = torch.zeros(batch_num, device=device)
-    for b in range(batch_num):
-        precision[b] = torch.sum(pmat_pred[b, :ns[b]] * pmat_gt[b, :ns[b]]) / torch.sum(pmat_pred[b, :ns[b]])
+    mask = _node_mask(pmat_pred, ns).to(pmat_pred.dtype)
+    precision = torch.sum(pmat_pred * pmat_gt * mask, dim=(1, 2)) / torch.sum(pmat_pred * mask, dim=(1, 2))
 
-    precision[torch.isnan(precision)] = 1
+    precision = torch.where(torch.isnan(precision), torch.ones_like(precision), precision)
 
     return precision
 
@@ -184,7 +188,8 @@ def objective_score(pmat_pred: Tensor, affmtx: Tensor) -> Tensor:
     where :math:`\mathrm{vec}(\cdot)` means column-wise vectorization.
 
     :param pmat_pred: predicted permutation matrix :math:`(\mathbf{X})`
-    :param affmtx: affinity matrix of the quadratic assignment problem :math:`(\mathbf{K})`
+    :param affmtx: affinity matrix of the quadratic assignment problem :math:`(\mathbf{K})`, or its lazy operator
+     (see :class:`~src.factorize_graph_matching.FactorizedAffinity`)
     :return: objective scores
 
     .. note::
@@ -195,6 +200,8 @@ def objective_score(pmat_pred: Tensor, affmtx: Tensor) -> Tensor:
     batch_num = pmat_pred.shape[0]
 
     p_vec = pmat_pred.transpose(1, 2).contiguous().view(batch_num, -1, 1)
+    if hasattr(affmtx, 'matvec'):
+        return torch.sum(p_vec * affmtx.matvec(p_vec.to(affmtx.dtype)), dim=(1, 2))
     obj_score = torch.matmul(torch.matmul(p_vec.transpose(1, 2), affmtx), p_vec).view(-1)
 
     return obj_score
@@ -228,35 +235,16 @@ def clustering_accuracy(pred_clusters: Tensor, gt_classes: Tensor) -> Tensor:
     :return: :math:`(b)` clustering accuracy
     """
     num_clusters = torch.max(pred_clusters, dim=-1).values + 1
-    batch_num = pred_clusters.shape[0]
+    gt_clusters = _gt_class_indices(gt_classes, pred_clusters)
+    conf = _confusion_matrix(pred_clusters, gt_clusters, num_clusters)  # b x k_pred x k_gt
+    pred_size = torch.sum(conf, dim=-1, keepdim=True).clamp(min=1)
 
-    gt_classes_t = []
-
-    for b in range(batch_num):
-        gt_classes_b_set = list(set(gt_classes[b]))
-        gt_classes_t.append([])
-        assert len(gt_classes_b_set) == num_clusters[b]
-        for i in range(len(gt_classes[b])):
-            gt_classes_t[b].append(gt_classes_b_set.index(gt_classes[b][i]))
-    gt_clusters = torch.tensor(gt_classes_t).to(dtype=pred_clusters.dtype, device=pred_clusters.device)
-
-    cluster_acc = torch.zeros(batch_num, device=pred_clusters.device)
-    for b in range(batch_num):
-        sum = 0
-        for i in range(num_clusters[b]):
-            for j, k in combinations(range(num_clusters[b]), 2):
-                pred_i = (pred_clusters[b] == i).to(dtype=torch.float)
-                gt_j = (gt_clusters[b] == j).to(dtype=torch.float)
-                gt_k = (gt_clusters[b] == k).to(dtype=torch.float)
-                sum += (torch.sum(pred_i * gt_j) * torch.sum(pred_i * gt_k)) / torch.sum(pred_i) ** 2
-        for i in range(num_clusters[b]):
-            for j, k in combinations(range(num_clusters[b]), 2):
-                gt_i = (gt_clusters[b] == i).to(dtype=torch.float)
-                pred_j = (pred_clusters[b] == j).to(dtype=torch.float)
-                pred_k = (pred_clusters[b] == k).to(dtype=torch.float)
-                sum += (torch.sum(gt_i * pred_j) * torch.sum(gt_i * pred_k)) / (torch.sum(pred_j) * torch.sum(pred_k))
-
-        cluster_acc[b] = 1 - sum / num_clusters[b].to(dtype=torch.float)
+    # sum_{j<k} a_j a_k = ((sum_j a_j)^2 - sum_j a_j^2) / 2
+    pair_sum = lambda a, dim: (torch.sum(a, dim=dim) ** 2 - torch.sum(a ** 2, dim=dim)) / 2
+    err = torch.sum(pair_sum(conf, -1) / pred_size.squeeze(-1) ** 2, dim=-1) + \
+          torch.sum(pair_sum(conf / pred_size, -2), dim=-1)
+
+    cluster_acc = 1 - err / num_clusters.to(dtype=torch.float)
 
     return cluster_acc
 
@@ -284,21 +272,10 @@ def clustering_purity(pred_clusters: Tensor, gt_classes: Tensor) -> Tensor:
     """
     num_clusters = torch.max(pred_clusters, dim=-1).values + 1
     num_instances = pred_clusters.shape[1]
-    batch_num = pred_clusters.shape[0]
-    gt_classes_t = []
-    for b in range(batch_num):
-        gt_classes_b_set = list(set(gt_classes[b]))
-        gt_classes_t.append([])
-        assert len(gt_classes_b_set) == num_clusters[b]
-        for i in range(len(gt_classes[b])):
-            gt_classes_t[b].append(gt_classes_b_set.index(gt_classes[b][i]))
-    gt_clusters = torch.tensor(gt_classes_t).to(dtype=pred_clusters.dtype, device=pred_clusters.device)
-
-    cluster_purity = torch.zeros(batch_num, device=pred_clusters.device)
-    for b in range(batch_num):
-        for i in range(num_clusters[b]):
-            max_counts = torch.max(torch.unique(gt_clusters[b][pred_clusters[b] == i], return_counts=True)[-1]).to(dtype=torch.float)
-            cluster_purity[b] += max_counts / num_instances
+    gt_clusters = _gt_class_indices(gt_classes, pred_clusters)
+    conf = _confusion_matrix(pred_clusters, gt_clusters, num_clusters)  # b x k_pred x k_gt
+
+    cluster_purity = torch.sum(torch.max(conf, dim=-1).values, dim=-1) / num_instances
 
     return cluster_purity
 
@@ -326,19 +303,132 @@ def rand_index(pred_clusters: Tensor, gt_classes: Tensor) -> Tensor:
                   ['bus','bus','cat', 'sofa',  'cat',  'sofa' ]]
     :return: :math:`(b)` clustering purity
     """
-    num_clusters = torch.max(pred_clusters, dim=-1).values + 1
     num_instances = pred_clusters.shape[1]
-    batch_num = pred_clusters.shape[0]
-    gt_classes_t = []
-    for b in range(batch_num):
-        gt_classes_b_set = list(set(gt_classes[b]))
-        gt_classes_t.append([])
-        assert len(gt_classes_b_set) == num_clusters[b]
-        for i in range(len(gt_classes[b])):
-            gt_classes_t[b].append(gt_classes_b_set.index(gt_classes[b][i]))
-    gt_clusters = torch.tensor(gt_classes_t).to(dtype=pred_clusters.dtype, device=pred_clusters.device)
+    gt_clusters = _gt_class_indices(gt_classes, pred_clusters)
     pred_pairs = pred_clusters.unsqueeze(-1) == pred_clusters.unsqueeze(-2)
     gt_pairs = gt_clusters.unsqueeze(-1) == gt_clusters.unsqueeze(-2)
     unmatched_pairs = torch.logical_xor(pred_pairs, gt_pairs).to(dtype=torch.float)
     rand_index = 1 - torch.sum(unmatched_pairs, dim=(-1,-2)) / (num_instances * (num_instances - 1))
     return rand_index
+
+
+def _gt_class_indices(gt_classes, pred_clusters: Tensor) -> Tensor:
+    """
+    Map the ground truth class names of every instance to indices in ``[0, k)``.
+
+    :return: :math:`(b\times n)` ground truth class indices, with the same dtype and device as ``pred_clusters``
+    """
+    gt_clusters = []
+    for gt_classes_b in gt_classes:
+        mapping = dict()
+        gt_clusters.append([mapping.setdefault(c, len(mapping)) for c in gt_classes_b])
+    gt_clusters = torch.tensor(gt_clusters, dtype=pred_clusters.dtype, device=pred_clusters.device)
+    if cfg.DEBUG:
+        assert torch.all(torch.max(gt_clusters, dim=-1).values == torch.max(pred_clusters, dim=-1).values)
+    return gt_clusters
+
+
+def _confusion_matrix(pred_clusters: Tensor, gt_clusters: Tensor, num_clusters: Tensor) -> Tensor:
+    """
+    :return: :math:`(b\times k \times k)` number of instances in every (predicted cluster, ground truth class) pair,
+     where :math:`k` is the maximum number of clusters in the batch
+    """
+    batch_num = pred_clusters.shape[0]
+    k = max(int(torch.max(num_clusters)), int(torch.max(gt_clusters)) + 1)
+    conf = torch.zeros(batch_num, k * k, device=pred_clusters.device)
+    conf.scatter_add_(1, pred_clusters * k + gt_clusters, torch.ones_like(pred_clusters, dtype=conf.dtype))
+    return conf.view(batch_num, k, k)
+
+
+class MetricAccumulator:
+    r"""
+    Streaming accumulator of the evaluation metrics.
+
+    The running count, sum and sum of squares of every metric are kept on the device, so that :meth:`update` never
+    synchronizes with the host. All metrics are reduced (across processes in distributed mode) and copied to the host at
+    once by :meth:`synchronize`.
+
+    Besides the per-instance metrics (e.g. recall, precision and f1 as returned by :func:`matching_recall`), the
+    accumulator also takes the objective score ratios (pred / gt, see :func:`objective_score`) and the inference time
+    (python numbers, which are accumulated on the host).
+
+    :param device: the device where the running sums are stored
+
+    Example:
+    ::
+
+        acc = MetricAccumulator(device)
+        for inputs in dataloader:
+            ...
+            acc.update('recall', matching_recall(pred, gt, ns))
+            acc.update('time', timer.toc() / batch_num, n=batch_num)
+        acc.synchronize()
+        print(acc.format('recall'), acc.mean('time'))
+    """
+    def __init__(self, device=None):
+        self.device = device
+        self._stats = dict()
+        self._host_stats = dict()
+        self._results = dict()
+
+    def update(self, name: str, values, n: int=1):
+        r"""
+        :param name: name of the metric
+        :param values: :math:`(b)` tensor of the per-instance metric, or a python number
+        :param n: the number of instances of a python number ``values``
+        """
+        if isinstance(values, Tensor):
+            v = values.detach().view(-1).to(dtype=torch.float64)
+            if self.device is not None:
+                v = v.to(self.device)
+            stats = torch.stack((torch.full((), v.shape[0], dtype=v.dtype, device=v.device),
+                                 torch.sum(v), torch.sum(v ** 2)))
+            self._stats[name] = self._stats[name] + stats if name in self._stats else stats
+        else:
+            stats = self._host_stats.get(name, (0, 0., 0.))
+            self._host_stats[name] = (stats[0] + n, stats[1] + values * n, stats[2] + values ** 2 * n)
+
+    def merge(self, other):
+        """
+        Add the running sums of another accumulator (e.g. to compute the average over all classes).
+        """
+        for name, stats in other._stats.items():
+            stats = stats.to(self.device) if self.device is not None else stats
+            self._stats[name] = self._stats[name] + stats if name in self._stats else stats
+        for name, stats in other._host_stats.items():
+            old = self._host_stats.get(name, (0, 0., 0.))
+            self._host_stats[name] = tuple(a + b for a, b in zip(old, stats))
+
+    def synchronize(self):
+        """
+        Reduce all metrics across processes and copy them to the host. This is the only synchronization point.
+        """
+        names = sorted(set(self._stats) | set(self._host_stats))
+        if len(names) == 0:
+            return
+        stats = torch.zeros(len(names), 3, dtype=torch.float64, device=self.device)
+        for i, name in enumerate(names):
+            if name in self._stats:
+                stats[i] += self._stats[name].to(stats.device)
+            if name in self._host_stats:
+                stats[i] += torch.tensor(self._host_stats[name], dtype=stats.dtype, device=stats.device)
+        stats = all_reduce_sum(stats).cpu()
+        for name, (count, total, sq_total) in zip(names, stats.tolist()):
+            mean = total / count if count > 0 else float('nan')
+            std = (max(sq_total - total * mean, 0.) / (count - 1)) ** 0.5 if count > 1 else float('nan')
+            self._results[name] = (int(count), mean, std)
+
+    def count(self, name: str) -> int:
+        return self._results[name][0] if name in self._results else 0
+
+    def mean(self, name: str) -> float:
+        return self._results[name][1] if name in self._results else float('nan')
+
+    def std(self, name: str) -> float:
+        return self._results[name][2] if name in self._results else float('nan')
+
+    def format(self, name: str) -> str:
+        """
+        :return: a formatted string with mean and variance, the same as :func:`format_metric`
+        """
+        return '{:.4f}±{:.4f}'.format(self.mean(name), self.std(name))
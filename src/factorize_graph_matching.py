@@ -3,12 +3,19 @@ from torch import Tensor
 from torch.autograd import Function
 from src.utils.sparse import bilinear_diag_torch
 from src.sparse_torch import CSRMatrix3d, CSCMatrix3d
+from src.sparse_torch.backend import _expand_indptr
 import scipy.sparse as ssp
 import numpy as np
+import hashlib
+import os
+from pathlib import Path
+from typing import Tuple
+from src.utils.amp import float32
 
 
+@float32
 def construct_aff_mat(Ke: Tensor, Kp: Tensor, KroG: CSRMatrix3d, KroH: CSCMatrix3d,
-                      KroGt: CSRMatrix3d=None, KroHt: CSCMatrix3d=None) -> Tensor:
+                      KroGt: CSRMatrix3d=None, KroHt: CSCMatrix3d=None, lazy: bool=False):
     r"""
     Construct the complete affinity matrix with edge-wise affinity matrix :math:`\mathbf{K}_e`, node-wise matrix
     :math:`\mathbf{K}_p` and graph connectivity matrices :math:`\mathbf{G}_1, \mathbf{H}_1, \mathbf{G}_2, \mathbf{H}_2`
@@ -35,13 +42,15 @@ def construct_aff_mat(Ke: Tensor, Kp: Tensor, KroG: CSRMatrix3d, KroH: CSCMatrix
      :math:`\mathbf{H}_2 (b\times n_2 \times n_{e_2})`, :math:`\mathbf{H}_1 (b\times n_1 \times n_{e_1})`
     :param KroGt: transpose of KroG (should be CSR, optional)
     :param KroHt: transpose of KroH (should be CSC, optional)
+    :param lazy: if ``True``, return a :class:`FactorizedAffinity` operator instead of the dense tensor
     :return: affinity matrix :math:`\mathbf K`
 
     .. note ::
         This function is optimized with sparse CSR and CSC matrices with GPU support for both forward and backward
-        computation with PyTorch. To use this function, you need to install ``ninja-build``, ``gcc-7``, ``nvcc`` (which
+        computation with PyTorch. For CUDA tensors, you need to install ``ninja-build``, ``gcc-7``, ``nvcc`` (which
         comes along with CUDA development tools) to successfully compile our customized CUDA code for CSR and CSC
-        matrices. The compiler is automatically called upon requirement.
+        matrices. The compiler is automatically called upon the first call. CPU tensors are handled by a pure PyTorch
+        implementation which requires no compilation (see :mod:`src.sparse_torch.backend`).
 
     For a graph matching problem with 5 nodes and 4 nodes,
     the connection of :math:`\mathbf K` and :math:`\mathbf{K}_p, \mathbf{K}_e` is illustrated as
@@ -50,10 +59,283 @@ def construct_aff_mat(Ke: Tensor, Kp: Tensor, KroG: CSRMatrix3d, KroH: CSCMatrix
 
     where :math:`\mathbf K (20 \times 20)` is the complete affinity matrix, :math:`\mathbf{K}_p (5 \times 4)` is the
     node-wise affinity matrix, :math:`\mathbf{K}_e(16 \times 10)` is the edge-wise affinity matrix.
+
+    .. note ::
+        The dense :math:`\mathbf K` costs :math:`O(b n_1^2 n_2^2)` memory, which is prohibitive for large graphs. With
+        ``lazy=True``, :math:`\mathbf K` is never materialized, and the solvers access it by matrix-vector products
+        (see :class:`FactorizedAffinity`).
     """
+    if lazy:
+        return FactorizedAffinity(Ke, Kp, KroG, KroH, KroGt, KroHt)
     return RebuildFGM.apply(Ke, Kp, KroG, KroH, KroGt, KroHt)
 
 
+def construct_sparse_aff_mat(Ke: Tensor, Kp: Tensor, KroG: CSRMatrix3d, KroH: CSCMatrix3d) -> Tuple[Tensor, Tensor]:
+    r"""
+    Construct the non-zero elements of the affinity matrix :math:`\mathbf K` without building the dense
+    :math:`(b\times n_1n_2 \times n_1n_2)` tensor. See :func:`~src.factorize_graph_matching.construct_aff_mat` for the
+    formulation and the parameters.
+
+    Since :math:`\mathbf{G}, \mathbf{H}` are incidence matrices, every column of their kronecker products contains at
+    most one non-zero element. Therefore every non-zero element of :math:`\mathrm{vec}(\mathbf{K}_e)` is scattered
+    to one element of :math:`\mathbf K`, and the memory and time cost are :math:`O(n_{e_1}n_{e_2} + n_1n_2)`.
+    This function is implemented by differentiable PyTorch indexing operations.
+
+    :param Ke: :math:`(b\times n_{e_1}\times n_{e_2})` edge-wise affinity matrix
+    :param Kp: :math:`(b\times n_1\times n_2)` node-wise affinity matrix
+    :param KroG: :math:`(b\times n_1n_2 \times n_{e_1}n_{e_2})` kronecker product of :math:`\mathbf{G}_2, \mathbf{G}_1`
+    :param KroH: :math:`(b\times n_{e_1}n_{e_2} \times n_1n_2)` kronecker product of :math:`\mathbf{H}_2, \mathbf{H}_1`
+     (transposed, in CSC format)
+    :return: :math:`(3\times nnz)` indices (batch, row, column) and :math:`(nnz)` values of the non-zero elements in
+     :math:`\mathbf K`. The diagonal elements are always included.
+    """
+    return FactorizedAffinity(Ke, Kp, KroG, KroH).nonzero()
+
+
+def order3_hyperedges(adj: Tensor) -> Tensor:
+    r"""
+    Enumerate the hyperedges of the third-order affinity tensor, which are the triangles of the association graph:
+
+    .. math::
+        \mathbf{A}^{(3)}_{x,y,z} = \mathbf{A}_{x,y} \mathbf{A}_{x,z} \mathbf{A}_{y,z}
+
+    Only the pairs of edges sharing the first node are visited, therefore the cost is
+    :math:`O(\sum_x \mathrm{deg}(x)^2)` instead of the :math:`O((n_1n_2)^3)` of the dense tensor.
+
+    :param adj: :math:`(b\times n_1n_2 \times n_1n_2)` adjacency matrix of the association graph, e.g. ``K > 0``
+    :return: :math:`(4\times m)` indices ``(batch, x, y, z)`` of the hyperedges, sorted in lexicographic order (the
+     same as a coalesced sparse tensor)
+    """
+    batch_num, n = adj.shape[0], adj.shape[1]
+    device = adj.device
+    b_idx, row, col = torch.nonzero(adj, as_tuple=True)
+    node = b_idx * n + row
+    deg = torch.bincount(node, minlength=batch_num * n)
+    ptr = torch.cumsum(deg, dim=0) - deg
+
+    # every edge (x, y) is paired with all edges (x, z)
+    count = deg[node]
+    e1 = torch.repeat_interleave(torch.arange(node.shape[0], device=device), count)
+    group_offset = torch.cumsum(count, dim=0) - count
+    e2 = ptr[node[e1]] + torch.arange(e1.shape[0], device=device) - group_offset[e1]
+
+    b_idx, x, y, z = b_idx[e1], row[e1], col[e1], col[e2]
+    valid = adj[b_idx, y, z] != 0
+    return torch.stack((b_idx[valid], x[valid], y[valid], z[valid]))
+
+
+class FactorizedAffinity:
+    r"""
+    Lazy operator of the affinity matrix
+
+    .. math ::
+        \mathbf{K}=\mathrm{diag}(\mathrm{vec}(\mathbf{K}_p)) +
+        (\mathbf{G}_2 \otimes_{\mathcal{K}} \mathbf{G}_1) \mathrm{diag}(\mathrm{vec}(\mathbf{K}_e))
+        (\mathbf{H}_2 \otimes_{\mathcal{K}} \mathbf{H}_1)^\top
+
+    which only stores :math:`\mathbf{K}_e, \mathbf{K}_p` and the non-zero elements of the kronecker products of the
+    connectivity matrices. All operations are implemented by PyTorch indexing operations, therefore the gradients are
+    back-propagated to :math:`\mathbf{K}_e, \mathbf{K}_p` by autograd. The cost of a matrix-vector product is
+    :math:`O(n_{e_1}n_{e_2} + n_1n_2)` per instance.
+
+    See :func:`~src.factorize_graph_matching.construct_aff_mat` for the parameters.
+
+    :param Ke: :math:`(b\times n_{e_1}\times n_{e_2})` edge-wise affinity matrix
+    :param Kp: :math:`(b\times n_1\times n_2)` node-wise affinity matrix
+    :param KroG: :math:`(b\times n_1n_2 \times n_{e_1}n_{e_2})` kronecker product of :math:`\mathbf{G}_2, \mathbf{G}_1`
+    :param KroH: :math:`(b\times n_{e_1}n_{e_2} \times n_1n_2)` kronecker product of :math:`\mathbf{H}_2, \mathbf{H}_1`
+     (transposed, in CSC format)
+    :param KroGt: transpose of KroG (optional, only used by :meth:`to_dense`)
+    :param KroHt: transpose of KroH (optional, only used by :meth:`to_dense`)
+    """
+    def __init__(self, Ke: Tensor, Kp: Tensor, KroG: CSRMatrix3d, KroH: CSCMatrix3d,
+                 KroGt: CSRMatrix3d=None, KroHt: CSCMatrix3d=None):
+        self.Ke, self.Kp = Ke, Kp
+        self.KroG, self.KroH, self.KroGt, self.KroHt = KroG, KroH, KroGt, KroHt
+        batch_num, n, e = KroG.shape
+        self.shape = (batch_num, n, n)
+        self.num_edges = e
+
+        # the non-zero elements in coordinate format, indexed globally in the batch
+        self.g_row = _expand_indptr(KroG.indptr)  # b * n + i
+        self.g_edge = self.g_row // n * e + KroG.indices  # b * e + edge
+        self.g_val = KroG.data
+        self.h_col = _expand_indptr(KroH.indptr)  # b * n + j
+        self.h_edge = self.h_col // n * e + KroH.indices
+        self.h_val = KroH.data
+
+    @classmethod
+    def _from_coo(cls, Ke, Kp, g_row, g_edge, g_val, h_col, h_edge, h_val) -> 'FactorizedAffinity':
+        K = cls.__new__(cls)
+        K.Ke, K.Kp = Ke, Kp
+        K.KroG = K.KroH = K.KroGt = K.KroHt = None
+        K.shape = (Kp.shape[0], Kp.shape[1] * Kp.shape[2], Kp.shape[1] * Kp.shape[2])
+        K.num_edges = Ke.shape[1] * Ke.shape[2]
+        K.g_row, K.g_edge, K.g_val = g_row, g_edge, g_val
+        K.h_col, K.h_edge, K.h_val = h_col, h_edge, h_val
+        return K
+
+    @property
+    def device(self):
+        return self.Ke.device
+
+    @property
+    def dtype(self):
+        return self.Ke.dtype
+
+    @property
+    def ke(self) -> Tensor:
+        r"""
+        :math:`\mathrm{vec}(\mathbf{K}_e)` of the whole batch :math:`(b n_{e_1}n_{e_2})`
+        """
+        return self.Ke.transpose(1, 2).reshape(-1)
+
+    @property
+    def kp(self) -> Tensor:
+        r"""
+        :math:`\mathrm{vec}(\mathbf{K}_p)` of the whole batch :math:`(b n_1n_2)`
+        """
+        return self.Kp.transpose(1, 2).reshape(-1).to(self.dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, batch_idx: Tensor) -> 'FactorizedAffinity':
+        r"""
+        Select instances from the batch.
+
+        :param batch_idx: :math:`(b')` indices of the selected instances
+        :return: the lazy operator of the selected :math:`(b'\times n_1n_2 \times n_1n_2)` affinity matrices
+        """
+        batch_num, n, _ = self.shape
+        e = self.num_edges
+        batch_idx = torch.as_tensor(batch_idx, dtype=torch.long, device=self.device).view(-1)
+        new_idx = torch.full((batch_num,), -1, dtype=torch.long, device=self.device)
+        new_idx[batch_idx] = torch.arange(batch_idx.shape[0], device=self.device)
+
+        g_batch = new_idx[self.g_row // n]
+        g_keep = g_batch >= 0
+        h_batch = new_idx[self.h_col // n]
+        h_keep = h_batch >= 0
+        return FactorizedAffinity._from_coo(
+            self.Ke[batch_idx], self.Kp[batch_idx],
+            g_batch[g_keep] * n + self.g_row[g_keep] % n, g_batch[g_keep] * e + self.g_edge[g_keep] % e,
+            self.g_val[g_keep],
+            h_batch[h_keep] * n + self.h_col[h_keep] % n, h_batch[h_keep] * e + self.h_edge[h_keep] % e,
+            self.h_val[h_keep])
+
+    def matvec(self, v: Tensor) -> Tensor:
+        r"""
+        Compute :math:`\mathbf{K} \mathbf{v}`.
+
+        :param v: :math:`(b\times n_1n_2)` or :math:`(b\times n_1n_2 \times k)` input tensor
+        :return: :math:`\mathbf{K} \mathbf{v}` of the same shape as ``v``
+        """
+        batch_num, n, _ = self.shape
+        v_flat = v.reshape(batch_num * n, -1)
+        u = torch.zeros(batch_num * self.num_edges, v_flat.shape[1], dtype=v_flat.dtype, device=v_flat.device)
+        u = u.index_add(0, self.h_edge, self.h_val.unsqueeze(-1).to(v_flat.dtype) * v_flat[self.h_col])
+        u = u * self.ke.unsqueeze(-1)
+        Kv = torch.zeros_like(v_flat).index_add(0, self.g_row, self.g_val.unsqueeze(-1).to(u.dtype) * u[self.g_edge])
+        Kv = Kv + self.kp.unsqueeze(-1) * v_flat
+        return Kv.view(v.shape)
+
+    def bmm(self, v: Tensor) -> Tensor:
+        r"""
+        Batched matrix product :math:`\mathbf{K} \mathbf{V}`, compatible to ``torch.bmm(K, v)``.
+
+        :param v: :math:`(b\times n_1n_2 \times k)` input tensor
+        :return: :math:`(b\times n_1n_2 \times k)` output tensor
+        """
+        return self.matvec(v)
+
+    def __matmul__(self, v: Tensor) -> Tensor:
+        return self.matvec(v)
+
+    def diag(self) -> Tensor:
+        r"""
+        :return: :math:`(b\times n_1n_2)` diagonal elements of :math:`\mathbf K`
+        """
+        batch_num, n, _ = self.shape
+        d = self.kp
+        if self.h_edge.shape[0] > 0:
+            h_key, order = torch.sort(self.h_edge * batch_num * n + self.h_col)
+            g_key = self.g_edge * batch_num * n + self.g_row
+            pos = torch.searchsorted(h_key, g_key).clamp(max=h_key.shape[0] - 1)
+            match = h_key[pos] == g_key
+            val = self.g_val[match] * self.h_val[order[pos[match]]] * self.ke[self.g_edge[match]]
+            d = d.index_add(0, self.g_row[match], val.to(self.dtype))
+        return d.view(batch_num, n)
+
+    def sum(self, dim: int) -> Tensor:
+        r"""
+        Row-wise (``dim=2``) or column-wise (``dim=1``) sums of :math:`\mathbf K`.
+
+        :return: :math:`(b\times n_1n_2)` sums
+        """
+        batch_num, n, _ = self.shape
+        ones = torch.ones(batch_num, n, dtype=self.dtype, device=self.device)
+        if dim == 2:
+            return self.matvec(ones)
+        elif dim == 1:
+            return self.transpose().matvec(ones)
+        else:
+            raise ValueError('Dimension {} not understood.'.format(dim))
+
+    def transpose(self) -> 'FactorizedAffinity':
+        r"""
+        :return: the lazy operator of :math:`\mathbf K^\top`, where the roles of :math:`\mathbf G` and
+         :math:`\mathbf H` are swapped
+        """
+        return FactorizedAffinity._from_coo(self.Ke, self.Kp, self.h_col, self.h_edge, self.h_val,
+                                            self.g_row, self.g_edge, self.g_val)
+
+    def to_dense(self) -> Tensor:
+        r"""
+        :return: :math:`(b\times n_1n_2 \times n_1n_2)` dense affinity matrix, same as
+         :func:`~src.factorize_graph_matching.construct_aff_mat`
+        """
+        if self.KroG is not None:
+            return RebuildFGM.apply(self.Ke, self.Kp, self.KroG, self.KroH, self.KroGt, self.KroHt)
+        indices, values = self.nonzero()
+        K = torch.zeros(self.shape, dtype=values.dtype, device=values.device)
+        return K.index_put(tuple(indices), values)
+
+    def nonzero(self) -> Tuple[Tensor, Tensor]:
+        r"""
+        Extract the non-zero elements of :math:`\mathbf K`.
+
+        Since :math:`\mathbf{G}, \mathbf{H}` are incidence matrices, every column of their kronecker products contains
+        at most one non-zero element. Therefore every non-zero element of :math:`\mathrm{vec}(\mathbf{K}_e)` is
+        scattered to one element of :math:`\mathbf K`.
+
+        :return: :math:`(3\times nnz)` indices (batch, row, column) and :math:`(nnz)` values. The diagonal elements are
+         always included.
+        """
+        batch_num, n, _ = self.shape
+        device = self.device
+        ke = self.ke
+
+        col_of_edge = torch.full((batch_num * self.num_edges,), -1, dtype=torch.long, device=device)
+        col_of_edge[self.h_edge] = self.h_col
+        h_val = torch.zeros(batch_num * self.num_edges, dtype=self.h_val.dtype, device=device)
+        h_val[self.h_edge] = self.h_val
+
+        g_col = col_of_edge[self.g_edge]
+        valid = g_col >= 0
+        g_row, g_col, g_edge = self.g_row[valid], g_col[valid], self.g_edge[valid]
+        diag = torch.arange(batch_num * n, device=device)
+
+        row = torch.cat((g_row, diag))
+        col = torch.cat((g_col, diag)) % n
+        val = torch.cat((self.g_val[valid] * h_val[g_edge] * ke[g_edge], self.kp))
+
+        key, inverse = torch.unique(row * n + col, sorted=True, return_inverse=True)
+        val = torch.zeros(key.shape[0], dtype=val.dtype, device=device).index_add(0, inverse, val)
+        row = key // n
+        return torch.stack((row // n, row % n, key % n)), val
+
+
 def kronecker_torch(t1: Tensor, t2: Tensor) -> Tensor:
     r"""
     Compute the kronecker product of :math:`\mathbf{T}_1` and :math:`\mathbf{T}_2`.
@@ -81,6 +363,114 @@ def kronecker_torch(t1: Tensor, t2: Tensor) -> Tensor:
     return tt
 
 
+class KroneckerAffinity:
+    r"""
+    Lazy operator of the affinity matrix of Koopmans-Beckmann's QAP
+
+    .. math ::
+        \mathbf{K} = \mathbf{F}_2 \otimes \mathbf{F}_1
+
+    which only stores :math:`\mathbf{F}_1, \mathbf{F}_2`. The matrix-vector product is computed by
+    :math:`\mathbf{K} \mathrm{vec}(\mathbf{X}) = \mathrm{vec}(\mathbf{F}_1 \mathbf{X} \mathbf{F}_2^\top)` in
+    :math:`O(n_1^2n_2 + n_1n_2^2)` time per instance, where :math:`\mathrm{vec}(\cdot)` means column-wise vectorization.
+    The interface is the same as :class:`FactorizedAffinity`.
+
+    :param F1: :math:`(b\times n_1 \times n_1)` flow (or distance) matrix of the first graph, e.g. ``Fi`` of QAPLIB
+    :param F2: :math:`(b\times n_2 \times n_2)` distance (or flow) matrix of the second graph, e.g. ``Fj`` of QAPLIB
+    """
+    def __init__(self, F1: Tensor, F2: Tensor):
+        self.F1, self.F2 = F1, F2
+        n = F1.shape[1] * F2.shape[1]
+        self.shape = (F1.shape[0], n, n)
+
+    @property
+    def device(self):
+        return self.F1.device
+
+    @property
+    def dtype(self):
+        return self.F1.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, batch_idx) -> 'KroneckerAffinity':
+        return KroneckerAffinity(self.F1[batch_idx], self.F2[batch_idx])
+
+    def to(self, *args, **kwargs) -> 'KroneckerAffinity':
+        return KroneckerAffinity(self.F1.to(*args, **kwargs), self.F2.to(*args, **kwargs))
+
+    def cuda(self) -> 'KroneckerAffinity':
+        return KroneckerAffinity(self.F1.cuda(), self.F2.cuda())
+
+    def matvec(self, v: Tensor) -> Tensor:
+        r"""
+        Compute :math:`\mathbf{K} \mathbf{v}`.
+
+        :param v: :math:`(b\times n_1n_2)` or :math:`(b\times n_1n_2 \times k)` input tensor
+        :return: :math:`\mathbf{K} \mathbf{v}` of the same shape as ``v``
+        """
+        batch_num, n1, n2 = self.F1.shape[0], self.F1.shape[1], self.F2.shape[1]
+        X = v.reshape(batch_num, n2, n1, -1)  # X[b, j, i] is the element (i, j) of the column-wise vectorized input
+        k = X.shape[-1]
+        X = torch.matmul(self.F1.unsqueeze(1).to(v.dtype), X)
+        X = torch.bmm(self.F2.to(v.dtype), X.reshape(batch_num, n2, n1 * k))
+        return X.view(v.shape)
+
+    def bmm(self, v: Tensor) -> Tensor:
+        r"""
+        Batched matrix product :math:`\mathbf{K} \mathbf{V}`, compatible to ``torch.bmm(K, v)``.
+
+        :param v: :math:`(b\times n_1n_2 \times k)` input tensor
+        :return: :math:`(b\times n_1n_2 \times k)` output tensor
+        """
+        return self.matvec(v)
+
+    def __matmul__(self, v: Tensor) -> Tensor:
+        return self.matvec(v)
+
+    def diag(self) -> Tensor:
+        r"""
+        :return: :math:`(b\times n_1n_2)` diagonal elements of :math:`\mathbf K`
+        """
+        d1 = torch.diagonal(self.F1, dim1=1, dim2=2)
+        d2 = torch.diagonal(self.F2, dim1=1, dim2=2)
+        return (d2.unsqueeze(2) * d1.unsqueeze(1)).view(self.shape[0], -1)
+
+    def sum(self, dim: int) -> Tensor:
+        r"""
+        Row-wise (``dim=2``) or column-wise (``dim=1``) sums of :math:`\mathbf K`.
+
+        :return: :math:`(b\times n_1n_2)` sums
+        """
+        if dim not in (1, 2):
+            raise ValueError('Dimension {} not understood.'.format(dim))
+        s1 = torch.sum(self.F1, dim=dim)
+        s2 = torch.sum(self.F2, dim=dim)
+        return (s2.unsqueeze(2) * s1.unsqueeze(1)).view(self.shape[0], -1)
+
+    def transpose(self) -> 'KroneckerAffinity':
+        r"""
+        :return: the lazy operator of :math:`\mathbf K^\top`
+        """
+        return KroneckerAffinity(self.F1.transpose(1, 2), self.F2.transpose(1, 2))
+
+    def to_dense(self) -> Tensor:
+        r"""
+        :return: :math:`(b\times n_1n_2 \times n_1n_2)` dense affinity matrix, same as ``kronecker_torch(F2, F1)``
+        """
+        return kronecker_torch(self.F2, self.F1)
+
+    @staticmethod
+    def concatenate(*Ks, device=None) -> 'KroneckerAffinity':
+        """
+        Concatenate the operators along the batch dimension (the graphs should be of the same size).
+        """
+        F1 = torch.cat([K.F1.to(device) for K in Ks])
+        F2 = torch.cat([K.F2.to(device) for K in Ks])
+        return KroneckerAffinity(F1, F2)
+
+
 def kronecker_sparse(arr1: np.ndarray, arr2: np.ndarray) -> np.ndarray:
     r"""
     Compute the kronecker product of :math:`\mathbf{T}_1` and :math:`\mathbf{T}_2`.
@@ -96,6 +486,99 @@ def kronecker_sparse(arr1: np.ndarray, arr2: np.ndarray) -> np.ndarray:
     return ss
 
 
+class KroneckerIncidence:
+    r"""
+    Vectorized builder of the batched kronecker products of incidence matrices
+    :math:`\mathbf{T}_1 \otimes_{\mathcal{K}} \mathbf{T}_2` (e.g. :math:`\mathbf{G}_2 \otimes_{\mathcal{K}} \mathbf{G}_1`)
+    in :class:`~src.sparse_torch.CSRMatrix3d`.
+
+    The non-zero elements of the kronecker product are the pairs of the non-zero elements of :math:`\mathbf{T}_1` and
+    :math:`\mathbf{T}_2`, whose indices are computed by index arithmetic for the whole batch. The output is the same as
+    building :func:`~src.factorize_graph_matching.kronecker_sparse` for every instance and stacking them by
+    :class:`~src.sparse_torch.CSRMatrix3d`.
+
+    :param dtype: numpy dtype of the output data
+    :param cache_dir: if specified, the results are cached on disk, keyed by the topology (non-zero pattern and values)
+     of the inputs. It is only helpful if the graphs are deterministic (e.g. the test set).
+    """
+    def __init__(self, dtype=np.float32, cache_dir: str=None):
+        self.dtype = dtype
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def to_coo(t) -> tuple:
+        r"""
+        Extract the non-zero elements of a batched matrix, which can be reused by multiple calls.
+
+        :param t: :math:`(b\times n \times e)` tensor or numpy array
+        :return: batch indices, row indices, column indices, values and the shape
+        """
+        if type(t) == tuple:
+            return t
+        if isinstance(t, Tensor):
+            t = t.cpu().numpy()
+        b, r, c = np.nonzero(t)
+        return b, r, c, t[b, r, c], t.shape
+
+    def __call__(self, t1, t2) -> CSRMatrix3d:
+        r"""
+        :param t1: :math:`(b\times n_1 \times e_1)` incidence matrices (tensor, array or the output of :meth:`to_coo`)
+        :param t2: :math:`(b\times n_2 \times e_2)` incidence matrices (tensor, array or the output of :meth:`to_coo`)
+        :return: :math:`(b\times n_1n_2 \times e_1e_2)` kronecker products in CSR format
+        """
+        t1, t2 = self.to_coo(t1), self.to_coo(t2)
+        (batch_num, n1, e1), (_, n2, e2) = t1[-1], t2[-1]
+        shape = (batch_num, n1 * n2, e1 * e2)
+
+        if self.cache_dir is not None:
+            h = hashlib.sha1()
+            for arr in t1[:-1] + t2[:-1]:
+                h.update(np.ascontiguousarray(arr).tobytes())
+            h.update(str((t1[-1], t2[-1], np.dtype(self.dtype).str)).encode())
+            cache_file = self.cache_dir / 'kron_{}.npz'.format(h.hexdigest())
+            if cache_file.exists():
+                with np.load(str(cache_file)) as f:
+                    return CSRMatrix3d([f['indices'], f['indptr'], f['data']], shape=shape)
+            indices, indptr, data = self.build(t1, t2)
+            tmp_file = cache_file.with_suffix('.tmp{}.npz'.format(os.getpid()))
+            np.savez(str(tmp_file), indices=indices, indptr=indptr, data=data)
+            tmp_file.replace(cache_file)
+        else:
+            indices, indptr, data = self.build(t1, t2)
+
+        return CSRMatrix3d([indices, indptr, data], shape=shape)
+
+    def build(self, t1: tuple, t2: tuple) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        r"""
+        Compute indices, indptr, data of the batched kronecker products (see :meth:`__call__`).
+        """
+        b1, r1, c1, v1, (batch_num, n1, e1) = t1
+        b2, r2, c2, v2, (_, n2, e2) = t2
+        cnt1 = np.bincount(b1, minlength=batch_num)
+        cnt2 = np.bincount(b2, minlength=batch_num)
+        off1 = np.cumsum(cnt1) - cnt1
+        off2 = np.cumsum(cnt2) - cnt2
+
+        # the j-th pair of batch b is (j // cnt2[b])-th element of t1 and (j % cnt2[b])-th element of t2
+        pair_cnt = cnt1 * cnt2
+        batch = np.repeat(np.arange(batch_num), pair_cnt)
+        j = np.arange(batch.shape[0]) - np.repeat(np.cumsum(pair_cnt) - pair_cnt, pair_cnt)
+        idx1 = off1[batch] + j // np.maximum(cnt2[batch], 1)
+        idx2 = off2[batch] + j % np.maximum(cnt2[batch], 1)
+
+        row = r1[idx1] * n2 + r2[idx2]
+        col = c1[idx1] * e2 + c2[idx2]
+        data = (v1[idx1] * v2[idx2]).astype(self.dtype)
+
+        order = np.lexsort((col, row, batch))
+        global_row = batch[order] * n1 * n2 + row[order]
+        indptr = np.zeros(batch_num * n1 * n2 + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(global_row, minlength=batch_num * n1 * n2))
+        return col[order].astype(np.int64), indptr, data[order]
+
+
 class RebuildFGM(Function):
     r"""
     Rebuild sparse affinity matrix in the formula of the paper `"Factorized Graph Matching, in
@@ -119,9 +602,7 @@ class RebuildFGM(Function):
         Kro1Ke = Kro1.dotdiag(Ke.transpose(1, 2).contiguous().view(batch_num, -1))
         Kro1KeKro2 = Kro1Ke.dot(Kro2, dense=True)
 
-        K = torch.empty_like(Kro1KeKro2)
-        for b in range(batch_num):
-            K[b] = Kro1KeKro2[b] + torch.diag(Kp[b].transpose(0, 1).contiguous().view(-1))
+        K = Kro1KeKro2 + torch.diag_embed(Kp.transpose(1, 2).reshape(batch_num, -1).to(Kro1KeKro2.dtype))
 
         return K
 
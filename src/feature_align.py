@@ -19,22 +19,24 @@ def feature_align(raw_feature: Tensor, P: Tensor, ns_t: Tensor, ori_size: tuple,
      size, this parameter is required.
     :param device: output device. If not specified, it will be the same as the input
     :return: :math:`(b\times c \times n)` extracted feature vectors
+
+    .. note::
+        All points in the batch are interpolated at once by gathering. The features of padded points (beyond
+        ``ns_t``) are zeros.
     """
     if device is None:
         device = raw_feature.device
 
-    batch_num = raw_feature.shape[0]
-    channel_num = raw_feature.shape[1]
     n_max = P.shape[1]
 
     ori_size = torch.tensor(ori_size, dtype=torch.float32, device=device)
-    F = torch.zeros(batch_num, channel_num, n_max, dtype=torch.float32, device=device)
-    for idx, feature in enumerate(raw_feature):
-        n = ns_t[idx]
-        feat_size = torch.as_tensor(feature.shape[1:3], dtype=torch.float32, device=device)
-        _P = P[idx, 0:n]
-        interp_2d(feature, _P, ori_size, feat_size, out=F[idx, :, 0:n])
-    return F
+    feat_size = torch.as_tensor(raw_feature.shape[2:4], dtype=torch.float32, device=device)
+    step = ori_size / feat_size
+    p = (P.to(device) - step / 2) / ori_size * feat_size
+
+    F = _bilinear_interpolate_batch(raw_feature.to(device), p[:, :, 0], p[:, :, 1])
+    mask = torch.arange(n_max, device=device).unsqueeze(0) < ns_t.to(device).unsqueeze(1)
+    return F.masked_fill(~mask.unsqueeze(1), 0)
 
 
 def interp_2d(z: Tensor, P: Tensor, ori_size: Tensor, feat_size: Tensor, out=None, device=None) -> Tensor:
@@ -55,12 +57,11 @@ def interp_2d(z: Tensor, P: Tensor, ori_size: Tensor, feat_size: Tensor, out=Non
         device = z.device
 
     step = ori_size / feat_size
+    p = (P - step / 2) / ori_size * feat_size
+    interp = _bilinear_interpolate_batch(z.unsqueeze(0).to(device), p[None, :, 0], p[None, :, 1]).squeeze(0)
     if out is None:
-        out = torch.zeros(z.shape[0], P.shape[0], dtype=torch.float32, device=device)
-    for i, p in enumerate(P):
-        p = (p - step / 2) / ori_size * feat_size
-        out[:, i] = bilinear_interpolate(z, p[0], p[1])
-
+        return interp
+    out[:] = interp
     return out
 
 
@@ -77,50 +78,56 @@ def bilinear_interpolate(im: Tensor, x: Tensor, y: Tensor, device=None):
     """
     if device is None:
         device = im.device
-    x = x.to(torch.float32).to(device)
-    y = y.to(torch.float32).to(device)
+    x = torch.as_tensor(x, device=device).view(1, 1)
+    y = torch.as_tensor(y, device=device).view(1, 1)
+    return _bilinear_interpolate_batch(im.unsqueeze(0).to(device), x, y).view(-1)
+
+
+def _bilinear_interpolate_batch(im: Tensor, x: Tensor, y: Tensor) -> Tensor:
+    r"""
+    Batched bi-linear interpolation. Coordinates out of the feature map are interpolated by the nearest border pixels,
+    in the same way as the former point-wise implementation.
+
+    :param im: :math:`(b\times c\times w\times h)` feature map
+    :param x: :math:`(b\times n)` x coordinates
+    :param y: :math:`(b\times n)` y coordinates
+    :return: :math:`(b\times c\times n)` interpolated feature vectors
+    """
+    batch_num, channel_num, height, width = im.shape
+    x = x.to(torch.float32)
+    y = y.to(torch.float32)
 
     x0 = torch.floor(x)
     x1 = x0 + 1
     y0 = torch.floor(y)
     y1 = y0 + 1
 
-    x0 = torch.clamp(x0, 0, im.shape[2] - 1)
-    x1 = torch.clamp(x1, 0, im.shape[2] - 1)
-    y0 = torch.clamp(y0, 0, im.shape[1] - 1)
-    y1 = torch.clamp(y1, 0, im.shape[1] - 1)
+    x0 = torch.clamp(x0, 0, width - 1)
+    x1 = torch.clamp(x1, 0, width - 1)
+    y0 = torch.clamp(y0, 0, height - 1)
+    y1 = torch.clamp(y1, 0, height - 1)
 
-    x0 = x0.to(torch.int32).to(device)
-    x1 = x1.to(torch.int32).to(device)
-    y0 = y0.to(torch.int32).to(device)
-    y1 = y1.to(torch.int32).to(device)
+    flat_im = im.reshape(batch_num, channel_num, height * width)
 
-    Ia = im[:, y0, x0]
-    Ib = im[:, y1, x0]
-    Ic = im[:, y0, x1]
-    Id = im[:, y1, x1]
+    def gather(_y, _x):
+        idx = (_y.to(torch.int64) * width + _x.to(torch.int64)).unsqueeze(1).expand(-1, channel_num, -1)
+        return torch.gather(flat_im, 2, idx)
+
+    Ia = gather(y0, x0)
+    Ib = gather(y1, x0)
+    Ic = gather(y0, x1)
+    Id = gather(y1, x1)
 
     # to perform nearest neighbor interpolation if out of bounds
-    if x0 == x1:
-        if x0 == 0:
-            x0 -= 1
-        else:
-            x1 += 1
-    if y0 == y1:
-        if y0 == 0:
-            y0 -= 1
-        else:
-            y1 += 1
-
-    x0 = x0.to(torch.float32).to(device)
-    x1 = x1.to(torch.float32).to(device)
-    y0 = y0.to(torch.float32).to(device)
-    y1 = y1.to(torch.float32).to(device)
-
-    wa = (x1 - x) * (y1 - y)
-    wb = (x1 - x) * (y - y0)
-    wc = (x - x0) * (y1 - y)
-    wd = (x - x0) * (y - y0)
+    x_eq = x0 == x1
+    x0, x1 = torch.where(x_eq & (x0 == 0), x0 - 1, x0), torch.where(x_eq & (x0 != 0), x1 + 1, x1)
+    y_eq = y0 == y1
+    y0, y1 = torch.where(y_eq & (y0 == 0), y0 - 1, y0), torch.where(y_eq & (y0 != 0), y1 + 1, y1)
+
+    wa = ((x1 - x) * (y1 - y)).unsqueeze(1)
+    wb = ((x1 - x) * (y - y0)).unsqueeze(1)
+    wc = ((x - x0) * (y1 - y)).unsqueeze(1)
+    wd = ((x - x0) * (y - y0)).unsqueeze(1)
 
     out = Ia * wa + Ib * wb + Ic * wc + Id * wd
-    return out
+    return out.to(torch.float32)
@@ -2,9 +2,12 @@ import torch
 import scipy.optimize as opt
 import numpy as np
 from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 from torch import Tensor
+from src.utils.amp import float32
 
 
+@float32
 def hungarian(s: Tensor, n1: Tensor=None, n2: Tensor=None, nproc: int=1) -> Tensor:
     r"""
     Solve optimal LAP permutation by hungarian algorithm. The time cost is :math:`O(n^3)`.
@@ -12,55 +15,174 @@ def hungarian(s: Tensor, n1: Tensor=None, n2: Tensor=None, nproc: int=1) -> Tens
     :param s: :math:`(b\times n_1 \times n_2)` input 3d tensor. :math:`b`: batch size
     :param n1: :math:`(b)` number of objects in dim1
     :param n2: :math:`(b)` number of objects in dim2
-    :param nproc: number of parallel processes (default: ``nproc=1`` for no parallel)
+    :param nproc: number of parallel workers (default: ``nproc=1`` for no parallel)
     :return: :math:`(b\times n_1 \times n_2)` optimal permutation matrix
 
     .. note::
         We support batched instances with different number of nodes, therefore ``n1`` and ``n2`` are
         required to specify the exact number of objects of each dimension in the batch. If not specified, we assume
         the batched matrices are not padded.
+
+    .. note::
+        This function is a thin wrapper of :class:`BatchedLAP`. The engines (and their worker pools) are cached and
+        reused across calls.
+    """
+    if nproc not in _ENGINES:
+        _ENGINES[nproc] = BatchedLAP(nproc=nproc)
+    return _ENGINES[nproc](s, n1, n2)
+
+
+class BatchedLAP:
+    r"""
+    Batched linear assignment solver, which maximizes :math:`\mathrm{tr}(\mathbf{X}^\top \mathbf{S})` for every
+    instance in the batch.
+
+    The whole batch is copied to one contiguous float64 buffer on CPU, and the instances are dispatched to a persistent
+    pool of workers, which is created on the first call and reused afterwards.
+
+    :param backend: name of the LAP backend. Available backends:
+                    ``'scipy'`` (``scipy.optimize.linear_sum_assignment``, default),
+                    ``'lapjv'`` (Jonker-Volgenant algorithm from the optional ``lap`` package).
+                    Other backends can be added by :func:`register_lap_backend`
+    :param nproc: number of parallel workers (default: ``nproc=1`` for no parallel)
+    :param pool_type: ``'thread'`` or ``'process'``
+
+    .. note::
+        Thread pool has the minimal overhead and is preferred if the backend releases the GIL. Otherwise, please
+        consider ``pool_type='process'``.
+    """
+    def __init__(self, backend: str='scipy', nproc: int=1, pool_type: str='thread'):
+        if backend not in _LAP_BACKENDS:
+            raise ValueError('Unknown LAP backend: {}'.format(backend))
+        if pool_type not in ('thread', 'process'):
+            raise ValueError('Unknown pool type: {}'.format(pool_type))
+        self.backend = backend
+        self.nproc = nproc
+        self.pool_type = pool_type
+        self._pool = None
+
+    def __call__(self, s: Tensor, n1: Tensor=None, n2: Tensor=None) -> Tensor:
+        r"""
+        :param s: :math:`(b\times n_1 \times n_2)` input 3d tensor (or :math:`(n_1 \times n_2)` 2d tensor)
+        :param n1: :math:`(b)` number of objects in dim1
+        :param n2: :math:`(b)` number of objects in dim2
+        :return: :math:`(b\times n_1 \times n_2)` optimal permutation matrix
+        """
+        indices = self.solve(s, n1, n2)
+        if len(s.shape) == 2:
+            return self.to_dense(indices, s.shape[-2:], dtype=s.dtype, device=s.device)
+        return self.to_dense(indices, s.shape, dtype=s.dtype, device=s.device)
+
+    def solve(self, s: Tensor, n1: Tensor=None, n2: Tensor=None) -> Tensor:
+        r"""
+        Solve the batched LAP and return the permutation in sparse format.
+
+        :param s: :math:`(b\times n_1 \times n_2)` input 3d tensor (or :math:`(n_1 \times n_2)` 2d tensor)
+        :param n1: :math:`(b)` number of objects in dim1
+        :param n2: :math:`(b)` number of objects in dim2
+        :return: :math:`(3\times m)` (or :math:`(2\times m)` for 2d input) indices of the matched pairs
+                 ``(batch, row, col)``, where :math:`m` is the total number of matches in the batch
+        """
+        if len(s.shape) == 2:
+            return self.solve(s.unsqueeze(0), n1, n2)[1:]
+        elif len(s.shape) != 3:
+            raise ValueError('input data shape not understood: {}'.format(s.shape))
+
+        batch_num = s.shape[0]
+        cost = (-s.detach()).to(device='cpu', dtype=torch.float64).contiguous().numpy()
+        n1 = [None] * batch_num if n1 is None else n1.cpu().tolist()
+        n2 = [None] * batch_num if n2 is None else n2.cpu().tolist()
+        args = [(self.backend, cost[b], n1[b], n2[b]) for b in range(batch_num)]
+
+        if self.nproc > 1 and batch_num > 1:
+            results = list(self._get_pool().map(_lap_kernel, args))
+        else:
+            results = [_lap_kernel(arg) for arg in args]
+
+        batch_idx = np.concatenate([np.full(len(row), b, dtype=np.int64) for b, (row, col) in enumerate(results)])
+        row_idx = np.concatenate([row for row, col in results]).astype(np.int64)
+        col_idx = np.concatenate([col for row, col in results]).astype(np.int64)
+        indices = torch.from_numpy(np.stack((batch_idx, row_idx, col_idx)))
+        return indices.to(s.device)
+
+    @staticmethod
+    def to_dense(indices: Tensor, shape, dtype=torch.float32, device=None) -> Tensor:
+        r"""
+        Dense view of the sparse permutation returned by :meth:`solve`.
+
+        :param indices: :math:`(3\times m)` or :math:`(2\times m)` indices from :meth:`solve`
+        :param shape: shape of the output permutation matrix
+        :return: permutation matrix of ``shape``
+        """
+        perm_mat = torch.zeros(shape, dtype=dtype, device=indices.device if device is None else device)
+        perm_mat[tuple(indices)] = 1
+        return perm_mat
+
+    def close(self):
+        """
+        Shut down the worker pool.
+        """
+        if self._pool is not None:
+            if self.pool_type == 'thread':
+                self._pool.shutdown()
+            else:
+                self._pool.terminate()
+            self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            if self.pool_type == 'thread':
+                self._pool = ThreadPoolExecutor(max_workers=self.nproc)
+            else:
+                self._pool = Pool(processes=self.nproc)
+        return self._pool
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        return state
+
+    def __del__(self):
+        self.close()
+
+
+def register_lap_backend(name: str, func):
+    r"""
+    Register a new LAP backend for :class:`BatchedLAP`.
+
+    :param name: name of the backend
+    :param func: ``func(cost) -> (row, col)``, which minimizes the cost of a 2d float64 numpy array and returns the
+                 matched row and column indices
     """
-    if len(s.shape) == 2:
-        s = s.unsqueeze(0)
-        matrix_input = True
-    elif len(s.shape) == 3:
-        matrix_input = False
-    else:
-        raise ValueError('input data shape not understood: {}'.format(s.shape))
-
-    device = s.device
-    batch_num = s.shape[0]
-
-    perm_mat = s.cpu().detach().numpy() * -1
-    if n1 is not None:
-        n1 = n1.cpu().numpy()
-    else:
-        n1 = [None] * batch_num
-    if n2 is not None:
-        n2 = n2.cpu().numpy()
-    else:
-        n2 = [None] * batch_num
-
-    if nproc > 1:
-        with Pool(processes=nproc) as pool:
-            mapresult = pool.starmap_async(_hung_kernel, zip(perm_mat, n1, n2))
-            perm_mat = np.stack(mapresult.get())
-    else:
-        perm_mat = np.stack([_hung_kernel(perm_mat[b], n1[b], n2[b]) for b in range(batch_num)])
-
-    perm_mat = torch.from_numpy(perm_mat).to(device)
-
-    if matrix_input:
-        perm_mat.squeeze_(0)
-
-    return perm_mat
-
-def _hung_kernel(s: torch.Tensor, n1=None, n2=None):
+    _LAP_BACKENDS[name] = func
+
+
+def _lap_kernel(args):
+    backend, s, n1, n2 = args
     if n1 is None:
         n1 = s.shape[0]
     if n2 is None:
         n2 = s.shape[1]
-    row, col = opt.linear_sum_assignment(s[:n1, :n2])
-    perm_mat = np.zeros_like(s)
-    perm_mat[row, col] = 1
-    return perm_mat
\ No newline at end of file
+    return _LAP_BACKENDS[backend](s[:n1, :n2])
+
+
+def _scipy_lap(cost: np.ndarray):
+    return opt.linear_sum_assignment(cost)
+
+
+def _lapjv_lap(cost: np.ndarray):
+    try:
+        import lap
+    except ImportError:
+        raise ImportError('Backend lapjv requires the lap package, which can be installed by "pip install lap".')
+    _, x, _ = lap.lapjv(cost, extend_cost=cost.shape[0] != cost.shape[1])
+    row = np.nonzero(x >= 0)[0]
+    return row, x[row]
+
+
+_LAP_BACKENDS = {
+    'scipy': _scipy_lap,
+    'lapjv': _lapjv_lap,
+}
+
+_ENGINES = dict()
@@ -1,6 +1,9 @@
 import torch
 import torch.nn as nn
 from torch import Tensor
+from torch.autograd import Function
+from torch.utils.checkpoint import checkpoint
+from src.utils.amp import float32
 
 
 class Sinkhorn(nn.Module):
@@ -25,8 +28,15 @@ class Sinkhorn(nn.Module):
     :param tau: the hyper parameter :math:`\tau` controlling the temperature (default: ``1``)
     :param epsilon: a small number for numerical stability (default: ``1e-4``)
     :param log_forward: apply log-scale computation for better numerical stability (default: ``True``)
-    :param batched_operation: apply batched_operation for better efficiency (but may cause issues for back-propagation,
-     default: ``False``)
+    :param batched_operation: kept for backward compatibility. The log-scale computation is always batched and masked
+     (default: ``False``)
+    :param tol: tolerance of the marginal error for early stopping. ``tol=0`` means always run ``max_iter`` iterations
+     (default: ``0``)
+    :param backward_mode: how gradients are computed for ``log_forward=True``. ``unroll``: back-propagate through
+     every iteration; ``implicit``: analytical gradient at the fixed point (see
+     :class:`~src.lap_solvers.sinkhorn.SinkhornImplicit`); ``checkpoint``: recompute the iterations during backward.
+     The latter two keep no per-iteration activations. ``implicit`` falls back to ``checkpoint`` if there are
+     non-square instances (:math:`n_1 \neq n_2` without dummy rows) (default: ``unroll``)
 
     .. note::
         ``tau`` is an important hyper parameter to be set for Sinkhorn algorithm. ``tau`` controls the distance between
@@ -43,11 +53,13 @@ class Sinkhorn(nn.Module):
         ``exp`` part.
 
     .. note::
-        Setting ``batched_operation=True`` may be preferred when you are doing inference with this module and do not
-        need the gradient.
+        With ``log_forward=True``, all instances in the batch are computed together and instances with fewer nodes are
+        handled by masking. The early stopping criterion is checked per instance: once the maximal row-wise marginal
+        error of an instance is smaller than ``tol``, this instance is no longer updated. The number of iterations
+        performed by each instance in the last call is stored in ``self.iter_num``.
     """
     def __init__(self, max_iter: int=10, tau: float=1., epsilon: float=1e-4,
-                 log_forward: bool=True, batched_operation: bool=False):
+                 log_forward: bool=True, batched_operation: bool=False, tol: float=0., backward_mode: str='unroll'):
         super(Sinkhorn, self).__init__()
         self.max_iter = max_iter
         self.tau = tau
@@ -55,8 +67,12 @@ class Sinkhorn(nn.Module):
         self.log_forward = log_forward
         if not log_forward:
             print('Warning: Sinkhorn algorithm without log forward is deprecated because log_forward is more stable.')
-        self.batched_operation = batched_operation # batched operation may cause instability in backward computation,
-                                                   # but will boost computation.
+        self.batched_operation = batched_operation # no longer affects log_forward, which is always batched
+        self.tol = tol
+        self.iter_num = None
+        if backward_mode not in ('unroll', 'implicit', 'checkpoint'):
+            raise ValueError('Unknown backward mode: {}'.format(backward_mode))
+        self.backward_mode = backward_mode
 
     def forward(self, s: Tensor, nrows: Tensor=None, ncols: Tensor=None, dummy_row: bool=False) -> Tensor:
         r"""
@@ -85,8 +101,12 @@ class Sinkhorn(nn.Module):
         else:
             return self.forward_ori(s, nrows, ncols, dummy_row) # deprecated
 
+    @float32
     def forward_log(self, s, nrows=None, ncols=None, dummy_row=False):
-        """Compute sinkhorn with row/column normalization in the log space."""
+        """
+        Compute sinkhorn with row/column normalization in the log space. Padded entries are masked to ``-inf`` instead
+        of being sliced out per instance.
+        """
         if len(s.shape) == 2:
             s = s.unsqueeze(0)
             matrix_input = True
@@ -96,6 +116,7 @@ class Sinkhorn(nn.Module):
             raise ValueError('input data shape not understood.')
 
         batch_size = s.shape[0]
+        device = s.device
 
         if s.shape[2] >= s.shape[1]:
             transposed = False
@@ -104,89 +125,67 @@ class Sinkhorn(nn.Module):
             transposed = True
 
         if nrows is None:
-            nrows = [s.shape[1] for _ in range(batch_size)]
+            nrows = torch.full((batch_size,), s.shape[1], dtype=torch.long, device=device)
+        else:
+            nrows = torch.as_tensor(nrows, dtype=torch.long, device=device)
         if ncols is None:
-            ncols = [s.shape[2] for _ in range(batch_size)]
+            ncols = torch.full((batch_size,), s.shape[2], dtype=torch.long, device=device)
+        else:
+            ncols = torch.as_tensor(ncols, dtype=torch.long, device=device)
         if transposed:
-            n = nrows
-            nrows = ncols
-            ncols = n
+            nrows, ncols = ncols, nrows
+
         # operations are performed on log_s
         s = s / self.tau
 
+        ori_rows = s.shape[1]
+        ori_nrows = nrows
         if dummy_row:
             assert s.shape[2] >= s.shape[1]
-            dummy_shape = list(s.shape)
-            dummy_shape[1] = s.shape[2] - s.shape[1]
-            ori_nrows = nrows
+            s = torch.cat((s, s.new_zeros(batch_size, s.shape[2] - s.shape[1], s.shape[2])), dim=1)
             nrows = ncols
-            s = torch.cat((s, torch.full(dummy_shape, -float('inf')).to(s.device)), dim=1)
-            for b in range(batch_size):
-                s[b, ori_nrows[b]:nrows[b], :ncols[b]] = -100
-                s[b, nrows[b]:, :] = -float('inf')
-                s[b, :, ncols[b]:] = -float('inf')
-
-        if self.batched_operation:
-            log_s = s
-
-            for i in range(self.max_iter):
-                if i % 2 == 0:
-                    log_sum = torch.logsumexp(log_s, 2, keepdim=True)
-                    log_s = log_s - log_sum
-                    log_s[torch.isnan(log_s)] = -float('inf')
-                else:
-                    log_sum = torch.logsumexp(log_s, 1, keepdim=True)
-                    log_s = log_s - log_sum
-                    log_s[torch.isnan(log_s)] = -float('inf')
-
-                # ret_log_s[b, row_slice, col_slice] = log_s
-
-            if dummy_row and dummy_shape[1] > 0:
-                log_s = log_s[:, :-dummy_shape[1]]
-                for b in range(batch_size):
-                    log_s[b, ori_nrows[b]:nrows[b], :ncols[b]] = -float('inf')
-
-            if matrix_input:
-                log_s.squeeze_(0)
-
-            return torch.exp(log_s)
-        else:
-            ret_log_s = torch.full((batch_size, s.shape[1], s.shape[2]), -float('inf'), device=s.device, dtype=s.dtype)
-
-            for b in range(batch_size):
-                row_slice = slice(0, nrows[b])
-                col_slice = slice(0, ncols[b])
-                log_s = s[b, row_slice, col_slice]
 
-                for i in range(self.max_iter):
-                    if i % 2 == 0:
-                        log_sum = torch.logsumexp(log_s, 1, keepdim=True)
-                        log_s = log_s - log_sum
-                    else:
-                        log_sum = torch.logsumexp(log_s, 0, keepdim=True)
-                        log_s = log_s - log_sum
+        row_range = torch.arange(s.shape[1], device=device).unsqueeze(0)
+        col_range = torch.arange(s.shape[2], device=device).unsqueeze(0)
+        row_mask = row_range < nrows.unsqueeze(1)  # b x n1
+        col_mask = col_range < ncols.unsqueeze(1)  # b x n2
+        mask = row_mask.unsqueeze(2) & col_mask.unsqueeze(1)
 
-                ret_log_s[b, row_slice, col_slice] = log_s
-
-            if dummy_row:
-                if dummy_shape[1] > 0:
-                    ret_log_s = ret_log_s[:, :-dummy_shape[1]]
-                for b in range(batch_size):
-                    ret_log_s[b, ori_nrows[b]:nrows[b], :ncols[b]] = -float('inf')
-
-            if transposed:
-                ret_log_s = ret_log_s.transpose(1, 2)
-            if matrix_input:
-                ret_log_s.squeeze_(0)
+        if dummy_row:
+            dummy_mask = (row_range >= ori_nrows.unsqueeze(1)).unsqueeze(2) & mask
+            s = s.masked_fill(dummy_mask, -100)
+
+        log_s = s.masked_fill(~mask, -float('inf'))
+
+        backward_mode = self.backward_mode
+        if backward_mode == 'implicit' and log_s.requires_grad and not dummy_row and torch.any(nrows != ncols):
+            # non-square instances have no doubly-stochastic fixed point, and the implicit gradient would be wrong
+            backward_mode = 'checkpoint'
+
+        if backward_mode == 'implicit' and log_s.requires_grad:
+            log_s, iter_num = SinkhornImplicit.apply(log_s, row_mask, col_mask, self.max_iter, self.tol)
+        elif backward_mode == 'checkpoint' and log_s.requires_grad:
+            iter_num_list = []
+            def iterate(_log_s):
+                _log_s, _iter_num = _sinkhorn_log_iter(_log_s, row_mask, col_mask, self.max_iter, self.tol)
+                iter_num_list.append(_iter_num)
+                return _log_s
+            log_s = checkpoint(iterate, log_s)
+            iter_num = iter_num_list[0]
+        else:
+            log_s, iter_num = _sinkhorn_log_iter(log_s, row_mask, col_mask, self.max_iter, self.tol)
+        self.iter_num = iter_num
 
-            return torch.exp(ret_log_s)
+        if dummy_row:
+            log_s = log_s[:, :ori_rows]
+            log_s = log_s.masked_fill(~(row_range[:, :ori_rows] < ori_nrows.unsqueeze(1)).unsqueeze(2), -float('inf'))
 
-        # ret_log_s = torch.full((batch_size, s.shape[1], s.shape[2]), -float('inf'), device=s.device, dtype=s.dtype)
+        if transposed:
+            log_s = log_s.transpose(1, 2)
+        if matrix_input:
+            log_s = log_s.squeeze(0)
 
-        # for b in range(batch_size):
-        #    row_slice = slice(0, nrows[b])
-        #    col_slice = slice(0, ncols[b])
-        #    log_s = s[b, row_slice, col_slice]
+        return torch.exp(log_s)
 
     def forward_ori(self, s, nrows=None, ncols=None, dummy_row=False):
         r"""
@@ -271,6 +270,96 @@ class Sinkhorn(nn.Module):
         return s
 
 
+def _sinkhorn_log_iter(log_s: Tensor, row_mask: Tensor, col_mask: Tensor, max_iter: int, tol: float):
+    r"""
+    Alternating row/column normalization in the log space. Entries out of ``row_mask``/``col_mask`` should be ``-inf``.
+
+    :param log_s: :math:`(b\times n_1 \times n_2)` input matrix in log space
+    :param row_mask: :math:`(b\times n_1)` bool mask of valid rows
+    :param col_mask: :math:`(b\times n_2)` bool mask of valid columns
+    :param max_iter: maximum iterations
+    :param tol: tolerance of the row-wise marginal error (``0`` for no early stopping)
+    :return: normalized ``log_s``, :math:`(b)` number of iterations performed by each instance
+    """
+    batch_size = log_s.shape[0]
+
+    # padded rows/columns contain only -inf. They are filled with zeros before logsumexp to keep both the forward
+    # and the backward pass free of nan
+    row_pad = ~row_mask.unsqueeze(2)
+    col_pad = ~col_mask.unsqueeze(1)
+
+    active = torch.ones(batch_size, dtype=torch.bool, device=log_s.device)
+    iter_num = torch.zeros(batch_size, dtype=torch.long, device=log_s.device)
+    for i in range(max_iter):
+        if i % 2 == 0:
+            log_sum = torch.logsumexp(log_s.masked_fill(row_pad, 0), 2, keepdim=True)
+            if tol > 0 and i > 0:
+                err = torch.abs(torch.exp(log_sum) - 1).masked_fill(row_pad, 0)
+                active = active & (torch.max(err.view(batch_size, -1), dim=1).values >= tol)
+                if not torch.any(active):
+                    break
+        else:
+            log_sum = torch.logsumexp(log_s.masked_fill(col_pad, 0), 1, keepdim=True)
+        log_s = torch.where(active.view(-1, 1, 1), log_s - log_sum, log_s)
+        iter_num = iter_num + active.to(iter_num.dtype)
+
+    return log_s, iter_num
+
+
+class SinkhornImplicit(Function):
+    r"""
+    Log-space Sinkhorn iterations whose backward pass is derived by the implicit function theorem at the fixed point.
+
+    Denote :math:`\mathbf{P}=\exp(\mathbf{s} + \mathbf{f}\mathbf{1}^\top + \mathbf{1}\mathbf{g}^\top)` as the
+    output with fixed row and column marginals. Given :math:`\mathbf{G}=\partial L / \partial \log\mathbf{P}`, the
+    gradient w.r.t. the input is
+
+    .. math::
+        \frac{\partial L}{\partial \mathbf{s}} = \mathbf{G} - \mathbf{P} \odot
+        (\boldsymbol{\lambda}\mathbf{1}^\top + \mathbf{1}\boldsymbol{\mu}^\top)
+
+    where :math:`[\boldsymbol{\lambda}; \boldsymbol{\mu}]` solves the (singular but consistent) linear system
+    :math:`\begin{bmatrix}\mathrm{diag}(\mathbf{P}\mathbf{1}) & \mathbf{P} \\ \mathbf{P}^\top &
+    \mathrm{diag}(\mathbf{P}^\top\mathbf{1})\end{bmatrix} \begin{bmatrix}\boldsymbol{\lambda} \\
+    \boldsymbol{\mu}\end{bmatrix} = \begin{bmatrix}\mathbf{G}\mathbf{1} \\ \mathbf{G}^\top\mathbf{1}
+    \end{bmatrix}`. It is solved through the Schur complement on :math:`\boldsymbol{\mu}`.
+
+    No intermediate result of the iterations is kept for backward, therefore the memory cost does not grow with the
+    number of iterations.
+
+    .. note::
+        The gradient is exact only if the iterations are converged. Non-square instances (:math:`n_1 \neq n_2` without
+        dummy rows) do not have a doubly-stochastic fixed point, and :class:`Sinkhorn` falls back to the checkpointed
+        backward for them.
+    """
+    @staticmethod
+    def forward(ctx, log_s: Tensor, row_mask: Tensor, col_mask: Tensor, max_iter: int, tol: float):
+        log_s, iter_num = _sinkhorn_log_iter(log_s, row_mask, col_mask, max_iter, tol)
+        ctx.save_for_backward(log_s, row_mask, col_mask)
+        ctx.mark_non_differentiable(iter_num)
+        return log_s, iter_num
+
+    @staticmethod
+    def backward(ctx, grad_log_s, grad_iter_num):
+        log_s, row_mask, col_mask = ctx.saved_tensors
+        mask = row_mask.unsqueeze(2) & col_mask.unsqueeze(1)
+        P = torch.exp(log_s)
+        G = grad_log_s.masked_fill(~mask, 0)
+
+        # padded rows/columns are decoupled by unit diagonals, their solutions are zeros
+        row_sum = torch.where(row_mask, P.sum(2), torch.ones_like(row_mask, dtype=P.dtype))
+        col_sum = torch.where(col_mask, P.sum(1), torch.ones_like(col_mask, dtype=P.dtype))
+        PtD = P.transpose(1, 2) / row_sum.unsqueeze(1)
+        col_maskf = col_mask.to(P.dtype)
+        schur = torch.diag_embed(col_sum) - torch.bmm(PtD, P) + col_maskf.unsqueeze(2) * col_maskf.unsqueeze(1)
+        rhs = G.sum(1) - torch.bmm(PtD, G.sum(2).unsqueeze(2)).squeeze(2)
+        mu = torch.linalg.solve(schur, rhs.unsqueeze(2)).squeeze(2)
+        lam = (G.sum(2) - torch.bmm(P, mu.unsqueeze(2)).squeeze(2)) / row_sum
+
+        grad = G - P * (lam.unsqueeze(2) + mu.unsqueeze(1))
+        return grad, None, None, None, None
+
+
 class GumbelSinkhorn(nn.Module):
     """
     Gumbel Sinkhorn Layer turns the input matrix into a bi-stochastic matrix.
@@ -280,8 +369,7 @@ class GumbelSinkhorn(nn.Module):
     :param max_iter: maximum iterations (default: ``10``)
     :param tau: the hyper parameter :math:`\tau` controlling the temperature (default: ``1``)
     :param epsilon: a small number for numerical stability (default: ``1e-4``)
-    :param batched_operation: apply batched_operation for better efficiency (but may cause issues for back-propagation,
-     default: ``False``)
+    :param batched_operation: kept for backward compatibility (default: ``False``)
 
     .. note::
         This module only supports log-scale Sinkhorn operation.
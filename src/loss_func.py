@@ -3,6 +3,34 @@ import torch.nn as nn
 import torch.nn.functional as F
 from src.lap_solvers.hungarian import hungarian
 from torch import Tensor
+from src.utils.amp import float32
+from src.utils.config import cfg
+
+
+def _valid_mask(x: Tensor, src_ns: Tensor, tgt_ns: Tensor) -> Tensor:
+    r"""
+    :param x: :math:`(b\times n_1 \times n_2)` batched matrices
+    :param src_ns: :math:`(b)` number of exact nodes in the first graph
+    :param tgt_ns: :math:`(b)` number of exact nodes in the second graph
+    :return: :math:`(b\times n_1 \times n_2)` mask of the valid (non-padded) entries
+    """
+    row_mask = torch.arange(x.shape[1], device=x.device).unsqueeze(0) < src_ns.to(x.device).unsqueeze(1)
+    col_mask = torch.arange(x.shape[2], device=x.device).unsqueeze(0) < tgt_ns.to(x.device).unsqueeze(1)
+    return row_mask.unsqueeze(2) & col_mask.unsqueeze(1)
+
+
+def _check_range(*xs: Tensor):
+    """
+    Check if all inputs are in the range of [0, 1]. This check synchronizes with the device, therefore it is only
+    enabled if ``cfg.DEBUG`` is set.
+    """
+    if cfg.DEBUG:
+        for x in xs:
+            try:
+                assert torch.all((x >= 0) * (x <= 1))
+            except AssertionError as err:
+                print(x)
+                raise err
 
 
 class PermutationLoss(nn.Module):
@@ -23,6 +51,7 @@ class PermutationLoss(nn.Module):
     def __init__(self):
         super(PermutationLoss, self).__init__()
 
+    @float32
     def forward(self, pred_dsmat: Tensor, gt_perm: Tensor, src_ns: Tensor, tgt_ns: Tensor) -> Tensor:
         r"""
         :param pred_dsmat: :math:`(b\times n_1 \times n_2)` predicted doubly-stochastic matrix :math:`(\mathbf{S})`
@@ -35,26 +64,18 @@ class PermutationLoss(nn.Module):
             We support batched instances with different number of nodes, therefore ``src_ns`` and ``tgt_ns`` are
             required to specify the exact number of nodes of each instance in the batch.
         """
-        batch_num = pred_dsmat.shape[0]
-
         pred_dsmat = pred_dsmat.to(dtype=torch.float32)
+        gt_perm = gt_perm.to(dtype=torch.float32)
+
+        _check_range(pred_dsmat, gt_perm)
 
-        try:
-            assert torch.all((pred_dsmat >= 0) * (pred_dsmat <= 1))
-            assert torch.all((gt_perm >= 0) * (gt_perm <= 1))
-        except AssertionError as err:
-            print(pred_dsmat)
-            raise err
-
-        loss = torch.tensor(0.).to(pred_dsmat.device)
-        n_sum = torch.zeros_like(loss)
-        for b in range(batch_num):
-            batch_slice = [b, slice(src_ns[b]), slice(tgt_ns[b])]
-            loss += F.binary_cross_entropy(
-                pred_dsmat[batch_slice],
-                gt_perm[batch_slice],
-                reduction='sum')
-            n_sum += src_ns[b].to(n_sum.dtype).to(pred_dsmat.device)
+        # the padded entries are set to zero, whose loss is exactly zero
+        mask = _valid_mask(pred_dsmat, src_ns, tgt_ns)
+        loss = F.binary_cross_entropy(
+            torch.where(mask, pred_dsmat, torch.zeros_like(pred_dsmat)),
+            torch.where(mask, gt_perm, torch.zeros_like(gt_perm)),
+            reduction='sum')
+        n_sum = torch.sum(src_ns).to(device=pred_dsmat.device, dtype=loss.dtype)
 
         return loss / n_sum
 
@@ -74,6 +95,7 @@ class CrossEntropyLoss(nn.Module):
     def __init__(self):
         super(CrossEntropyLoss, self).__init__()
 
+    @float32
     def forward(self, pred_dsmat: Tensor, gt_perm: Tensor, src_ns: Tensor, tgt_ns: Tensor) -> Tensor:
         r"""
         :param pred_dsmat: :math:`(b\times n_1 \times n_2)` predicted doubly-stochastic matrix :math:`(\mathbf{S})`
@@ -86,27 +108,17 @@ class CrossEntropyLoss(nn.Module):
             We support batched instances with different number of nodes, therefore ``src_ns`` and ``tgt_ns`` are
             required to specify the exact number of nodes of each instance in the batch.
         """
-        batch_num = pred_dsmat.shape[0]
-
         pred_dsmat = pred_dsmat.to(dtype=torch.float32)
 
-        try:
-            assert torch.all((pred_dsmat >= 0) * (pred_dsmat <= 1))
-            assert torch.all((gt_perm >= 0) * (gt_perm <= 1))
-        except AssertionError as err:
-            print(pred_dsmat)
-            raise err
-
-        loss = torch.tensor(0.).to(pred_dsmat.device)
-        n_sum = torch.zeros_like(loss)
-        for b in range(batch_num):
-            batch_slice = [b, slice(src_ns[b]), slice(tgt_ns[b])]
-            gt_index = torch.max(gt_perm[batch_slice], dim=-1).indices
-            loss += F.nll_loss(
-                torch.log(pred_dsmat[batch_slice]),
-                gt_index,
-                reduction='sum')
-            n_sum += src_ns[b].to(n_sum.dtype).to(pred_dsmat.device)
+        _check_range(pred_dsmat, gt_perm)
+
+        mask = _valid_mask(pred_dsmat, src_ns, tgt_ns)
+        row_mask = mask[:, :, 0]
+        gt_index = torch.max(torch.where(mask, gt_perm, torch.zeros_like(gt_perm)), dim=-1, keepdim=True).indices
+        pred_gt = torch.gather(pred_dsmat, -1, gt_index).squeeze(-1)
+        # the padded rows are set to one, whose loss is exactly zero
+        loss = -torch.sum(torch.log(torch.where(row_mask, pred_gt, torch.ones_like(pred_gt))))
+        n_sum = torch.sum(src_ns).to(device=pred_dsmat.device, dtype=loss.dtype)
 
         return loss / n_sum
 
@@ -138,6 +150,7 @@ class PermutationLossHung(nn.Module):
     def __init__(self):
         super(PermutationLossHung, self).__init__()
 
+    @float32
     def forward(self, pred_dsmat: Tensor, gt_perm: Tensor, src_ns: Tensor, tgt_ns: Tensor) -> Tensor:
         r"""
         :param pred_dsmat: :math:`(b\times n_1 \times n_2)` predicted doubly-stochastic matrix :math:`(\mathbf{S})`
@@ -150,24 +163,17 @@ class PermutationLossHung(nn.Module):
             We support batched instances with different number of nodes, therefore ``src_ns`` and ``tgt_ns`` are
             required to specify the exact number of nodes of each instance in the batch.
         """
-        batch_num = pred_dsmat.shape[0]
-
-        assert torch.all((pred_dsmat >= 0) * (pred_dsmat <= 1))
-        assert torch.all((gt_perm >= 0) * (gt_perm <= 1))
+        _check_range(pred_dsmat, gt_perm)
 
         dis_pred = hungarian(pred_dsmat, src_ns, tgt_ns)
         ali_perm = dis_pred + gt_perm
         ali_perm[ali_perm > 1.0] = 1.0 # Hung
+        # the padded entries are also masked out by ali_perm
+        ali_perm = ali_perm * _valid_mask(pred_dsmat, src_ns, tgt_ns).to(ali_perm.dtype)
         pred_dsmat = torch.mul(ali_perm, pred_dsmat)
         gt_perm = torch.mul(ali_perm, gt_perm)
-        loss = torch.tensor(0.).to(pred_dsmat.device)
-        n_sum = torch.zeros_like(loss)
-        for b in range(batch_num):
-            loss += F.binary_cross_entropy(
-                pred_dsmat[b, :src_ns[b], :tgt_ns[b]],
-                gt_perm[b, :src_ns[b], :tgt_ns[b]],
-                reduction='sum')
-            n_sum += src_ns[b].to(n_sum.dtype).to(pred_dsmat.device)
+        loss = F.binary_cross_entropy(pred_dsmat, gt_perm, reduction='sum')
+        n_sum = torch.sum(src_ns).to(device=pred_dsmat.device, dtype=loss.dtype)
         return loss / n_sum
 
 
@@ -191,6 +197,7 @@ class OffsetLoss(nn.Module):
         self.epsilon = epsilon
         self.norm = norm
 
+    @float32
     def forward(self, d1: Tensor, d2: Tensor, mask: float=None) -> Tensor:
         """
         :param d1: predicted displacement matrix
@@ -236,6 +243,7 @@ class FocalLoss(nn.Module):
         self.gamma = gamma
         self.eps = eps
 
+    @float32
     def forward(self, pred_dsmat: Tensor, gt_perm: Tensor, src_ns: Tensor, tgt_ns: Tensor) -> Tensor:
         r"""
         :param pred_dsmat: :math:`(b\times n_1 \times n_2)` predicted doubly-stochastic matrix :math:`(\mathbf{S})`
@@ -248,23 +256,18 @@ class FocalLoss(nn.Module):
             We support batched instances with different number of nodes, therefore ``src_ns`` and ``tgt_ns`` are
             required to specify the exact number of nodes of each instance in the batch.
         """
-        batch_num = pred_dsmat.shape[0]
-
         pred_dsmat = pred_dsmat.to(dtype=torch.float32)
 
-        assert torch.all((pred_dsmat >= 0) * (pred_dsmat <= 1))
-        assert torch.all((gt_perm >= 0) * (gt_perm <= 1))
+        _check_range(pred_dsmat, gt_perm)
 
-        loss = torch.tensor(0.).to(pred_dsmat.device)
-        n_sum = torch.zeros_like(loss)
-        for b in range(batch_num):
-            x = pred_dsmat[b, :src_ns[b], :tgt_ns[b]]
-            y = gt_perm[b, :src_ns[b], :tgt_ns[b]]
-            loss += torch.sum(
-                - (1 - x) ** self.gamma * y * torch.log(x + self.eps)
-                - x ** self.gamma * (1 - y) * torch.log(1 - x + self.eps)
-            )
-            n_sum += src_ns[b].to(n_sum.dtype).to(pred_dsmat.device)
+        # the padded entries are replaced by a safe value before computing, to avoid nan gradients
+        mask = _valid_mask(pred_dsmat, src_ns, tgt_ns)
+        x = torch.where(mask, pred_dsmat, torch.full_like(pred_dsmat, 0.5))
+        y = gt_perm
+        loss = - (1 - x) ** self.gamma * y * torch.log(x + self.eps) \
+               - x ** self.gamma * (1 - y) * torch.log(1 - x + self.eps)
+        loss = torch.sum(torch.where(mask, loss, torch.zeros_like(loss)))
+        n_sum = torch.sum(src_ns).to(device=pred_dsmat.device, dtype=loss.dtype)
 
         return loss / n_sum
 
@@ -284,6 +287,7 @@ class InnerProductLoss(nn.Module):
     def __init__(self):
         super(InnerProductLoss, self).__init__()
 
+    @float32
     def forward(self, pred_dsmat: Tensor, gt_perm: Tensor, src_ns: Tensor, tgt_ns: Tensor) -> Tensor:
         r"""
         :param pred_dsmat: :math:`(b\times n_1 \times n_2)` predicted doubly-stochastic matrix :math:`(\mathbf{S})`
@@ -296,21 +300,13 @@ class InnerProductLoss(nn.Module):
             We support batched instances with different number of nodes, therefore ``src_ns`` and ``tgt_ns`` are
             required to specify the exact number of nodes of each instance in the batch.
         """
-        batch_num = pred_dsmat.shape[0]
-
         pred_dsmat = pred_dsmat.to(dtype=torch.float32)
 
-        try:
-            assert torch.all((gt_perm >= 0) * (gt_perm <= 1))
-        except AssertionError as err:
-            raise err
+        _check_range(gt_perm)
 
-        loss = torch.tensor(0.).to(pred_dsmat.device)
-        n_sum = torch.zeros_like(loss)
-        for b in range(batch_num):
-            batch_slice = [b, slice(src_ns[b]), slice(tgt_ns[b])]
-            loss -= torch.sum(pred_dsmat[batch_slice] * gt_perm[batch_slice])
-            n_sum += src_ns[b].to(n_sum.dtype).to(pred_dsmat.device)
+        mask = _valid_mask(pred_dsmat, src_ns, tgt_ns)
+        loss = -torch.sum(torch.where(mask, pred_dsmat * gt_perm, torch.zeros_like(pred_dsmat)))
+        n_sum = torch.sum(src_ns).to(device=pred_dsmat.device, dtype=loss.dtype)
 
         return loss / n_sum
 
@@ -335,6 +331,7 @@ class HammingLoss(torch.nn.Module):
     def __init__(self):
         super(HammingLoss, self).__init__()
 
+    @float32
     def forward(self, pred_perm: Tensor, gt_perm: Tensor) -> Tensor:
         r"""
         :param pred_perm: :math:`(b\times n_1 \times n_2)` predicted permutation matrix :math:`(\mathbf{X})`
@@ -1,3 +1,6 @@
 from .data_parallel import *
+from .distributed import DistributedDataParallel, init_distributed, is_distributed, get_rank, get_world_size, \
+    is_main_process
 
-__all__ = ['DataParallel']
+__all__ = ['DataParallel', 'DistributedDataParallel', 'init_distributed', 'is_distributed', 'get_rank',
+           'get_world_size', 'is_main_process']
@@ -0,0 +1,125 @@
+import os
+import random
+import builtins
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as _DistributedDataParallel
+
+from src.utils.config import cfg
+
+
+def init_distributed():
+    """
+    Initialize the process group from the environment variables (``RANK``, ``WORLD_SIZE``, ``LOCAL_RANK``,
+    ``MASTER_ADDR``, ``MASTER_PORT``) set by ``torchrun`` or ``python -m torch.distributed.launch --use_env``.
+    Nothing is done if ``WORLD_SIZE`` is not greater than 1.
+
+    The backend is ``cfg.DIST.BACKEND``. If not specified, ``nccl`` is used for CUDA and ``gloo`` is used for CPU, so
+    that the distributed mode can also be run by multiple local CPU processes.
+
+    :return: the device of this process
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size <= 1:
+        return torch.device('cuda:{}'.format(cfg.GPUS[0]) if torch.cuda.is_available() else 'cpu')
+
+    rank = int(os.environ['RANK'])
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if torch.cuda.is_available() and cfg.DIST.BACKEND != 'gloo':
+        device = torch.device('cuda:{}'.format(local_rank))
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device('cpu')
+    if is_distributed():
+        return device
+
+    backend = cfg.DIST.BACKEND
+    if len(backend) == 0:
+        backend = 'nccl' if device.type == 'cuda' else 'gloo'
+    dist.init_process_group(backend=backend, init_method='env://', world_size=world_size, rank=rank)
+
+    # the samples are drawn by random/np.random in the main process if there is no dataloader worker
+    random.seed(cfg.RANDOM_SEED + rank)
+    np.random.seed(cfg.RANDOM_SEED + rank)
+
+    _setup_print(rank == 0)
+    return device
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def all_gather_cat(t: torch.Tensor) -> torch.Tensor:
+    """
+    Gather the 1-d tensors (of different lengths) from all processes and concatenate them in the order of ranks.
+    """
+    if not is_distributed():
+        return t
+    world_size = get_world_size()
+    device = t.device if dist.get_backend() != 'nccl' else torch.device('cuda', torch.cuda.current_device())
+    t = t.to(device)
+    length = torch.tensor([t.shape[0]], dtype=torch.long, device=device)
+    lengths = [torch.zeros_like(length) for _ in range(world_size)]
+    dist.all_gather(lengths, length)
+    lengths = [int(l.item()) for l in lengths]
+
+    max_length = max(lengths)
+    padded = torch.zeros(max_length, dtype=t.dtype, device=device)
+    padded[:t.shape[0]] = t
+    gathered = [torch.zeros_like(padded) for _ in range(world_size)]
+    dist.all_gather(gathered, padded)
+    return torch.cat([g[:l] for g, l in zip(gathered, lengths)])
+
+
+def all_reduce_sum(t: torch.Tensor) -> torch.Tensor:
+    """
+    Sum the tensor over all processes.
+    """
+    if not is_distributed():
+        return t
+    device = t.device if dist.get_backend() != 'nccl' else torch.device('cuda', torch.cuda.current_device())
+    t = t.clone().to(device)
+    dist.all_reduce(t)
+    return t
+
+
+class DistributedDataParallel(_DistributedDataParallel):
+    """
+    DistributedDataParallel wrapper for the graph matching models.
+
+    Every process loads its own mini-batch (including the CSRMatrix3d/CSCMatrix3d objects built by the collate function)
+    and moves it to its device by :func:`~src.utils.data_to_cuda.data_to_cuda` before calling the model. Therefore, the
+    inputs are passed to the module as is, and there is no scatter/gather across devices. The gradients are
+    all-reduced in backward.
+    """
+    def __init__(self, module, **kwargs):
+        kwargs.setdefault('find_unused_parameters', cfg.DIST.FIND_UNUSED_PARAMETERS)
+        super(DistributedDataParallel, self).__init__(module, device_ids=None, **kwargs)
+
+
+def _setup_print(is_main):
+    """
+    Disable printing in the non-main processes. Printing can be forced by ``print(..., force=True)``.
+    """
+    builtin_print = builtins.print
+
+    def print(*args, **kwargs):
+        force = kwargs.pop('force', False)
+        if is_main or force:
+            builtin_print(*args, **kwargs)
+
+    builtins.print = print
@@ -1,6 +1,7 @@
 import torch
 import torch.nn.parallel.scatter_gather as torch_
 from src.sparse_torch import CSRMatrix3d, CSCMatrix3d, concatenate
+from src.factorize_graph_matching import KroneckerAffinity
 
 
 def scatter(inputs, target_gpus, dim=0):
@@ -20,7 +21,7 @@ def scatter(inputs, target_gpus, dim=0):
             return list(map(type(obj), zip(*map(scatter_map, obj.items()))))
 
         # modified here
-        if isinstance(obj, CSRMatrix3d) or isinstance(obj, CSCMatrix3d):
+        if isinstance(obj, CSRMatrix3d) or isinstance(obj, CSCMatrix3d) or isinstance(obj, KroneckerAffinity):
             return scatter_sparse_matrix(target_gpus, obj)
 
         return [obj for targets in target_gpus]
@@ -53,8 +54,10 @@ def scatter_sparse_matrix(target_gpus, obj):
     """Scatter for customized sparse matrix"""
     def get_device(i):
         return torch.device('cuda:{}'.format(i)) if i != -1 else torch.device('cpu')
-    step = len(obj) // len(target_gpus)
-    return tuple([obj[i:i+step].to(get_device(i // step)) for i in range(0, len(obj), step)])
+    # same chunk sizes as torch.Tensor.chunk, the last chunk may be smaller and there may be fewer chunks than GPUs
+    step = (len(obj) + len(target_gpus) - 1) // len(target_gpus)
+    return tuple([obj[i:min(i+step, len(obj))].to(get_device(target_gpus[i // step]))
+                  for i in range(0, len(obj), step)])
 
 
 def gather(outputs, target_device, dim=0):
@@ -69,6 +72,8 @@ def gather(outputs, target_device, dim=0):
         # modified here
         if isinstance(out, CSRMatrix3d) or isinstance(out, CSCMatrix3d):
             return concatenate(*outputs, device=target_device)
+        if isinstance(out, KroneckerAffinity):
+            return KroneckerAffinity.concatenate(*outputs, device=target_device)
 
         if out is None:
             return None
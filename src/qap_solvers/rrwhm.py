@@ -8,54 +8,105 @@ class RRWHM(nn.Module):
     """
     RRWHM solver for hyper graph matching, implemented by tensor power iteration with Sinkhorn reweighted jumps.
     Parameter: maximum iteration max_iter
-    Input: input tensor H
+               convergence is checked every check_freq iterations, and the converged instances are removed from the
+               batch. A larger check_freq means less host-device synchronization.
+    Input: input tensor H, which is a dense tensor, a sparse COO tensor or a tuple (indices, values) of the non-zero
+           hyperedge affinities. indices is a ((order + 1) x nnz) tensor of (batch, x, y, ...) and values is (nnz).
            maximum size of source graph num_src
            sizes of source graph in batch ns_src
            sizes of target graph in batch ns_tgt
-           (optional) initialization vector v0. If not specified, v0 will be initialized with all 1.
+           (optional) initialization vector v0. If not specified, v0 will be initialized uniformly over the valid
+           (non-padded) entries.
     Output: computed eigenvector v
+
+    The tensor-vector contractions are computed by gather and scatter-add over the non-zero elements, which costs
+    O(order * nnz) per iteration instead of O((n1n2)^order) of the dense tensor.
     """
-    def __init__(self, max_iter=50, sk_iter=20, alpha=0.2, beta=30):
+    def __init__(self, max_iter=50, sk_iter=20, alpha=0.2, beta=30, stop_thresh=1e-5, check_freq=5):
         super(RRWHM, self).__init__()
         self.max_iter = max_iter
         self.alpha = alpha
         self.beta = beta
-        self.sk = Sinkhorn(max_iter=sk_iter,log_forward=False)
+        self.stop_thresh = stop_thresh
+        self.check_freq = check_freq
+        self.sk = Sinkhorn(max_iter=sk_iter, tau=1.)
 
     def forward(self, H, num_src, ns_src, ns_tgt, v0=None):
-        order = len(H.shape) - 1
-        sum_dims = [i+2 for i in range(order-1)]
-        d = H.sum(dim=sum_dims, keepdim=True)
-        dmax = d.max(dim=1, keepdim=True).values
-        H = H / dmax
-
-        batch_num = H.shape[0]
-        mn = H.shape[1]
-        if v0 is None:
-            v0 = torch.zeros(batch_num, num_src, mn // num_src, dtype=H.dtype, device=H.device)
-            for b in range(batch_num):
-                v0[b, 0:ns_src[b], 0:ns_tgt[b]] = torch.tensor(1.) / (ns_src[b] * ns_tgt[b])
+        if type(H) is tuple:
+            H_ind, H_val = H
+            batch_num = ns_src.shape[0]
+            mn = v0.shape[1] if v0 is not None else num_src * int(torch.max(ns_tgt))
+        else:
+            if not H.is_sparse:
+                H = H.to_sparse()
+            H_ind, H_val = H._indices(), H._values()
+            batch_num, mn = H.shape[0], H.shape[1]
+        order = H_ind.shape[0] - 1
+        dtype, device = H_val.dtype, H_val.device
+
+        # normalize H by its maximum row sum
+        d = torch.zeros(batch_num * mn, dtype=dtype, device=device).index_add(0, H_ind[0] * mn + H_ind[1], H_val)
+        dmax = d.view(batch_num, mn).max(dim=1).values
+        H_val = H_val / dmax[H_ind[0]]
 
+        if v0 is None:
+            row_mask = torch.arange(num_src, device=device).unsqueeze(0) < ns_src.unsqueeze(1)
+            col_mask = torch.arange(mn // num_src, device=device).unsqueeze(0) < ns_tgt.unsqueeze(1)
+            v0 = (row_mask.unsqueeze(2) & col_mask.unsqueeze(1)).to(dtype)
+            v0 = v0 / (ns_src * ns_tgt).to(dtype).view(-1, 1, 1)
             v0 = v0.transpose(1, 2).reshape(batch_num, mn, 1)
 
+        # active set of the batch, the converged instances are written to v_out
+        v_out = v0
+        active = torch.arange(batch_num, device=device)
         v = v0
         for i in range(self.max_iter):
-            H_red = H.unsqueeze(-1)
-            for o in range(order - 1):
-                v_shape = [v.shape[0]] + [1] * (order - 1 - o) + list(v.shape[1:])
-                H_red = torch.sum(torch.mul(H_red, v.view(*v_shape)), dim=-2)
-            v = H_red
+            v = self._contract(H_ind, H_val, v, order)
             last_v = v
             n = torch.norm(v, p=1, dim=1, keepdim=True)
             v = v / n
-            s = v.view(batch_num, -1, num_src).transpose(1, 2)
-            s = torch.exp(self.beta * s / s.max(dim=1, keepdim=True).values.max(dim=2, keepdim=True).values)
+            s = v.view(v.shape[0], -1, num_src).transpose(1, 2)
+            s = self.beta * s / s.max(dim=1, keepdim=True).values.max(dim=2, keepdim=True).values
 
-            v = self.alpha * self.sk(s, ns_src, ns_tgt).transpose(1, 2).reshape(batch_num, mn, 1) + (1 - self.alpha) * v
+            # Sinkhorn in the log space, which is batched and equivalent to Sinkhorn(exp(s))
+            v = self.alpha * self.sk(s, ns_src, ns_tgt).transpose(1, 2).reshape(v.shape[0], mn, 1) + (1 - self.alpha) * v
             n = torch.norm(v, p=1, dim=1, keepdim=True)
             v = torch.matmul(v, 1 / n)
 
-            if torch.norm(v - last_v) < 1e-5:
-                break
+            if (i + 1) % self.check_freq == 0 or i == self.max_iter - 1:
+                v_out = v_out.index_copy(0, active, v)
+                converged = torch.norm((v - last_v).view(v.shape[0], -1), dim=1) < self.stop_thresh
+                remain = torch.nonzero(~converged, as_tuple=False).view(-1)
+                if remain.shape[0] == 0:
+                    break
+                elif remain.shape[0] < v.shape[0]:
+                    active = active[remain]
+                    H_ind, H_val = self._select(H_ind, H_val, remain, v.shape[0])
+                    v, ns_src, ns_tgt = v[remain], ns_src[remain], ns_tgt[remain]
+
+        return v_out.view(batch_num, -1)
+
+    @staticmethod
+    def _contract(H_ind, H_val, v, order):
+        """
+        Tensor-vector contraction H v ... v (order - 1 times) over the non-zero elements of H.
+        """
+        batch_num, mn = v.shape[0], v.shape[1]
+        v_flat = v.reshape(-1)
+        offset = H_ind[0] * mn
+        prod = H_val
+        for o in range(2, order + 1):
+            prod = prod * v_flat[offset + H_ind[o]]
+        H_red = torch.zeros(batch_num * mn, dtype=prod.dtype, device=prod.device).index_add(0, offset + H_ind[1], prod)
+        return H_red.view(batch_num, mn, 1)
 
-        return v.view(batch_num, -1)
+    @staticmethod
+    def _select(H_ind, H_val, batch_idx, batch_num):
+        """
+        Select the non-zero elements of the instances in batch_idx, and re-index the batch.
+        """
+        new_idx = torch.full((batch_num,), -1, dtype=torch.long, device=H_ind.device)
+        new_idx[batch_idx] = torch.arange(batch_idx.shape[0], device=H_ind.device)
+        new_batch = new_idx[H_ind[0]]
+        keep = new_batch >= 0
+        return torch.cat((new_batch[keep].unsqueeze(0), H_ind[1:, keep])), H_val[keep]
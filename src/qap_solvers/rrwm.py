@@ -2,54 +2,74 @@ import torch
 import torch.nn as nn
 
 from src.lap_solvers.sinkhorn import Sinkhorn as Sinkhorn
+from src.utils.sparse import batch_matvec, batch_select
 
 
 class RRWM(nn.Module):
     """
     RRWM solver for graph matching (QAP), implemented by power iteration with Sinkhorn reweighted jumps.
     Parameter: maximum iteration max_iter
-    Input: input matrix M
+               convergence is checked every check_freq iterations, and the converged instances are removed from the
+               batch. A larger check_freq means less host-device synchronization.
+    Input: input matrix M, which is a dense tensor, a sparse tensor or a lazy operator with matvec (e.g.
+           FactorizedAffinity)
            maximum size of source graph num_src
            sizes of source graph in batch ns_src
            sizes of target graph in batch ns_tgt
            (optional) initialization vector v0. If not specified, v0 will be initialized with all 1.
     Output: computed eigenvector v
     """
-    def __init__(self, max_iter=50, sk_iter=20, alpha=0.2, beta=30):
+    def __init__(self, max_iter=50, sk_iter=20, alpha=0.2, beta=30, stop_thresh=1e-5, check_freq=5):
         super(RRWM, self).__init__()
         self.max_iter = max_iter
         self.alpha = alpha
         self.beta = beta
+        self.stop_thresh = stop_thresh
+        self.check_freq = check_freq
         self.sk = Sinkhorn(max_iter=sk_iter,log_forward=False)
 
     def forward(self, M, num_src, ns_src, ns_tgt, v0=None):
-        d = M.sum(dim=2, keepdim=True)
-        dmax = d.max(dim=1, keepdim=True).values
-        M = M / (dmax + d.min() * 1e-5)
-
         batch_num = M.shape[0]
         mn = M.shape[1]
-        if v0 is None:
-            v0 = torch.zeros(batch_num, num_src, mn // num_src, dtype=M.dtype, device=M.device)
-            for b in range(batch_num):
-                v0[b, 0:ns_src[b], 0:ns_tgt[b]] = torch.tensor(1.) / (ns_src[b] * ns_tgt[b])
+        dtype, device = (M.dtype, M.device)
 
+        # normalize M by its maximum row sum, which is applied to M @ v instead of M
+        d = batch_matvec(M, torch.ones(batch_num, mn, 1, dtype=dtype, device=device))
+        dmax = d.max(dim=1, keepdim=True).values
+        scale = 1 / (dmax + d.min() * 1e-5)
+
+        if v0 is None:
+            row_mask = torch.arange(num_src, device=device).unsqueeze(0) < ns_src.unsqueeze(1)
+            col_mask = torch.arange(mn // num_src, device=device).unsqueeze(0) < ns_tgt.unsqueeze(1)
+            v0 = (row_mask.unsqueeze(2) & col_mask.unsqueeze(1)).to(dtype)
+            v0 = v0 / (ns_src * ns_tgt).to(dtype).view(-1, 1, 1)
             v0 = v0.transpose(1, 2).reshape(batch_num, mn, 1)
 
+        # active set of the batch, the converged instances are written to v_out
+        v_out = v0
+        active = torch.arange(batch_num, device=device)
         v = v0
         for i in range(self.max_iter):
-            v = torch.bmm(M, v)
+            v = batch_matvec(M, v) * scale
             last_v = v
             n = torch.norm(v, p=1, dim=1, keepdim=True)
             v = v / n
-            s = v.view(batch_num, -1, num_src).transpose(1, 2)
+            s = v.view(v.shape[0], -1, num_src).transpose(1, 2)
             s = torch.exp(self.beta * s / s.max(dim=1, keepdim=True).values.max(dim=2, keepdim=True).values)
 
-            v = self.alpha * self.sk(s, ns_src, ns_tgt).transpose(1, 2).reshape(batch_num, mn, 1) + (1 - self.alpha) * v
+            v = self.alpha * self.sk(s, ns_src, ns_tgt).transpose(1, 2).reshape(v.shape[0], mn, 1) + (1 - self.alpha) * v
             n = torch.norm(v, p=1, dim=1, keepdim=True)
             v = torch.matmul(v, 1 / n)
 
-            if torch.norm(v - last_v) < 1e-5:
-                break
+            if (i + 1) % self.check_freq == 0 or i == self.max_iter - 1:
+                v_out = v_out.index_copy(0, active, v)
+                converged = torch.norm((v - last_v).view(v.shape[0], -1), dim=1) < self.stop_thresh
+                remain = torch.nonzero(~converged, as_tuple=False).view(-1)
+                if remain.shape[0] == 0:
+                    break
+                elif remain.shape[0] < v.shape[0]:
+                    active = active[remain]
+                    M, v, scale = batch_select(M, remain), v[remain], scale[remain]
+                    ns_src, ns_tgt = ns_src[remain], ns_tgt[remain]
 
-        return v.view(batch_num, -1)
+        return v_out.view(batch_num, -1)
@@ -1,6 +1,6 @@
 import torch
 import torch.nn as nn
-from src.utils.sparse import sbmm
+from src.utils.sparse import batch_matvec, batch_select
 
 
 class SpectralMatching(nn.Module):
@@ -10,14 +10,18 @@ class SpectralMatching(nn.Module):
     For every iteration,
         v_k+1 = M * v_k / ||M * v_k||_2
     Parameter: maximum iteration max_iter
-    Input: input matrix M
+               convergence is checked every check_freq iterations, and the converged instances are removed from the
+               batch. A larger check_freq means less host-device synchronization.
+    Input: input matrix M, which is a dense tensor, a sparse tensor or a lazy operator with matvec (e.g.
+           FactorizedAffinity)
            (optional) initialization vector v0. If not specified, v0 will be initialized with all 1.
     Output: computed eigenvector v
     """
-    def __init__(self, max_iter=50, stop_thresh=2e-7):
+    def __init__(self, max_iter=50, stop_thresh=2e-7, check_freq=5):
         super(SpectralMatching, self).__init__()
         self.max_iter = max_iter
         self.stop_thresh = stop_thresh
+        self.check_freq = check_freq
 
     def forward(self, M, v0=None, **kwargs):
         batch_num = M.shape[0]
@@ -25,19 +29,27 @@ class SpectralMatching(nn.Module):
         if v0 is None:
             v0 = torch.ones(batch_num, mn, 1, dtype=M.dtype, device=M.device)
 
+        # active set of the batch, the converged instances are written to v_out
+        v_out = v0
+        active = torch.arange(batch_num, device=v0.device)
         v = vlast = v0
         for i in range(self.max_iter):
-            if M.is_sparse:
-                v = sbmm(M, v)
-            else:
-                v = torch.bmm(M, v)
+            v = batch_matvec(M, v)
             n = torch.norm(v, p=2, dim=1)
-            v = torch.matmul(v, (1 / n).view(batch_num, 1, 1))
-            if torch.norm(v - vlast) < self.stop_thresh:
-                return v.view(batch_num, -1)
+            v = torch.matmul(v, (1 / n).view(v.shape[0], 1, 1))
+
+            if (i + 1) % self.check_freq == 0 or i == self.max_iter - 1:
+                v_out = v_out.index_copy(0, active, v)
+                converged = torch.norm((v - vlast).view(v.shape[0], -1), dim=1) < self.stop_thresh
+                remain = torch.nonzero(~converged, as_tuple=False).view(-1)
+                if remain.shape[0] == 0:
+                    break
+                elif remain.shape[0] < v.shape[0]:
+                    active = active[remain]
+                    M, v = batch_select(M, remain), v[remain]
             vlast = v
 
-        return v.view(batch_num, -1)
+        return v_out.view(batch_num, -1)
 
 
 if __name__ == '__main__':
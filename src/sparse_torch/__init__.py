@@ -3,3 +3,4 @@ sparse matrix in pytorch implementation.
 """
 
 from .csx_matrix import CSRMatrix3d, CSCMatrix3d, dot, concatenate
+from .backend import register_backend, set_backend
@@ -0,0 +1,227 @@
+"""
+Backends of the batched CSR/CSC sparse operations.
+
+Every backend provides the following operations (see the docstrings of the ``torch`` backend for the exact signatures):
+``csr_dot_csc``, ``csr_dot_csc_dense``, ``csr_dot_diag`` and ``bilinear_diag``.
+
+Available backends:
+::
+
+    'extension': the customized C++/CUDA extension. It is compiled on its first call, and requires nvcc and ninja.
+    'torch': vectorized pure PyTorch implementation built on index_add/searchsorted. Works on any device.
+
+By default (``'auto'``), CUDA tensors are handled by ``extension`` and CPU tensors are handled by ``torch``.
+"""
+import os
+import sys
+import torch
+from torch import Tensor
+
+
+_BACKENDS = dict()
+_BACKEND_NAME = os.environ.get('SPARSE_BACKEND', 'auto')
+_EXTENSIONS = dict()
+
+
+def register_backend(name: str, ops: dict):
+    """
+    Register a new backend.
+
+    :param name: name of the backend
+    :param ops: a dict mapping operation names to functions
+    """
+    _BACKENDS[name] = ops
+
+
+def set_backend(name: str):
+    """
+    Set the global backend of sparse operations.
+
+    :param name: name of the backend, or ``'auto'``
+    """
+    global _BACKEND_NAME
+    if name != 'auto' and name not in _BACKENDS:
+        raise ValueError('Unknown sparse backend: {}'.format(name))
+    _BACKEND_NAME = name
+
+
+def get_op(op_name: str, device: torch.device):
+    """
+    Get the sparse operation implemented by the current backend.
+
+    :param op_name: name of the operation
+    :param device: device of the input tensors, used by the ``'auto'`` backend
+    :return: the function of the operation
+    """
+    if _BACKEND_NAME == 'auto':
+        name = 'extension' if device.type == 'cuda' else 'torch'
+    else:
+        name = _BACKEND_NAME
+    return _BACKENDS[name][op_name]
+
+
+def _load_extension(name: str):
+    """
+    Compile and load the customized C++/CUDA extension upon its first usage.
+    """
+    if name not in _EXTENSIONS:
+        from torch.utils.cpp_extension import load
+        if name == 'sparse_dot':
+            sources = ['src/extension/sparse_dot/sparse_dot.cpp',
+                       'src/extension/sparse_dot/csr_dot_csc_cuda.cu',
+                       'src/extension/sparse_dot/csr_dot_diag_cuda.cu']
+        elif name == 'bilinear_diag':
+            sources = ['src/extension/bilinear_diag/bilinear_diag.cpp',
+                       'src/extension/bilinear_diag/bilinear_diag_cuda.cu']
+        else:
+            raise ValueError('Unknown extension: {}'.format(name))
+        _EXTENSIONS[name] = load(name=name, sources=sources,
+                                 extra_include_paths=[
+                                     '/usr/include/python{}.{}/'.format(sys.version_info.major, sys.version_info.minor)]
+                                 )
+    return _EXTENSIONS[name]
+
+
+'''
+C++/CUDA extension backend
+'''
+
+
+def _ext_csr_dot_csc(*args):
+    if args[0].is_cuda:  # sparse output is not implemented in CUDA
+        return _torch_csr_dot_csc(*args)
+    return _load_extension('sparse_dot').csr_dot_csc(*args)
+
+
+def _ext_csr_dot_csc_dense(*args):
+    if not args[0].is_cuda:  # dense output is only implemented in CUDA
+        batch_size, out_h, out_w = args[-3:]
+        indices, indptr, data = _load_extension('sparse_dot').csr_dot_csc(*args)
+        outp = torch.zeros(batch_size * out_h * out_w, dtype=data.dtype, device=data.device)
+        outp[_expand_indptr(indptr) * out_w + indices] = data
+        return outp.view(batch_size, out_h, out_w)
+    return _load_extension('sparse_dot').csr_dot_csc_dense_cuda(*args)
+
+
+def _ext_csr_dot_diag(*args):
+    return _load_extension('sparse_dot').csr_dot_diag(*args)
+
+
+def _ext_bilinear_diag(*args):
+    return _load_extension('bilinear_diag').bilinear_diag(*args)
+
+
+register_backend('extension', {
+    'csr_dot_csc': _ext_csr_dot_csc,
+    'csr_dot_csc_dense': _ext_csr_dot_csc_dense,
+    'csr_dot_diag': _ext_csr_dot_diag,
+    'bilinear_diag': _ext_bilinear_diag,
+})
+
+
+'''
+Pure PyTorch backend
+'''
+
+
+def _expand_indptr(indptr: Tensor) -> Tensor:
+    """
+    Expand the compressed indptr into the (global) compressed index of every non-zero element.
+    """
+    return torch.repeat_interleave(torch.arange(indptr.shape[0] - 1, device=indptr.device), indptr[1:] - indptr[:-1])
+
+
+def _join_csr_csc(t1_indices, t1_indptr, t1_data, t2_indices, t2_indptr, t2_data, batch_size, out_h, out_w):
+    """
+    Match every non-zero element of the CSR matrix with the non-zero elements of the CSC matrix sharing the same inner
+    index. Returns the flattened output index (b * out_h * out_w + i * out_w + j) and the products of data.
+    """
+    inner = t1_indices.max().item() + 1 if t1_indices.numel() > 0 else 1
+    if t2_indices.numel() > 0:
+        inner = max(inner, t2_indices.max().item() + 1)
+
+    t1_row = _expand_indptr(t1_indptr)  # b * out_h + i
+    t1_key = t1_row // out_h * inner + t1_indices
+    t2_col = _expand_indptr(t2_indptr)  # b * out_w + j
+    t2_key = t2_col // out_w * inner + t2_indices
+
+    t2_key, order = torch.sort(t2_key)
+    start = torch.searchsorted(t2_key, t1_key)
+    count = torch.searchsorted(t2_key, t1_key, right=True) - start
+
+    t1_idx = torch.repeat_interleave(torch.arange(t1_key.shape[0], device=t1_key.device), count)
+    group_offset = torch.cumsum(count, dim=0) - count
+    t2_idx = order[start[t1_idx] + torch.arange(t1_idx.shape[0], device=t1_idx.device) - group_offset[t1_idx]]
+
+    out_idx = t1_row[t1_idx] * out_w + t2_col[t2_idx] % out_w
+    out_data = t1_data[t1_idx] * t2_data[t2_idx]
+    return out_idx, out_data
+
+
+def _torch_csr_dot_csc(t1_indices, t1_indptr, t1_data, t2_indices, t2_indptr, t2_data, batch_size, out_h, out_w):
+    """
+    CSR (b x out_h x k) dot CSC (b x k x out_w) -> CSR (b x out_h x out_w).
+
+    :return: indices, indptr, data of the output CSR matrix
+    """
+    out_idx, out_data = _join_csr_csc(t1_indices, t1_indptr, t1_data, t2_indices, t2_indptr, t2_data,
+                                      batch_size, out_h, out_w)
+    out_idx, inverse = torch.unique(out_idx, sorted=True, return_inverse=True)
+    data = torch.zeros(out_idx.shape[0], dtype=t1_data.dtype, device=t1_data.device).index_add_(0, inverse, out_data)
+    nonzero = data != 0
+    out_idx, data = out_idx[nonzero], data[nonzero]
+
+    row = out_idx // out_w
+    indptr = torch.zeros(batch_size * out_h + 1, dtype=torch.int64, device=t1_indptr.device)
+    indptr[1:] = torch.cumsum(torch.bincount(row, minlength=batch_size * out_h), dim=0)
+    return out_idx % out_w, indptr, data
+
+
+def _torch_csr_dot_csc_dense(t1_indices, t1_indptr, t1_data, t2_indices, t2_indptr, t2_data, batch_size, out_h, out_w):
+    """
+    CSR (b x out_h x k) dot CSC (b x k x out_w) -> dense (b x out_h x out_w).
+    """
+    out_idx, out_data = _join_csr_csc(t1_indices, t1_indptr, t1_data, t2_indices, t2_indptr, t2_data,
+                                      batch_size, out_h, out_w)
+    outp = torch.zeros(batch_size * out_h * out_w, dtype=t1_data.dtype, device=t1_data.device)
+    outp.index_add_(0, out_idx, out_data)
+    return outp.view(batch_size, out_h, out_w)
+
+
+def _torch_csr_dot_diag(t1_indices, t1_indptr, t1_data, t2, batch_size, out_h, out_w):
+    """
+    CSR (b x out_h x out_w) dot diag(t2) where t2 is (b x out_w) -> CSR (b x out_h x out_w).
+
+    :return: indices, indptr, data of the output CSR matrix
+    """
+    batch_idx = _expand_indptr(t1_indptr) // out_h
+    outp_data = t1_data * t2[batch_idx, t1_indices]
+    return t1_indices.clone(), t1_indptr.clone(), outp_data
+
+
+def _torch_bilinear_diag(t1_indices, t1_indptr, t1_data, t2, t3_indices, t3_indptr, t3_data, batch_size, xlen):
+    """
+    diag(CSR (b x xlen x y) dot dense (b x y x y) dot CSC (b x y x xlen)) -> dense (b x xlen).
+    """
+    # row i of t1 is matched with column i of t3, which are both stored in a contiguous segment
+    t1_row = _expand_indptr(t1_indptr)  # b * xlen + i
+    t3_start = t3_indptr[:-1][t1_row]
+    count = t3_indptr[1:][t1_row] - t3_start
+
+    t1_idx = torch.repeat_interleave(torch.arange(t1_row.shape[0], device=t1_row.device), count)
+    group_offset = torch.cumsum(count, dim=0) - count
+    t3_idx = t3_start[t1_idx] + torch.arange(t1_idx.shape[0], device=t1_idx.device) - group_offset[t1_idx]
+
+    row = t1_row[t1_idx]
+    batch_idx = row // xlen
+    val = t1_data[t1_idx] * t3_data[t3_idx] * t2[batch_idx, t1_indices[t1_idx], t3_indices[t3_idx]]
+    outp = torch.zeros(batch_size * xlen, dtype=t2.dtype, device=t2.device).index_add_(0, row, val.to(t2.dtype))
+    return outp.view(batch_size, xlen)
+
+
+register_backend('torch', {
+    'csr_dot_csc': _torch_csr_dot_csc,
+    'csr_dot_csc_dense': _torch_csr_dot_csc_dense,
+    'csr_dot_diag': _torch_csr_dot_diag,
+    'bilinear_diag': _torch_bilinear_diag,
+})
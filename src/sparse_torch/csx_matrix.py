@@ -1,19 +1,8 @@
-import sys
-import os
 import torch
 import numpy as np
 import scipy.sparse as ssp
 
-if 'SPHINX' not in os.environ:
-    from torch.utils.cpp_extension import load
-
-    sparse_dot = load(name='sparse_dot',
-                      sources=['src/extension/sparse_dot/sparse_dot.cpp',
-                               'src/extension/sparse_dot/csr_dot_csc_cuda.cu',
-                               'src/extension/sparse_dot/csr_dot_diag_cuda.cu'],
-                      extra_include_paths=[
-                          '/usr/include/python{}.{}/'.format(sys.version_info.major, sys.version_info.minor)]
-                      )
+from .backend import get_op
 
 
 class CSXMatrix3d:
@@ -380,7 +369,7 @@ class CSRMatrix3d(CSXMatrix3d):
         out_h = self.shape[1]
         out_w = self.shape[2]
 
-        result = sparse_dot.csr_dot_diag(*self.as_list(), other, batch_size, out_h, out_w)
+        result = get_op('csr_dot_diag', self.device)(*self.as_list(), other, batch_size, out_h, out_w)
         ret = CSRMatrix3d(result, shape=self.shape)
         '''
         indptr = self.indptr.clone()
@@ -405,7 +394,7 @@ class CSRMatrix3d(CSXMatrix3d):
 def dot(csr: CSRMatrix3d, csc: CSCMatrix3d, dense=False):
     """
     Compute the dot product of one CSR matrix and one CSC matrix. The result will be returned in a new CSR or dense
-    matrix. Note that CUDA implementations do not work when dense=False.
+    matrix. The implementation is chosen by :mod:`src.sparse_torch.backend`.
     :param csr: fist input CSR matrix
     :param csc: second input CSC matrix
     :param dense: output matrix in dense format
@@ -420,16 +409,12 @@ def dot(csr: CSRMatrix3d, csc: CSCMatrix3d, dense=False):
     out_h = csr.shape[1]
     out_w = csc.shape[2]
 
-    if csr.indptr.device == torch.device('cpu'):
+    if dense:
+        ret = get_op('csr_dot_csc_dense', csr.device)(*csr.as_list(), *csc.as_list(), batch_num, out_h, out_w)
+    else:
         new_indices, new_indptr, new_data = \
-            sparse_dot.csr_dot_csc(*csr.as_list(), *csc.as_list(), batch_num, out_h, out_w)
+            get_op('csr_dot_csc', csr.device)(*csr.as_list(), *csc.as_list(), batch_num, out_h, out_w)
         ret = CSRMatrix3d([new_indices, new_indptr, new_data], shape=(batch_num, out_h, out_w))
-        if dense:
-            ret = ret.numpy()
-    else:
-        if not dense:
-            raise RuntimeWarning('Sparse dot product result in CUDA is not implemented.')
-        ret = sparse_dot.csr_dot_csc_dense_cuda(*csr.as_list(), *csc.as_list(), batch_num, out_h, out_w)
     return ret
 
 
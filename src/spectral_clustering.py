@@ -3,6 +3,8 @@ import torch
 from torch import Tensor
 from typing import Union, Tuple
 
+from src.utils.linalg import eigh
+
 def initialize(X: Tensor, num_clusters: int, method: str='plus') -> np.array:
     r"""
     Initialize cluster centers.
@@ -218,7 +220,7 @@ def spectral_clustering(sim_matrix: Tensor, cluster_num: int, init: Tensor=None,
         aff_matrix = (degree - sim_matrix) / torch.diag(degree).unsqueeze(1)
     else:
         aff_matrix = degree - sim_matrix
-    e, v = torch.symeig(aff_matrix, eigenvectors=True)
+    e, v = eigh(aff_matrix)
     topargs = torch.argsort(torch.abs(e), descending=False)[1:cluster_num]
     v = v[:, topargs]
 
@@ -1,5 +1,6 @@
 from __future__ import division
 import torch
+import copy
 import math
 import random
 import torch.nn as nn
@@ -301,6 +302,197 @@ def augmentation(im, pset, crop_lb=0.5, crop_ub=1.0, crop_scale_lb=3. / 4., crop
     return trans, qset, coord
 
 
+class BatchedAugmentation(object):
+    r"""
+    Tensor-based augmentation engine, which augments a batch of images with the same pipeline as
+    :func:`augmentation`: random resized crop, vertical/horizontal flip, color jitter, grayscale and gaussian blur.
+
+    All random parameters are sampled per image, and the crop, resize and flips of the whole batch are fused into a
+    single ``grid_sample`` call. The keypoints are transformed as :math:`(b\times n \times 2)` tensors with visibility
+    masks. The engine is stateless between calls, so one instance can be created once and reused.
+
+    .. note::
+        Bilinear resampling is done by ``grid_sample`` (without anti-aliasing), the color jitter is applied in a fixed
+        order (brightness, contrast, saturation, hue), and hue is rotated in YIQ color space. Therefore, the results
+        are not bit-exact compared to the PIL-based :func:`augmentation`.
+    """
+
+    def __init__(self, size=256, crop_lb=0.5, crop_ub=1.0, crop_scale_lb=3. / 4., crop_scale_ub=4. / 3., v_f=0.05,
+                 h_f=0.25, cj=(0.4, 0.4, 0.4, 0.1), cj_p=0.8, gs=0.2, gb=3, gb_sigma=(0.1, 2.0), device=None):
+        if isinstance(size, (tuple, list)):
+            self.size = tuple(size)
+        else:
+            self.size = (size, size)
+        self.scale = (crop_lb, crop_ub)
+        self.ratio = (crop_scale_lb, crop_scale_ub)
+        self.v_f = v_f
+        self.h_f = h_f
+        self.cj = cj
+        self.cj_p = cj_p
+        self.gs = gs
+        self.gb_r = gb // 2
+        self.gb_sigma = gb_sigma
+        self.device = device
+        self._blur_offsets = dict()
+
+    def __call__(self, imgs, pts):
+        r"""
+        :param imgs: :math:`(b\times 3 \times H \times W)` images in [0, 1]
+        :param pts: :math:`(b\times n \times 2)` keypoint coordinates (x, y) in pixels
+        :return: augmented images :math:`(b\times 3 \times h \times w)`, transformed keypoints
+                 :math:`(b\times n \times 2)`, visibility mask :math:`(b\times n)`, normalized crop coordinates
+                 :math:`(b\times 4)` (same as ``coord`` returned by :func:`augmentation`)
+        """
+        device = imgs.device if self.device is None else self.device
+        imgs = imgs.to(device)
+        pts = torch.as_tensor(pts, dtype=imgs.dtype).to(device)
+        batch_size, _, height, width = imgs.shape
+
+        # random resized crop, parameters are sampled on CPU the same way as RandomResizedCropCoord
+        crop = torch.tensor([RandomResizedCropCoord.get_params(imgs[0], self.scale, self.ratio)[:4]
+                             for _ in range(batch_size)], dtype=imgs.dtype, device=device)
+        i, j, h, w = crop.unbind(dim=1)
+        coord = torch.stack((j / (width - 1), i / (height - 1), (j + w - 1) / (width - 1), (i + h - 1) / (height - 1)),
+                            dim=1)
+
+        x, y = pts[:, :, 0], pts[:, :, 1]
+        visible = (x >= j[:, None]) & (x <= (j + w)[:, None]) & (y >= i[:, None]) & (y <= (i + h)[:, None])
+        x = (x - j[:, None]) * self.size[0] / w[:, None]
+        y = (y - i[:, None]) * self.size[1] / h[:, None]
+
+        # random flips
+        v_flip = torch.rand(batch_size, device=device) < self.v_f
+        h_flip = torch.rand(batch_size, device=device) < self.h_f
+        y = torch.where(v_flip[:, None], self.size[1] - y, y)
+        x = torch.where(h_flip[:, None], self.size[0] - x, x)
+        coord = torch.where(v_flip[:, None], coord[:, [0, 3, 2, 1]], coord)
+        coord = torch.where(h_flip[:, None], coord[:, [2, 1, 0, 3]], coord)
+
+        # crop + resize + flips in one affine grid (align_corners=False)
+        sx = torch.where(h_flip, -w / width, w / width)
+        sy = torch.where(v_flip, -h / height, h / height)
+        zeros = torch.zeros_like(sx)
+        theta = torch.stack((
+            torch.stack((sx, zeros, (2 * j + w) / width - 1), dim=1),
+            torch.stack((zeros, sy, (2 * i + h) / height - 1), dim=1)
+        ), dim=1)
+        grid = nn.functional.affine_grid(theta, [batch_size, 3, self.size[1], self.size[0]], align_corners=False)
+        imgs = nn.functional.grid_sample(imgs, grid, mode='bilinear', padding_mode='border', align_corners=False)
+
+        imgs = self.color_jitter(imgs)
+        imgs = self.gaussian_blur(imgs)
+
+        return imgs, torch.stack((x, y), dim=-1), visible, coord
+
+    def color_jitter(self, imgs):
+        """
+        Randomly apply color jitter (with probability ``cj_p``) and grayscale (with probability ``gs``) per image.
+        """
+        batch_size = imgs.shape[0]
+        device = imgs.device
+        apply = (torch.rand(batch_size, device=device) < self.cj_p).to(imgs.dtype)[:, None, None, None]
+
+        def factor(strength):
+            f = 1 + (torch.rand(batch_size, device=device) * 2 - 1) * strength
+            return (f.clamp(min=0)[:, None, None, None] - 1) * apply + 1
+
+        b, c, s, hue = self.cj
+        imgs = (imgs * factor(b)).clamp(0, 1)
+        mean = _rgb_to_gray(imgs).mean(dim=(1, 2, 3), keepdim=True)
+        f = factor(c)
+        imgs = (imgs * f + mean * (1 - f)).clamp(0, 1)
+        f = factor(s)
+        imgs = (imgs * f + _rgb_to_gray(imgs) * (1 - f)).clamp(0, 1)
+        angle = (torch.rand(batch_size, device=device) * 2 - 1) * hue * 2 * math.pi * apply.view(-1)
+        imgs = _rotate_hue(imgs, angle).clamp(0, 1)
+
+        gray = (torch.rand(batch_size, device=device) < self.gs)[:, None, None, None]
+        return torch.where(gray, _rgb_to_gray(imgs).expand_as(imgs), imgs)
+
+    def gaussian_blur(self, imgs):
+        """
+        Separable gaussian blur with per-image sigma and reflection padding.
+        """
+        batch_size, channel, height, width = imgs.shape
+        device = imgs.device
+        key = (device, imgs.dtype)
+        if key not in self._blur_offsets:
+            self._blur_offsets[key] = torch.arange(-self.gb_r, self.gb_r + 1, dtype=imgs.dtype, device=device)
+        offsets = self._blur_offsets[key]
+
+        sigma = torch.empty(batch_size, dtype=imgs.dtype, device=device).uniform_(*self.gb_sigma)
+        kernel = torch.exp(-offsets[None, :] ** 2 / (2 * sigma[:, None] ** 2))
+        kernel = (kernel / kernel.sum(dim=1, keepdim=True)).repeat_interleave(channel, dim=0)
+
+        k = kernel.shape[1]
+        imgs = nn.functional.pad(imgs, [self.gb_r] * 4, mode='reflect').view(1, batch_size * channel,
+                                                                            height + 2 * self.gb_r,
+                                                                            width + 2 * self.gb_r)
+        imgs = nn.functional.conv2d(imgs, kernel.view(-1, 1, k, 1), groups=batch_size * channel)
+        imgs = nn.functional.conv2d(imgs, kernel.view(-1, 1, 1, k), groups=batch_size * channel)
+        return imgs.view(batch_size, channel, height, width)
+
+
+def _rgb_to_gray(imgs):
+    return (0.299 * imgs[:, 0:1] + 0.587 * imgs[:, 1:2] + 0.114 * imgs[:, 2:3])
+
+
+def _rotate_hue(imgs, angle):
+    """
+    Rotate the hue of RGB images by angle (in radians, per image) in YIQ color space.
+    """
+    rgb2yiq = imgs.new_tensor([[0.299, 0.587, 0.114], [0.596, -0.274, -0.322], [0.211, -0.523, 0.312]])
+    yiq2rgb = torch.inverse(rgb2yiq)
+    cos, sin = torch.cos(angle), torch.sin(angle)
+    ones, zeros = torch.ones_like(angle), torch.zeros_like(angle)
+    rot = torch.stack((
+        torch.stack((ones, zeros, zeros), dim=1),
+        torch.stack((zeros, cos, -sin), dim=1),
+        torch.stack((zeros, sin, cos), dim=1)
+    ), dim=1)
+    transform = torch.matmul(yiq2rgb, torch.matmul(rot, rgb2yiq))
+    return torch.einsum('bij,bjhw->bihw', transform, imgs)
+
+
+def augment_anno_dict(anno_dict, engine, num=1, padding_rate=0.5, min_kpt_num=3, shuffle=True):
+    """
+    Augment one annotation dict for ``num`` times in a single batched call of the augmentation engine.
+
+    :param anno_dict: annotation dict with a PIL image and keypoints
+    :param engine: :class:`BatchedAugmentation` instance
+    :param num: number of augmented copies
+    :param padding_rate: probability of replacing an invisible keypoint with a random outlier
+    :param min_kpt_num: pad random outliers until there are at least ``min_kpt_num`` keypoints
+    :param shuffle: random shuffle the keypoints
+    :return: list of augmented annotation dicts, whose images are tensors in [0, 1]
+    """
+    im = anno_dict['image']
+    ps = anno_dict['keypoints']
+    imgs = F.to_tensor(im.convert('RGB')).unsqueeze(0).repeat(num, 1, 1, 1)
+    pts = torch.tensor([(p['x'], p['y']) for p in ps], dtype=torch.float32).view(1, -1, 2).repeat(num, 1, 1)
+    trans, qset, visible, coord = engine(imgs, pts)
+    qset, visible = qset.cpu().tolist(), visible.cpu().tolist()
+
+    ret = []
+    for n in range(num):
+        new_dict = copy.copy(anno_dict)
+        new_dict['image'] = trans[n]
+        new_dict['id'] = None  # the random augmentation is not reproducible, therefore not cacheable
+        qs = []
+        for i in range(len(ps)):
+            if visible[n][i]:
+                qs.append({'name': ps[i]['name'], 'x': qset[n][i][0], 'y': qset[n][i][1]})
+            elif random.random() < padding_rate:
+                qs.append({'name': 'outlier', 'x': random.random() * im.size[0], 'y': random.random() * im.size[1]})
+        while len(qs) < min_kpt_num:
+            qs.append({'name': 'outlier', 'x': random.random() * im.size[0], 'y': random.random() * im.size[1]})
+        if shuffle:
+            random.shuffle(qs)
+        new_dict['keypoints'] = qs
+        ret.append(new_dict)
+    return ret
+
+
 if __name__ == '__main__':
     im = Image.open("./Cars_000a.png").convert('RGB')
     # pset = [(101, 101), (453, 256), (400, 300), (567, 432), (621, 571)]
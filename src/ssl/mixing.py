@@ -0,0 +1,110 @@
+"""
+Batched operations of the self-supervised node feature mixing, on the node features of a batch of graphs which are
+concatenated as a ragged tensor (see ``concat_features`` in the models).
+
+All functions are free of host-device synchronization, and the number of kernel launches does not depend on the batch
+size.
+"""
+import torch
+from torch import Tensor
+
+
+def ragged_index(ns: Tensor, total: int) -> (Tensor, Tensor):
+    r"""
+    The batch index and the local index (inside its graph) of every node in the ragged tensor.
+
+    :param ns: :math:`(b)` number of nodes of every graph
+    :param total: total number of nodes, i.e. ``sum(ns)``, which is known on host as the length of the ragged tensor
+    :return: :math:`(total)` batch index, :math:`(total)` local index
+    """
+    ns = ns.to(torch.long)
+    offsets = torch.cumsum(ns, dim=0) - ns
+    # mark the start of every graph (but the first one), and the cumulative sum counts the graphs
+    batch_idx = torch.zeros(total + 1, dtype=torch.long, device=ns.device)
+    batch_idx = batch_idx.index_add(0, offsets[1:], torch.ones_like(offsets[1:])).cumsum(dim=0)[:total]
+    pos = torch.arange(total, device=ns.device) - offsets[batch_idx]
+    return batch_idx, pos
+
+
+def ragged_to_padded(x: Tensor, ns: Tensor, max_n: int) -> Tensor:
+    r"""
+    Format the ragged node features as a padded batch.
+
+    :param x: :math:`(\sum n_i \times d)` ragged node features
+    :param ns: :math:`(b)` number of nodes of every graph
+    :param max_n: padded number of nodes
+    :return: :math:`(b\times max_n \times d)` padded node features, zeros at the padded positions
+    """
+    batch_idx, pos = ragged_index(ns, x.shape[0])
+    padded = torch.zeros(ns.shape[0], max_n, x.shape[1], dtype=x.dtype, device=x.device)
+    return padded.index_put((batch_idx, pos), x)
+
+
+def batched_randperm(ns: Tensor, max_n: int) -> Tensor:
+    r"""
+    Random permutations of all graphs in one call, by sorting random keys.
+
+    :param ns: :math:`(b)` number of nodes of every graph
+    :param max_n: padded number of nodes
+    :return: :math:`(b\times max_n)` permutations. The first :math:`n_i` elements of the :math:`i`-th row are a random
+             permutation of :math:`0,\ldots,n_i-1`, and the padded positions are permuted among themselves
+    """
+    valid = torch.arange(max_n, device=ns.device).unsqueeze(0) < ns.unsqueeze(1)
+    # the keys of the padded positions are in [1, 2), which are sorted behind the valid ones in [0, 1)
+    keys = torch.rand(ns.shape[0], max_n, device=ns.device) + (~valid).to(torch.float)
+    return torch.argsort(keys, dim=1)
+
+
+def mix_node_features(x: Tensor, ns: Tensor, perm: Tensor, rate: float, detach: bool=False) -> Tensor:
+    r"""
+    Mix every node feature with the feature of the node it is permuted to, inside the same graph:
+    :math:`x_j \leftarrow (1 - rate) x_j + rate \cdot x_{perm(j)}`.
+
+    :param x: :math:`(\sum n_i \times d)` ragged node features
+    :param ns: :math:`(b)` number of nodes of every graph
+    :param perm: :math:`(b\times max_n)` permutations from :func:`batched_randperm`
+    :param rate: mixing rate
+    :param detach: stop the gradient through the mixed-in features
+    :return: :math:`(\sum n_i \times d)` mixed node features
+    """
+    batch_idx, pos = ragged_index(ns, x.shape[0])
+    offsets = torch.cumsum(ns.to(torch.long), dim=0) - ns
+    x_perm = x[offsets[batch_idx] + perm[batch_idx, pos]]
+    if detach:
+        x_perm = x_perm.detach()
+    return x * (1 - rate) + rate * x_perm
+
+
+def perm_to_mat(perm: Tensor, ns: Tensor, dtype=torch.float32) -> Tensor:
+    r"""
+    Permutation matrices of the permutations, i.e. :math:`\mathbf{P}_{j, perm(j)} = 1` for :math:`j < n_i`.
+
+    :param perm: :math:`(b\times max_n)` permutations from :func:`batched_randperm`
+    :param ns: :math:`(b)` number of nodes of every graph
+    :param dtype: data type of the output
+    :return: :math:`(b\times max_n \times max_n)` permutation matrices, zeros at the padded positions
+    """
+    batch_num, max_n = perm.shape
+    valid = torch.arange(max_n, device=perm.device).unsqueeze(0) < ns.unsqueeze(1)
+    perm_mat = torch.zeros(batch_num, max_n, max_n, dtype=dtype, device=perm.device)
+    return perm_mat.scatter(2, perm.unsqueeze(-1), valid.unsqueeze(-1).to(dtype))
+
+
+def compact_nonzero_rows(z: Tensor, *others: Tensor):
+    r"""
+    Move the non-zero rows of every matrix in ``z`` to the front (in their original order), and the rows of
+    ``others`` at the same positions along with them. The remaining rows are filled by zeros.
+
+    :param z: :math:`(b\times n \times d)` batched matrices
+    :param others: other :math:`(b\times n \times d')` batched matrices
+    :return: list of the compacted ``z`` and ``others``
+    """
+    nonzero = z.sum(dim=2) != 0
+    # the zero rows are scattered to an extra row, which is dropped afterwards
+    dest = torch.where(nonzero, torch.cumsum(nonzero.to(torch.long), dim=1) - 1,
+                       torch.full_like(nonzero, z.shape[1], dtype=torch.long))
+    ret = []
+    for t in (z,) + others:
+        out = torch.zeros(t.shape[0], t.shape[1] + 1, t.shape[2], dtype=t.dtype, device=t.device)
+        ret.append(out.scatter(1, dest.unsqueeze(-1).expand(-1, -1, t.shape[2]), t)[:, :-1])
+    return ret
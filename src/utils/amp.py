@@ -0,0 +1,102 @@
+"""
+Automatic mixed precision (AMP) utilities based on native PyTorch autocast.
+
+``cfg.AMP.ENABLED`` enables autocast in the forward pass. The autocast data type is ``cfg.AMP.DTYPE``, and if not
+specified, ``float16`` is used on CUDA and ``bfloat16`` is used on CPU. The gradients are scaled by
+:class:`torch.cuda.amp.GradScaler` only for ``float16``.
+
+The numerically sensitive operations (e.g. Sinkhorn, Hungarian, loss functions) are wrapped by :func:`float32`, which
+disables autocast and computes in float32.
+"""
+import functools
+from contextlib import nullcontext
+import torch
+
+from src.utils.config import cfg
+
+
+def amp_enabled() -> bool:
+    return cfg.AMP.ENABLED or cfg.FP16
+
+
+def autocast_dtype(device: torch.device) -> torch.dtype:
+    """
+    :param device: the device where the model runs
+    :return: the data type of autocast
+    """
+    if cfg.FP16:
+        return torch.float16
+    if len(cfg.AMP.DTYPE) > 0:
+        return getattr(torch, cfg.AMP.DTYPE)
+    return torch.float16 if device.type == 'cuda' else torch.bfloat16
+
+
+def autocast(device: torch.device):
+    """
+    The autocast context of the forward pass. It does nothing if AMP is disabled.
+
+    :param device: the device where the model runs
+    """
+    if not amp_enabled():
+        return nullcontext()
+    if hasattr(torch, 'autocast'):
+        return torch.autocast(device_type=device.type, dtype=autocast_dtype(device))
+    elif device.type == 'cuda':
+        return torch.cuda.amp.autocast()
+    else:
+        raise RuntimeError('Autocast on CPU requires PyTorch>=1.10.')
+
+
+def grad_scaler(device: torch.device) -> torch.cuda.amp.GradScaler:
+    """
+    Gradient scaler to prevent the underflow of float16 gradients. It is a no-op if AMP is disabled or the autocast data
+    type is bfloat16, whose range is the same as float32.
+
+    :param device: the device where the model runs
+    """
+    enabled = amp_enabled() and device.type == 'cuda' and autocast_dtype(device) == torch.float16
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+def _disable_autocast():
+    if hasattr(torch, 'autocast'):
+        return _NestedContext(torch.autocast(device_type='cuda', enabled=False),
+                              torch.autocast(device_type='cpu', enabled=False))
+    elif hasattr(torch.cuda, 'amp'):
+        return torch.cuda.amp.autocast(enabled=False)
+    return nullcontext()
+
+
+class _NestedContext:
+    def __init__(self, *contexts):
+        self.contexts = contexts
+
+    def __enter__(self):
+        for c in self.contexts:
+            c.__enter__()
+
+    def __exit__(self, *args):
+        for c in reversed(self.contexts):
+            c.__exit__(*args)
+
+
+def _to_float32(x):
+    if isinstance(x, torch.Tensor) and x.dtype in (torch.float16, torch.bfloat16):
+        return x.float()
+    elif isinstance(x, (list, tuple)):
+        return type(x)(_to_float32(y) for y in x)
+    return x
+
+
+def float32(func):
+    """
+    Decorator of the float32 islands in the autocast region: autocast is disabled, and the half-precision tensors in
+    the arguments are cast to float32.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not amp_enabled():
+            return func(*args, **kwargs)
+        with _disable_autocast():
+            return func(*_to_float32(args), **{k: _to_float32(v) for k, v in kwargs.items()})
+    return wrapper
@@ -111,13 +111,26 @@ __C.SYNTHETIC.POS_NOISE_STD = 0.00  # position noise ~ N(0, X^2)
 __C.GRAPH = edict()
 
 # The ways of constructing source graph/target graph.
-# Candidates can be 'tri' (Delaunay triangulation), 'fc' (Fully-connected)
+# Candidates can be 'tri' (Delaunay triangulation), 'fc' (Fully-connected), 'knn' (k-nearest-neighbor)
 __C.GRAPH.SRC_GRAPH_CONSTRUCT = 'tri'
 __C.GRAPH.TGT_GRAPH_CONSTRUCT = 'fc'
 
+# Number of neighbors for 'knn' graph construction
+__C.GRAPH.KNN_K = 4
+
+# Cache the constructed graphs by the hash of keypoint coordinates (only for test set, which is deterministic)
+__C.GRAPH.CACHE = True
+
+# Cache the kronecker products of G, H on disk (in CACHE_PATH), keyed by the graph topology. Only helpful if the graphs
+# are deterministic, e.g. for evaluation
+__C.GRAPH.KRON_CACHE = False
+
 # Build a symmetric adjacency matrix, else only the upper right triangle of adjacency matrix will be filled
 __C.GRAPH.SYM_ADJACENCY = True
 
+# Build the third-order hyperedges (triangles) in pyg graphs. Only required by models using hyperedge_index
+__C.GRAPH.HYPEREDGE = False
+
 # Padding length on number of keypoints for batched operation
 __C.GRAPH.PADDING = 23
 
@@ -196,6 +209,24 @@ __C.BACKBONE = 'VGG16_bn'
 
 __C.BACKBONE_IGNORE = False
 
+# Cache the CNN features of the (non-augmented) images, keyed by (dataset, object id). The cache is only used if the
+# backbone is not trained, e.g. for evaluation or with a frozen backbone
+__C.FEATURE_CACHE = edict()
+__C.FEATURE_CACHE.ENABLED = False
+# Size limit of the in-memory LRU tier (in MB, for every device)
+__C.FEATURE_CACHE.MEMORY_MB = 2048
+# Write the features through to a float16 memory-mapped tier on disk (in CACHE_PATH)
+__C.FEATURE_CACHE.DISK = False
+
+# Fused forward pass of the backbone layers (see src.backbone.FusedBackbone)
+__C.BACKBONE_FUSION = edict()
+# Compute in channels-last memory format
+__C.BACKBONE_FUSION.CHANNELS_LAST = False
+# Fold batch normalization into convolution, only if the backbone is not trained
+__C.BACKBONE_FUSION.FOLD_BN = False
+# Compile the backbone: '' for no compilation, 'script' for TorchScript, 'compile' for torch.compile (PyTorch>=2.0)
+__C.BACKBONE_FUSION.COMPILE = ''
+
 # Parallel GPU indices ([0] for single GPU)
 __C.GPUS = [0]
 
@@ -230,7 +261,27 @@ __C.STATISTIC_STEP = 100
 # random seed used for data loading
 __C.RANDOM_SEED = 123
 
-# enable fp16 instead of fp32 in the model (via nvidia/apex)
+# enable the sanity checks that synchronize with the device (e.g. the value range of the loss function inputs)
+__C.DEBUG = False
+
+# Distributed data parallel options. The distributed mode is enabled if the script is launched by torchrun (or
+# python -m torch.distributed.launch --use_env) with WORLD_SIZE > 1
+__C.DIST = edict()
+
+# 'nccl' or 'gloo'. If empty, nccl is used for CUDA and gloo is used for CPU
+__C.DIST.BACKEND = ''
+
+# Required if some parameters are not used in forward (e.g. the SSL branches)
+__C.DIST.FIND_UNUSED_PARAMETERS = True
+
+# Automatic mixed precision by torch autocast
+__C.AMP = edict()
+__C.AMP.ENABLED = False
+
+# 'float16' or 'bfloat16'. If empty, float16 is used for CUDA and bfloat16 is used for CPU
+__C.AMP.DTYPE = ''
+
+# enable fp16 mixed precision (deprecated, same as AMP.ENABLED=True and AMP.DTYPE='float16')
 __C.FP16 = False
 
 def lcm(x, y):
@@ -1,5 +1,6 @@
 import torch
 from src.sparse_torch.csx_matrix import CSRMatrix3d, CSCMatrix3d
+from src.factorize_graph_matching import KroneckerAffinity
 import torch_geometric as pyg
 
 def data_to_cuda(inputs):
@@ -20,7 +21,7 @@ def data_to_cuda(inputs):
             inputs[key] = data_to_cuda(inputs[key])
     elif type(inputs) in [str, int, float]:
         inputs = inputs
-    elif type(inputs) in [torch.Tensor, CSRMatrix3d, CSCMatrix3d]:
+    elif type(inputs) in [torch.Tensor, CSRMatrix3d, CSCMatrix3d, KroneckerAffinity]:
         inputs = inputs.cuda()
     elif type(inputs) in [pyg.data.Data, pyg.data.Batch]:
         inputs = inputs.to('cuda')
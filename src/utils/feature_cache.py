@@ -0,0 +1,128 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import torch
+
+
+class FeatureCache:
+    r"""
+    Two-tier cache of the CNN features of images, keyed by a non-negative integer which identifies the image (see
+    :meth:`hash_key`).
+
+    The memory tier is a LRU cache whose total size is limited by ``memory_mb``. If ``disk_path`` is specified, the
+    features are also written through to disk as float16 ``.npy`` arrays, and are loaded by memory mapping upon a miss
+    in the memory tier. The features loaded from disk are float16 CPU tensors.
+
+    :param memory_mb: size limit of the memory tier, in megabytes
+    :param disk_path: directory of the disk tier. ``None`` for no disk tier
+
+    .. note::
+        The cached features are only valid for the backbone weights which computed them. The disk tier should be
+        placed in a directory specific to the backbone, see :meth:`default_disk_path`.
+    """
+    def __init__(self, memory_mb: float=2048, disk_path: str=None):
+        self.capacity = int(memory_mb * 2 ** 20)
+        self.disk_path = disk_path
+        if disk_path is not None:
+            os.makedirs(disk_path, exist_ok=True)
+        self.memory = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: int):
+        r"""
+        :param key: the key of the image
+        :return: tuple of the cached feature tensors, or ``None`` upon a miss
+        """
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+
+        if self.disk_path is not None:
+            files = self._disk_files(key)
+            if len(files) > 0:
+                feats = tuple(torch.from_numpy(np.array(np.load(f, mmap_mode='r'))) for f in files)
+                self._put_memory(key, feats)
+                self.hits += 1
+                return feats
+
+        self.misses += 1
+        return None
+
+    def put(self, key: int, feats):
+        r"""
+        :param key: the key of the image
+        :param feats: tuple of the feature tensors of the image
+        """
+        # owned copies, since the features are usually views into the whole batch, whose storage would be kept alive
+        # and not counted by the size limit
+        feats = tuple(f.detach().clone() for f in feats)
+        self._put_memory(key, feats)
+        if self.disk_path is not None:
+            prefix = self._disk_prefix(key)
+            if os.path.exists('{}_0.npy'.format(prefix)):
+                return
+            # the first file is written at last, which marks the features of the key as complete
+            for i in reversed(range(len(feats))):
+                # the temporary file is unique to the process and thread, which may write the same key concurrently
+                tmp_file = '{}_{}.{}-{}.tmp.npy'.format(prefix, i, os.getpid(), threading.get_ident())
+                np.save(tmp_file, feats[i].to(device='cpu', dtype=torch.float16).numpy())
+                os.replace(tmp_file, '{}_{}.npy'.format(prefix, i))
+
+    def clear(self):
+        """
+        Clear the memory tier. The disk tier is kept.
+        """
+        self.memory.clear()
+        self.size = 0
+
+    def _put_memory(self, key, feats):
+        if key in self.memory:
+            self.size -= self._nbytes(self.memory.pop(key))
+        self.memory[key] = feats
+        self.size += self._nbytes(feats)
+        while self.size > self.capacity and len(self.memory) > 0:
+            _, evicted = self.memory.popitem(last=False)
+            self.size -= self._nbytes(evicted)
+
+    def _disk_prefix(self, key):
+        return os.path.join(self.disk_path, '{:016x}'.format(key))
+
+    def _disk_files(self, key):
+        prefix = self._disk_prefix(key)
+        files = []
+        while os.path.exists('{}_{}.npy'.format(prefix, len(files))):
+            files.append('{}_{}.npy'.format(prefix, len(files)))
+        return files
+
+    @staticmethod
+    def _nbytes(feats):
+        return sum(f.numel() * f.element_size() for f in feats)
+
+    @staticmethod
+    def hash_key(*ids) -> int:
+        r"""
+        The key of an image, which is a 63-bit hash of its identifiers, e.g. ``hash_key('PascalVOC', 'cat', xml_name)``.
+        The key is an integer so that it can be stored in a tensor, and be split with the batch.
+
+        :param ids: identifiers of the image
+        :return: the key
+        """
+        digest = hashlib.md5('/'.join(str(x) for x in ids).encode()).digest()
+        return int.from_bytes(digest[:8], 'little') & (2 ** 63 - 1)
+
+    @staticmethod
+    def default_disk_path(cache_path: str, *backbone_ids) -> str:
+        r"""
+        The directory of the disk tier, which is specific to the backbone.
+
+        :param cache_path: root of the cache directory
+        :param backbone_ids: anything that identifies the backbone weights and the input images, e.g. the backbone
+                             name, the path of the pretrained weights and the image size
+        :return: the directory
+        """
+        return os.path.join(cache_path, 'feature', hashlib.md5(str(backbone_ids).encode()).hexdigest())
@@ -0,0 +1,69 @@
+import torch
+from torch import Tensor
+
+
+def eigh(A: Tensor) -> (Tensor, Tensor):
+    r"""
+    Batched eigen-decomposition of symmetric matrices. ``torch.linalg.eigh`` is used if available, otherwise it falls
+    back to the deprecated ``torch.symeig``.
+
+    :param A: :math:`(\ldots \times n \times n)` symmetric matrices
+    :return: :math:`(\ldots \times n)` eigenvalues in ascending order, :math:`(\ldots \times n \times n)` eigenvectors
+    """
+    if hasattr(torch, 'linalg') and hasattr(torch.linalg, 'eigh'):
+        return torch.linalg.eigh(A)
+    return torch.symeig(A, eigenvectors=True)
+
+
+def eigvalsh(A: Tensor) -> Tensor:
+    r"""
+    Batched eigenvalues of symmetric matrices, in ascending order.
+
+    :param A: :math:`(\ldots \times n \times n)` symmetric matrices
+    :return: :math:`(\ldots \times n)` eigenvalues
+    """
+    if hasattr(torch, 'linalg') and hasattr(torch.linalg, 'eigvalsh'):
+        return torch.linalg.eigvalsh(A)
+    return torch.symeig(A, eigenvectors=False)[0]
+
+
+def _qr(A: Tensor) -> Tensor:
+    if hasattr(torch, 'linalg') and hasattr(torch.linalg, 'qr'):
+        return torch.linalg.qr(A)[0]
+    return torch.qr(A)[0]
+
+
+def top_eigh(A: Tensor, k: int, method: str='full', n_iter: int=4, oversample: int=8) -> (Tensor, Tensor):
+    r"""
+    The top-:math:`k` (largest) eigenvalues and eigenvectors of batched symmetric matrices.
+
+    Available methods:
+    ::
+
+        'full': full eigen-decomposition by eigh, which costs O(n^3).
+        'randomized': randomized subspace iteration with Rayleigh-Ritz projection, which costs O(n^2 (k + oversample))
+                      per iteration. It converges to the eigenvalues of the largest magnitude, therefore the top-k
+                      eigenvalues are assumed to dominate the negative ones, e.g. for the joint matching matrix of
+                      multiple graphs whose top eigenvalues are close to the number of graphs.
+
+    :param A: :math:`(b\times n \times n)` symmetric matrices
+    :param k: number of eigenvectors
+    :param method: ``'full'`` or ``'randomized'``
+    :param n_iter: number of subspace iterations (only for ``'randomized'``)
+    :param oversample: number of extra vectors in the subspace (only for ``'randomized'``)
+    :return: :math:`(b\times k)` eigenvalues in ascending order, :math:`(b\times n \times k)` eigenvectors
+    """
+    if method not in ('full', 'randomized'):
+        raise ValueError('Unknown eigensolver: {}'.format(method))
+    n = A.shape[-1]
+    k = min(k, n)
+    if method == 'full' or k + oversample >= n:
+        e, v = eigh(A)
+        return e[..., -k:], v[..., -k:]
+    else:
+        Q = torch.randn(A.shape[0], n, k + oversample, dtype=A.dtype, device=A.device)
+        for _ in range(n_iter):
+            Q = _qr(torch.bmm(A, Q))
+        B = torch.bmm(torch.bmm(Q.transpose(1, 2), A), Q)
+        e, u = eigh((B + B.transpose(1, 2)) / 2)
+        return e[..., -k:], torch.bmm(Q, u[..., -k:])
@@ -1,4 +1,5 @@
 import argparse
+import os
 from src.utils.config import cfg, cfg_from_file, cfg_from_list, get_output_dir
 from pathlib import Path
 
@@ -12,8 +13,13 @@ def parse_args(description):
     parser.add_argument('--epoch', dest='epoch',
                         help='epoch number', default=None, type=int)
     parser.add_argument('--rate', default=1.0, type=float)
+    parser.add_argument('--local_rank', default=None, type=int,
+                        help='set by torch.distributed.launch (without --use_env)')
     args = parser.parse_args()
 
+    if args.local_rank is not None:
+        os.environ['LOCAL_RANK'] = str(args.local_rank)
+
     # load cfg from file
     if args.cfg_file is not None:
         for f in args.cfg_file:
@@ -1,19 +1,10 @@
-import sys
-import os
 import torch
 from torch.autograd import Function
 import numpy as np
 import scipy.sparse as ssp
 
 from src.sparse_torch import CSRMatrix3d, CSCMatrix3d
-
-if 'SPHINX' not in os.environ:
-    from torch.utils.cpp_extension import load
-    bilinear_diag = load(name='bilinear_diag', sources=['src/extension/bilinear_diag/bilinear_diag.cpp',
-                                                        'src/extension/bilinear_diag/bilinear_diag_cuda.cu'],
-                         extra_include_paths=[
-                             '/usr/include/python{}.{}/'.format(sys.version_info.major, sys.version_info.minor)]
-                         )
+from src.sparse_torch.backend import get_op
 
 
 def to_sparse(x, dense_dim=1):
@@ -36,6 +27,30 @@ def sbmm(t1, t2):
     return SparseDenseDenseBMM.apply(t1, t2)
 
 
+def batch_matvec(M, v):
+    """
+    Perform bmm for the affinity matrix M and dense v -> dense. M can be a dense tensor, a sparse tensor or a lazy
+    operator providing ``matvec`` (e.g. :class:`~src.factorize_graph_matching.FactorizedAffinity`).
+    """
+    if hasattr(M, 'matvec'):
+        return M.matvec(v)
+    elif M.is_sparse:
+        return sbmm(M, v)
+    else:
+        return torch.bmm(M, v)
+
+
+def batch_select(M, idx):
+    """
+    Select instances from the batched affinity matrix M (dense, sparse or lazy operator).
+    :param idx: indices of the selected instances (LongTensor)
+    """
+    if isinstance(M, torch.Tensor) and M.is_sparse:
+        return torch.stack([M[i] for i in idx.tolist()])
+    else:
+        return M[idx]
+
+
 def sbmm_diag(t1, t2):
     """
     Perform bmm and diagonal for sparse x dense -> dense. The diagonalized result is returned in vector tensor.
@@ -185,7 +200,8 @@ def bilinear_diag_torch(s_t1: CSRMatrix3d, d_t2: torch.Tensor, s_t3: CSCMatrix3d
     with s_t1.shape = (b, x, y), d_t2.shape = (b, y, y), d_t3.shape = (b, y, x), the output shape is (b, x).
     In this function, two sparse tensors (s1 and s3) are represented in CSR and CSC format to guarantee efficient
     computation.
-    The main operation is implemented in a custom C++ extension, and will be ~1000x faster if CUDA is available.
+    The main operation is dispatched by :mod:`src.sparse_torch.backend`: the custom C++/CUDA extension for CUDA
+    tensors, and a vectorized PyTorch implementation otherwise.
     :param s_t1: CSR matrix 1
     :param d_t2: dense tensor 2
     :param s_t3: CSC matrix 3
@@ -230,7 +246,7 @@ def bilinear_diag_torch(s_t1: CSRMatrix3d, d_t2: torch.Tensor, s_t3: CSCMatrix3d
                 _dtype = torch.int64
             input[idx] = torch.tensor(np.concatenate(input[idx]), dtype=_dtype, device=device)
     '''
-    outp = bilinear_diag.bilinear_diag(*s_t1.as_list(), d_t2, *s_t3.as_list(), batch_num, xlen)
+    outp = get_op('bilinear_diag', d_t2.device)(*s_t1.as_list(), d_t2, *s_t3.as_list(), batch_num, xlen)
 
     return outp.to(device)
 
@@ -2,6 +2,7 @@ import torch.optim as optim
 import time
 import xlwt
 from datetime import datetime
+from contextlib import nullcontext
 from pathlib import Path
 from tensorboardX import SummaryWriter
 
@@ -9,10 +10,11 @@ from src.dataset.data_loader import GMDataset, get_dataloader
 from src.displacement_layer import Displacement
 from src.loss_func import *
 from src.evaluation_metric import matching_recall
-from src.parallel import DataParallel
+from src.parallel import DataParallel, DistributedDataParallel, init_distributed, is_distributed, is_main_process
 from src.utils.model_sl import load_model, save_model
 from eval import eval_model
 from src.utils.data_to_cuda import data_to_cuda
+from src.utils.amp import autocast, grad_scaler
 
 from src.utils.config import cfg
 
@@ -28,11 +30,12 @@ def train_eval_model(model,
     print('Start training...')
 
     since = time.time()
-    dataset_size = len(dataloader['train'].dataset)
+    dataset_size = len(dataloader['train'].sampler)  # number of samples of this process
     displacement = Displacement()
 
     device = next(model.parameters()).device
     print('model on device: {}'.format(device))
+    scaler = grad_scaler(device)
 
     checkpoint_path = Path(cfg.OUTPUT_PATH) / 'params'
     if not checkpoint_path.exists():
@@ -60,6 +63,8 @@ def train_eval_model(model,
         print('-' * 10)
 
         model.train()  # Set model to training mode
+        if hasattr(dataloader['train'].sampler, 'set_epoch'):
+            dataloader['train'].sampler.set_epoch(epoch)
 
         print('lr = ' + ', '.join(['{:.2e}'.format(x['lr']) for x in optimizer.param_groups]))
 
@@ -71,7 +76,7 @@ def train_eval_model(model,
 
         # Iterate over data.
         for inputs in dataloader['train']:
-            if model.module.device != torch.device('cpu'):
+            if device != torch.device('cpu'):
                 inputs = data_to_cuda(inputs)
 
             iter_num = iter_num + 1
@@ -81,7 +86,8 @@ def train_eval_model(model,
 
             with torch.set_grad_enabled(True):
                 # forward
-                outputs = model(inputs)
+                with autocast(device):
+                    outputs = model(inputs)
 
                 if cfg.PROBLEM.TYPE == '2GM':
                     assert 'ds_mat' in outputs
@@ -133,7 +139,7 @@ def train_eval_model(model,
 
                     # compute loss & accuracy
                     if cfg.TRAIN.LOSS_FUNC in ['perm', 'ce' 'hung']:
-                        loss = torch.zeros(1, device=model.module.device)
+                        loss = torch.zeros(1, device=device)
                         ns = outputs['ns']
                         for s_pred, x_gt, (idx_src, idx_tgt) in \
                                 zip(outputs['ds_mat_list'], outputs['gt_perm_mat_list'], outputs['graph_indices']):
@@ -146,7 +152,7 @@ def train_eval_model(model,
                         raise ValueError('Unsupported loss function {} for problem type {}'.format(cfg.TRAIN.LOSS_FUNC, cfg.PROBLEM.TYPE))
 
                     # compute accuracy
-                    acc = torch.zeros(1, device=model.module.device)
+                    acc = torch.zeros(1, device=device)
                     for x_pred, x_gt, (idx_src, idx_tgt) in \
                             zip(outputs['perm_mat_list'], outputs['gt_perm_mat_list'], outputs['graph_indices']):
                         a = matching_recall(x_pred, x_gt, ns[idx_src])
@@ -156,27 +162,25 @@ def train_eval_model(model,
                     raise ValueError('Unknown problem type {}'.format(cfg.PROBLEM.TYPE))
 
                 # backward + optimize
-                if cfg.FP16:
-                    with amp.scale_loss(loss, optimizer) as scaled_loss:
-                        scaled_loss.backward()
-                else:
-                    loss.backward()
-                optimizer.step()
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
 
                 batch_num = inputs['batch_size']
 
                 # tfboard writer
-                loss_dict = dict()
-                loss_dict['loss'] = loss.item()
-                tfboard_writer.add_scalars('loss', loss_dict, epoch * cfg.TRAIN.EPOCH_ITERS + iter_num)
-
-                accdict = dict()
-                accdict['matching accuracy'] = torch.mean(acc)
-                tfboard_writer.add_scalars(
-                    'training accuracy',
-                    accdict,
-                    epoch * cfg.TRAIN.EPOCH_ITERS + iter_num
-                )
+                if tfboard_writer is not None:
+                    loss_dict = dict()
+                    loss_dict['loss'] = loss.item()
+                    tfboard_writer.add_scalars('loss', loss_dict, epoch * cfg.TRAIN.EPOCH_ITERS + iter_num)
+
+                    accdict = dict()
+                    accdict['matching accuracy'] = torch.mean(acc)
+                    tfboard_writer.add_scalars(
+                        'training accuracy',
+                        accdict,
+                        epoch * cfg.TRAIN.EPOCH_ITERS + iter_num
+                    )
 
                 # statistics
                 running_loss += loss.item() * batch_num
@@ -187,17 +191,18 @@ def train_eval_model(model,
                     running_speed = cfg.STATISTIC_STEP * batch_num / (time.time() - running_since)
                     print('Epoch {:<4} Iteration {:<4} {:>4.2f}sample/s Loss={:<8.4f}'
                           .format(epoch, iter_num, running_speed, running_loss / cfg.STATISTIC_STEP / batch_num))
-                    tfboard_writer.add_scalars(
-                        'speed',
-                        {'speed': running_speed},
-                        epoch * cfg.TRAIN.EPOCH_ITERS + iter_num
-                    )
-
-                    tfboard_writer.add_scalars(
-                        'learning rate',
-                        {'lr_{}'.format(i): x['lr'] for i, x in enumerate(optimizer.param_groups)},
-                        epoch * cfg.TRAIN.EPOCH_ITERS + iter_num
-                    )
+                    if tfboard_writer is not None:
+                        tfboard_writer.add_scalars(
+                            'speed',
+                            {'speed': running_speed},
+                            epoch * cfg.TRAIN.EPOCH_ITERS + iter_num
+                        )
+
+                        tfboard_writer.add_scalars(
+                            'learning rate',
+                            {'lr_{}'.format(i): x['lr'] for i, x in enumerate(optimizer.param_groups)},
+                            epoch * cfg.TRAIN.EPOCH_ITERS + iter_num
+                        )
 
                     running_loss = 0.0
                     running_since = time.time()
@@ -205,8 +210,9 @@ def train_eval_model(model,
         epoch_loss = epoch_loss / (dataset_size + 1e-5)
         epoch_loss_cl = epoch_loss_cl / (dataset_size + 1e-5)
 
-        save_model(model, str(checkpoint_path / 'params_{:04}.pt'.format(epoch + 1)))
-        torch.save(optimizer.state_dict(), str(checkpoint_path / 'optim_{:04}.pt'.format(epoch + 1)))
+        if is_main_process():
+            save_model(model, str(checkpoint_path / 'params_{:04}.pt'.format(epoch + 1)))
+            torch.save(optimizer.state_dict(), str(checkpoint_path / 'optim_{:04}.pt'.format(epoch + 1)))
 
         print('Epoch {:<4} Loss_1: {:.4f} Loss_2: {:.4f}'.format(epoch, epoch_loss - epoch_loss_cl, epoch_loss_cl))
         print()
@@ -215,12 +221,14 @@ def train_eval_model(model,
         accs = eval_model(model, dataloader['test'], xls_sheet=xls_wb.add_sheet('epoch{}'.format(epoch + 1)))
         acc_dict = {"{}".format(cls): single_acc for cls, single_acc in zip(dataloader['test'].dataset.classes, accs)}
         acc_dict['average'] = torch.mean(accs)
-        tfboard_writer.add_scalars(
-            'Eval acc',
-            acc_dict,
-            (epoch + 1) * cfg.TRAIN.EPOCH_ITERS
-        )
-        wb.save(wb.__save_path)
+        if tfboard_writer is not None:
+            tfboard_writer.add_scalars(
+                'Eval acc',
+                acc_dict,
+                (epoch + 1) * cfg.TRAIN.EPOCH_ITERS
+            )
+        if is_main_process():
+            wb.save(wb.__save_path)
 
         scheduler.step()
 
@@ -243,6 +251,7 @@ if __name__ == '__main__':
     mod = importlib.import_module(cfg.MODULE)
     Net = mod.Net
 
+    device = init_distributed()
     torch.manual_seed(cfg.RANDOM_SEED)
 
     dataset_len = {'train': cfg.TRAIN.EPOCH_ITERS * cfg.BATCH_SIZE, 'test': cfg.EVAL.SAMPLES}
@@ -262,8 +271,6 @@ if __name__ == '__main__':
     dataloader = {x: get_dataloader(image_dataset[x], fix_seed=(x == 'test'))
                   for x in ('train', 'test')}
 
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-
     model = Net()
     model = model.to(device)
 
@@ -301,24 +308,24 @@ if __name__ == '__main__':
     else:
         raise ValueError('Unknown optimizer {}'.format(cfg.TRAIN.OPTIMIZER))
 
-    if cfg.FP16:
-        try:
-            from apex import amp
-        except ImportError:
-            raise ImportError("Please install apex from https://www.github.com/nvidia/apex to enable FP16.")
-        model, optimizer = amp.initialize(model, optimizer)
-
-    model = DataParallel(model, device_ids=cfg.GPUS)
+    if is_distributed():
+        model = DistributedDataParallel(model)
+    else:
+        model = DataParallel(model, device_ids=cfg.GPUS)
 
     if not Path(cfg.OUTPUT_PATH).exists():
         Path(cfg.OUTPUT_PATH).mkdir(parents=True)
 
     now_time = datetime.now().strftime('%Y-%m-%d-%H-%M-%S-%f')[:-3]
-    tfboardwriter = SummaryWriter(logdir=str(Path(cfg.OUTPUT_PATH) / 'tensorboard' / 'training_{}'.format(now_time)))
+    if is_main_process():
+        tfboardwriter = SummaryWriter(logdir=str(Path(cfg.OUTPUT_PATH) / 'tensorboard' / 'training_{}'.format(now_time)))
+    else:
+        tfboardwriter = None
     wb = xlwt.Workbook()
     wb.__save_path = str(Path(cfg.OUTPUT_PATH) / ('train_eval_result_' + now_time + '.xls'))
 
-    with DupStdoutFileManager(str(Path(cfg.OUTPUT_PATH) / ('train_log_' + now_time + '.log'))) as _:
+    with DupStdoutFileManager(str(Path(cfg.OUTPUT_PATH) / ('train_log_' + now_time + '.log'))) \
+            if is_main_process() else nullcontext() as _:
         print('rate : ', rate_1, rate_2)
         print_easydict(cfg)
         print('Number of parameters: {:.2f}M'.format(count_parameters(model) / 1e6))
@@ -327,4 +334,5 @@ if __name__ == '__main__':
                                  start_epoch=cfg.TRAIN.START_EPOCH,
                                  xls_wb=wb)
 
-    wb.save(wb.__save_path)
+    if is_main_process():
+        wb.save(wb.__save_path)
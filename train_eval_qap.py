@@ -11,6 +11,7 @@ from src.parallel import DataParallel
 from src.utils.model_sl import load_model, save_model
 from eval_qap import eval_model
 from src.utils.data_to_cuda import data_to_cuda
+from src.utils.amp import autocast, grad_scaler
 
 from src.utils.config import cfg
 
@@ -29,6 +30,7 @@ def train_eval_model(model,
 
     device = next(model.parameters()).device
     print('model on device: {}'.format(device))
+    scaler = grad_scaler(device)
 
     alphas = torch.tensor(cfg.EVAL.PCK_ALPHAS, dtype=torch.float32, device=device)  # for evaluation
 
@@ -71,7 +73,7 @@ def train_eval_model(model,
 
         # Iterate over data.
         for inputs in dataloader['train']:
-            if model.module.device != torch.device('cpu'):
+            if device != torch.device('cpu'):
                 inputs = data_to_cuda(inputs)
 
             n1_gt, n2_gt = inputs['ns']
@@ -85,7 +87,8 @@ def train_eval_model(model,
             with torch.set_grad_enabled(True):
                 with torch.autograd.set_detect_anomaly(det_anomaly):
                     # forward
-                    pred = model(inputs)
+                    with autocast(device):
+                        pred = model(inputs)
                     s_pred, affmtx = pred['ds_mat'], pred['aff_mat']
 
                     if type(s_pred) is list:
@@ -101,11 +104,9 @@ def train_eval_model(model,
                     else:
                         raise ValueError('Unknown loss function {}'.format(cfg.TRAIN.LOSS_FUNC))
 
-                    if cfg.FP16:
-                        with amp.scale_loss(loss, optimizer) as scaled_loss:
-                            scaled_loss.backward()
-                    else:
-                        loss.backward()
+                    scaler.scale(loss).backward()
+                    # check the true gradients, and the scaler records the overflow to reduce the loss scale
+                    scaler.unscale_(optimizer)
 
                     det_anomaly = False
 
@@ -114,7 +115,8 @@ def train_eval_model(model,
                             det_anomaly = True
                             break
                     if not det_anomaly:
-                        optimizer.step()
+                        scaler.step(optimizer)
+                    scaler.update()
 
                     # training accuracy statistic
                     #acc, _, __ = matching_accuracy(lap_solver(s_pred, n1_gt, n2_gt), perm_mat, n1_gt)
@@ -229,13 +231,6 @@ if __name__ == '__main__':
     else:
         raise ValueError('Unknown optimizer {}'.format(cfg.TRAIN.OPTIMIZER))
 
-    if cfg.FP16:
-        try:
-            from apex import amp
-        except ImportError:
-            raise ImportError("Please install apex from https://www.github.com/nvidia/apex to enable FP16.")
-        model, optimizer = amp.initialize(model, optimizer)
-
     model = DataParallel(model, device_ids=cfg.GPUS)
 
     if not Path(cfg.OUTPUT_PATH).exists():
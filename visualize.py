@@ -53,7 +53,7 @@ def visualize_model(models, dataloader, device, num_images=6, set='test', cls=No
         images_so_far = 0
 
         for i, inputs in enumerate(dataloader[set]):
-            if models[0].module.device != torch.device('cpu'):
+            if device != torch.device('cpu'):
                 inputs = data_to_cuda(inputs)
             assert 'images' in inputs
             data1, data2 = inputs['images']